@@ -0,0 +1,715 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import random
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+import keyboard as app
+import control
+import host_agent
+
+class NullTyper:
+    def press_and_release(self, keys):
+        pass
+
+    def write(self, text):
+        pass
+
+def stub_typing_backends():
+    app.ensure_backends()
+    app.pyautogui = None
+    app.keyboard = NullTyper()
+
+def make_keyboard(key_count, name="bench"):
+    columns = max(1, int(key_count ** 0.5 * 2))
+    key_width = max(4, app.LAYOUT_WIDTH // columns - 4)
+    rows = (key_count + columns - 1) // columns
+    key_height = max(4, (app.LAYOUT_HEIGHT - 90) // max(1, rows) - 4)
+    keys = []
+    for i in range(key_count):
+        row, column = divmod(i, columns)
+        actions = {direction: f"{direction[0]}{i % 10}" for direction in app.DIRECTIONS}
+        actions["Tap"] = string.ascii_lowercase[i % 26]
+        keys.append({
+            "char": actions["Tap"],
+            "x": column * (key_width + 4),
+            "y": row * (key_height + 4),
+            "width": key_width,
+            "height": key_height,
+            "actions": actions
+        })
+    return {"id": f"{name}-{key_count}", "name": f"{name} {key_count}", "keys": keys}
+
+def legacy_truncate_text(text, font, max_width):
+    if not text:
+        return text
+    text_width = font.size(text)[0]
+    if text_width <= max_width:
+        return text
+    ellipsis = "..."
+    ellipsis_width = font.size(ellipsis)[0]
+    available_width = max_width - ellipsis_width
+    if available_width <= 0:
+        return ellipsis
+    truncated = ""
+    for i in range(len(text)):
+        if font.size(text[:i+1])[0] > available_width:
+            break
+        truncated = text[:i+1]
+    return truncated + ellipsis
+
+def time_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def bench_truncate(size, repeat):
+    rng = random.Random(size)
+    text = "".join(rng.choice(string.ascii_letters + string.digits + '{}[]:," ') for _ in range(size))
+    results = {}
+    for font_name, text_font, max_width in [("small_font", app.small_font, 400), ("font", app.font, 140)]:
+        expected = legacy_truncate_text(text, text_font, max_width)
+        legacy_ms = time_call(lambda: legacy_truncate_text(text, text_font, max_width), 1)
+        app.truncate_cache.clear()
+        app.glyph_width_cache.clear()
+        cold_ms = time_call(lambda: app.truncate_text(text, text_font, max_width), 1)
+        warm_ms = time_call(lambda: app.truncate_text(text, text_font, max_width), repeat)
+        assert app.truncate_text(text, text_font, max_width) == expected, "truncate_text disagrees with the legacy cut"
+        results[f"truncate_{size}_{font_name}"] = {"legacy_ms": legacy_ms, "cold_ms": cold_ms, "warm_ms": warm_ms}
+    return results
+
+def bench_clipboard(calls):
+    # Writes to the system clipboard; whatever each provider held before is put
+    # back afterwards. Providers that are unavailable here report ok=0 and their
+    # timings only measure the failure path.
+    results = {}
+    text = "clipboard benchmark " * 50
+    providers = ["scrap", "pyperclip"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        original = {provider: app.read_clipboard_text(provider) for provider in providers}
+        written = []
+        try:
+            for provider in providers:
+                ok = app.write_clipboard_text(text, provider)
+                if ok:
+                    written.append(provider)
+                write_ms = time_call(lambda: app.write_clipboard_text(text, provider), calls)
+                read_ms = time_call(lambda: app.read_clipboard_text(provider), calls)
+                results[f"clipboard_{provider}"] = {"ok": float(ok), "write_ms": write_ms, "read_ms": read_ms}
+            # UI-thread cost of the service: queued writes and change-detected repeats.
+            saved = (app.clipboard_provider, app.clipboard_text, app.clipboard_fresh)
+            app.clipboard_provider = "pyperclip"
+            app.clipboard_fresh = False
+            queued_ms = time_call(lambda: app.copy_to_clipboard(text), calls)
+            for _ in range(calls):
+                app.clipboard_results.get()
+            app.clipboard_text = text
+            app.clipboard_fresh = True
+            unchanged_ms = time_call(lambda: app.copy_to_clipboard(text), calls)
+            app.clipboard_provider, app.clipboard_text, app.clipboard_fresh = saved
+        finally:
+            for provider in written:
+                app.write_clipboard_text(original[provider], provider)
+    results["clipboard_service"] = {"queued_write_ms": queued_ms, "unchanged_write_ms": unchanged_ms}
+    return results
+
+def bench_typing_soak(keystrokes, samples):
+    # Roughly one keystroke every 0.5s for 24 hours; memory and the cost of a
+    # keyboard frame must not grow with session length.
+    stub_typing_backends()
+    app.selected_keyboard = make_keyboard(60, "soak")
+    app.state = "keyboard"
+    app.clear_input_history()
+    typed = ["a", "b", "Space", "Backspace", "hello", "Enter", "c", "Backspace"]
+    frame_ms = []
+    memory = []
+    tracemalloc.start()
+    interval = max(1, keystrokes // samples)
+    with contextlib.redirect_stdout(io.StringIO()) as log:
+        for i in range(keystrokes):
+            app.send_key(typed[i % len(typed)])
+            if i % interval == 0:
+                log.seek(0)
+                log.truncate()
+                frame_ms.append(time_call(app.draw_keyboard, 20))
+                memory.append(tracemalloc.get_traced_memory()[0] / 1024)
+    tracemalloc.stop()
+    return {"typing_soak": {
+        "first_frame_ms": frame_ms[0],
+        "last_frame_ms": frame_ms[-1],
+        "mid_mem_kb": memory[len(memory) // 2],
+        "last_mem_kb": memory[-1],
+        "history_entries": len(app.input_buffer)
+    }}
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import contextlib, io
+with contextlib.redirect_stdout(io.StringIO()):
+    import keyboard as app
+    imported = time.perf_counter()
+    app.setup()
+    app.update_loop()
+print(imported - start, time.perf_counter() - start)
+"""
+
+def bench_startup(runs, target_ms=300):
+    # Each run is a fresh interpreter so module import and font lookup are cold
+    # inside the process; time to first frame covers import, setup() and one update_loop().
+    env = dict(os.environ, SDL_VIDEODRIVER=os.environ["SDL_VIDEODRIVER"], SDL_AUDIODRIVER=os.environ["SDL_AUDIODRIVER"], PYGAME_HIDE_SUPPORT_PROMPT="1")
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    import_ms = []
+    first_frame_ms = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=script_dir, env=env, capture_output=True, text=True, check=True).stdout
+        imported, first_frame = output.split()[-2:]
+        import_ms.append(float(imported) * 1000)
+        first_frame_ms.append(float(first_frame) * 1000)
+    import_ms.sort()
+    first_frame_ms.sort()
+    return {"startup": {
+        "import_ms": import_ms[len(import_ms) // 2],
+        "first_frame_ms": first_frame_ms[len(first_frame_ms) // 2],
+        "worst_first_frame_ms": first_frame_ms[-1],
+        "target_ms": target_ms
+    }}
+
+def bench_layouts(sizes, repeat):
+    # The swipe and hit-test inputs are seeded, so every run times the same work.
+    stub_typing_backends()
+    rng = random.Random(39)
+    results = {}
+    layouts = [make_keyboard(size) for size in sizes]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for keyboard_data in layouts:
+            size = len(keyboard_data["keys"])
+            app.selected_keyboard = keyboard_data
+            app.state = "keyboard"
+            app.selected_key = None
+
+            def draw_cold():
+                app.invalidate_keyboard_layer(keyboard_data)
+                app.draw_keyboard()
+            cold_ms = time_call(draw_cold, 3)
+            warm_ms = time_call(app.draw_keyboard, repeat)
+            app.selected_key = keyboard_data["keys"][size // 2]
+            pressed_ms = time_call(app.draw_keyboard, repeat)
+            app.selected_key = None
+
+            app.state = "configure"
+            app.current_keys = keyboard_data["keys"]
+            app.configuring_key = keyboard_data["keys"][0]
+            app.action_texts = dict(app.configuring_key["actions"])
+            configure_ms = time_call(app.draw_configure_screen, max(3, repeat // 10))
+            app.configuring_key = None
+
+            points = [(rng.uniform(0, app.LAYOUT_WIDTH), rng.uniform(0, app.LAYOUT_HEIGHT)) for _ in range(200)]
+            start = time.perf_counter()
+            for point in points:
+                app.find_key_at(keyboard_data["keys"], point)
+            hit_test_ms = (time.perf_counter() - start) / len(points) * 1000
+            hit_grid = app.build_hit_grid(keyboard_data["keys"])
+            start = time.perf_counter()
+            for point in points:
+                app.find_key_at(keyboard_data["keys"], point, hit_grid)
+            hit_test_indexed_ms = (time.perf_counter() - start) / len(points) * 1000
+
+            saved = json.dumps(app.keyboard_to_json(keyboard_data), indent=2)
+            save_ms = time_call(lambda: json.dumps(app.keyboard_to_json(keyboard_data), indent=2), 20)
+            load_ms = time_call(lambda: app.normalize_keyboard_layout(json.loads(saved)), 20)
+            results[f"layout_{size}"] = {
+                "draw_keyboard_cold_ms": cold_ms,
+                "draw_keyboard_ms": warm_ms,
+                "draw_keyboard_pressed_ms": pressed_ms,
+                "draw_configure_ms": configure_ms,
+                "hit_test_ms": hit_test_ms,
+                "hit_test_indexed_ms": hit_test_indexed_ms,
+                "json_save_ms": save_ms,
+                "json_load_ms": load_ms,
+                "json_kb": len(saved) / 1024
+            }
+
+        swipes = [((rng.uniform(0, 800), rng.uniform(0, 400)), (rng.uniform(0, 800), rng.uniform(0, 400))) for _ in range(1000)]
+        start = time.perf_counter()
+        for swipe_start, swipe_end in swipes:
+            app.get_swipe_direction(swipe_start, swipe_end)
+        swipe_ms = (time.perf_counter() - start) / len(swipes) * 1000
+
+        app.keyboards = layouts + [make_keyboard(10 + i % 90, f"list{i}") for i in range(200)]
+        app.state = "list"
+        app.scroll_offset = 0
+        list_cold_ms = time_call(app.draw_keyboard_list, 1)
+        deadline = time.perf_counter() + 30
+        while app.thumbnail_pending and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        list_ms = time_call(app.draw_keyboard_list, repeat)
+        app.scroll_offset = app.max_scroll // 2
+        list_scrolled_ms = time_call(app.draw_keyboard_list, repeat)
+        app.keyboards = []
+        app.state = "start"
+    results["swipe"] = {"get_swipe_direction_ms": swipe_ms}
+    results[f"keyboard_list_{len(layouts) + 200}"] = {"cold_ms": list_cold_ms, "warm_ms": list_ms, "scrolled_ms": list_scrolled_ms}
+    return results
+
+def bench_dispatch(taps, hold_ms):
+    # Taps and right-swipes are pushed through update_loop() with a real pause
+    # between touch-down and release, so press_ms includes the time the finger
+    # rests on the key, as it does for a user.
+    stub_typing_backends()
+    keyboard_data = make_keyboard(20, "dispatch")
+    for key in keyboard_data["keys"][::2]:
+        key["actions"] = {direction: "" for direction in app.DIRECTIONS}
+        key["actions"]["Tap"] = key["char"]
+    app.selected_keyboard = keyboard_data
+    app.state = "keyboard"
+    view = app.get_layout_view(app.screen.get_size())
+    results = {}
+    saved_mode = app.dispatch_mode
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.update_loop()
+        for mode in ["release", "press", "early"]:
+            app.dispatch_mode = mode
+            app.keystroke_traces.clear()
+            for i in range(taps):
+                key = keyboard_data["keys"][i % len(keyboard_data["keys"])]
+                pos = app.layout_to_screen_rect(key["x"], key["y"], key["width"], key["height"], view).center
+                end = pos if i % 2 == 0 else (pos[0] + 15, pos[1])
+                app.last_key_action_time = 0
+                pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=1))
+                app.update_loop()
+                time.sleep(hold_ms / 2000)
+                pygame.event.post(pygame.event.Event(pygame.MOUSEMOTION, pos=end, rel=(end[0] - pos[0], 0), buttons=(1, 0, 0)))
+                app.update_loop()
+                time.sleep(hold_ms / 2000)
+                pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=end, button=1))
+                app.update_loop()
+            taps_ms = sorted(trace["press_ms"] for trace in app.keystroke_traces if trace["direction"] == "Tap")
+            swipes_ms = sorted(trace["press_ms"] for trace in app.keystroke_traces if trace["direction"] != "Tap")
+            results[f"dispatch_{mode}"] = {
+                "tap_press_to_inject_ms": app.exact_percentile(taps_ms, 0.5),
+                "swipe_press_to_inject_ms": app.exact_percentile(swipes_ms, 0.5),
+                "keystrokes": len(app.keystroke_traces)
+            }
+    app.dispatch_mode = saved_mode
+    app.state = "start"
+    return results
+
+def bench_motion(rates, frames):
+    # A key is dragged on the configure screen with several motion reports per
+    # frame, as a high-rate digitizer delivers them; "events" is the profiler's
+    # event-handling stage of update_loop().
+    keyboard_data = make_keyboard(60, "motion")
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.state = "configure"
+        app.selected_keyboard = keyboard_data
+        app.current_keys = keyboard_data["keys"]
+        app.update_loop()
+        for rate in rates:
+            app.configuring_key = keyboard_data["keys"][0]
+            app.key_drag = app.begin_key_drag((100, 200))
+            app.reset_profile()
+            for frame in range(frames):
+                for i in range(rate):
+                    pos = (100 + (frame * rate + i) % 400, 200)
+                    pygame.event.post(pygame.event.Event(pygame.MOUSEMOTION, pos=pos, rel=(1, 0), buttons=(1, 0, 0)))
+                app.update_loop()
+            events = app.profile_histograms["events"]
+            results[f"motion_{rate}_per_frame"] = {"events_ms": events["total_ms"] / events["count"]}
+        app.key_drag = None
+        app.configuring_key = None
+        app.state = "start"
+    return results
+
+def bench_select(sizes, frames):
+    # Half of each layout is box-selected and dragged on the configure screen;
+    # a frame is one update_loop() with a motion event, event handling and
+    # drawing included. relayout_frame_ms is the same frame with labels placed
+    # from scratch, as every frame of a drag used to be.
+    rng = random.Random(47)
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for size in sizes:
+            keyboard_data = make_keyboard(size, "select")
+            keys = keyboard_data["keys"]
+            app.state = "configure"
+            app.selected_keyboard = keyboard_data
+            app.current_keys = keys
+            rects = [(rng.uniform(0, 700), rng.uniform(0, 300), rng.uniform(20, 300), rng.uniform(20, 200)) for _ in range(200)]
+            start = time.perf_counter()
+            for rect in rects:
+                app.find_keys_in_rect(keys, rect)
+            box_query_ms = (time.perf_counter() - start) / len(rects) * 1000
+            hit_grid = app.build_hit_grid(keys)
+            start = time.perf_counter()
+            for rect in rects:
+                app.find_keys_in_rect(keys, rect, hit_grid)
+            box_query_indexed_ms = (time.perf_counter() - start) / len(rects) * 1000
+
+            selection = app.find_keys_in_rect(keys, (0, 0, app.LAYOUT_WIDTH / 2, app.LAYOUT_HEIGHT), hit_grid)
+            app.configuring_key = selection[0]
+            app.key_selection = {id(key): key for key in selection}
+            app.update_loop()
+            relayout_frame_ms = time_call(lambda: (app.configure_label_cache.clear(), app.draw_configure_screen()), 5)
+            origin = (selection[0]["x"] + 2, selection[0]["y"] + app.CONFIGURE_AREA_TOP + 2)
+            pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=origin, button=1))
+            app.update_loop()
+            frame_ms = []
+            for frame in range(frames):
+                pos = (origin[0] + frame % 40, origin[1] + frame % 20)
+                pygame.event.post(pygame.event.Event(pygame.MOUSEMOTION, pos=pos, rel=(1, 1), buttons=(1, 0, 0)))
+                start = time.perf_counter()
+                app.update_loop()
+                frame_ms.append((time.perf_counter() - start) * 1000)
+            pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=origin, button=1))
+            app.update_loop()
+            frame_ms.sort()
+            results[f"select_{size}"] = {
+                "selected": len(selection),
+                "box_query_ms": box_query_ms,
+                "box_query_indexed_ms": box_query_indexed_ms,
+                "drag_frame_ms": app.exact_percentile(frame_ms, 0.5),
+                "drag_frame_p95_ms": app.exact_percentile(frame_ms, 0.95),
+                "relayout_frame_ms": relayout_frame_ms
+            }
+        app.configuring_key = None
+        app.key_selection = {}
+        app.current_keys = []
+        app.selected_keyboard = None
+        app.state = "start"
+    return results
+
+def bench_snap(sizes, moves):
+    # One key is dragged across each layout with snapping on. The edge index is
+    # built once for a layout, and after that only the keys that moved are
+    # reindexed.
+    rng = random.Random(48)
+    results = {}
+    for size in sizes:
+        keyboard_data = make_keyboard(size, "snap")
+        keys = keyboard_data["keys"]
+        app.current_keys = keys
+        app.configuring_key = keys[size // 2]
+        app.key_selection = {}
+
+        def build():
+            app.snap_index.clear()
+            app.get_snap_index()
+        index_build_ms = time_call(build, 5)
+        start = time.perf_counter()
+        for _ in range(20):
+            key = rng.choice(keys)
+            key["x"] += rng.choice([-1, 1])
+            app.get_snap_index()
+        index_update_ms = (time.perf_counter() - start) / 20 * 1000
+        drag = app.begin_key_drag((0, 0))
+        points = [(rng.uniform(-400, 400), rng.uniform(-200, 200)) for _ in range(moves)]
+        start = time.perf_counter()
+        for point in points:
+            app.move_key_drag(drag, point)
+        snap_ms = (time.perf_counter() - start) / moves * 1000
+        start = time.perf_counter()
+        for point in points:
+            app.move_key_drag(drag, point, snap=False)
+        unsnapped_ms = (time.perf_counter() - start) / moves * 1000
+        results[f"snap_{size}"] = {"index_build_ms": index_build_ms, "index_update_ms": index_update_ms,
+                                   "snap_move_ms": snap_ms, "free_move_ms": unsnapped_ms}
+    app.current_keys = []
+    app.configuring_key = None
+    return results
+
+def make_layout_spec(key_count):
+    # A QWERTY block with shifted and numeric swipes, repeated down the layout,
+    # then a macro grid written with ranges for the rest of the keys.
+    columns = 100
+    lines = ["name Spec {}".format(key_count), "unit 6", "gap 2",
+             "template letters = q/^/d=1 w/^/d=2 e/^/d=3 r/^/d=4 t/^/d=5 y/^/d=6 u/^/d=7 i/^/d=8 o/^/d=9 p/^/d=0"]
+    qwerty_rows = min(key_count // 4 // columns, 10)
+    if qwerty_rows:
+        lines.append(f"row*{qwerty_rows} " + " ".join(["@letters"] * (columns // 10)))
+    remaining = key_count - qwerty_rows * columns
+    full_rows, last_row = divmod(remaining, columns)
+    if full_rows:
+        lines.append(f"row*{full_rows} M{{1..{columns}}}/Macro{{1..{columns}}}/l=Ctrl/r=Alt")
+    if last_row:
+        lines.append(f"row M{{1..{last_row}}}/Macro{{1..{last_row}}}/l=Ctrl/r=Alt")
+    return "\n".join(lines)
+
+def bench_spec(sizes, repeat):
+    # Loading is what the Load button does with pasted text: parse, validate and
+    # fit to the layout space. The same layout saved as JSON is loaded for scale.
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for size in sizes:
+            spec = make_layout_spec(size)
+            compiled = app.compile_layout_spec(spec)
+            saved = json.dumps(compiled, indent=2)
+
+            def load(text):
+                keyboard_data = app.parse_keyboard_text(text)
+                app.validate_keyboard_json(keyboard_data)
+                return app.normalize_keyboard_layout(keyboard_data)
+            results[f"spec_{size}"] = {
+                "keys": len(compiled["keys"]),
+                "compile_ms": time_call(lambda: app.compile_layout_spec(spec), repeat),
+                "load_ms": time_call(lambda: load(spec), repeat),
+                "json_load_ms": time_call(lambda: load(saved), repeat),
+                "spec_kb": len(spec) / 1024,
+                "json_kb": len(saved) / 1024
+            }
+    return results
+
+def bench_lint(sizes, repeat):
+    # The synthetic layouts are a clean grid except for a stack of duplicates,
+    # so the sweep sees realistic neighbours and still has overlaps to report.
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for size in sizes:
+            keyboard_data = make_keyboard(size)
+            keyboard_data["keys"].extend(copy.deepcopy(keyboard_data["keys"][:max(1, size // 100)]))
+            rects = [(key["x"], key["y"], key["width"], key["height"]) for key in keyboard_data["keys"]]
+            # A full-height key beside a full-height column of keys keeps every
+            # rect active at once, the worst case for the sweep.
+            column = [(0, 0, 20, app.LAYOUT_HEIGHT)] + [(10, i * app.LAYOUT_HEIGHT / size, 20, app.LAYOUT_HEIGHT / size) for i in range(size)]
+            issues = app.lint_keyboard_layout(keyboard_data)
+            results[f"lint_{size}"] = {
+                "issues": len(issues),
+                "sweep_ms": time_call(lambda: app.find_rect_overlaps(rects), repeat),
+                "column_sweep_ms": time_call(lambda: app.find_rect_overlaps(column), repeat),
+                "lint_ms": time_call(lambda: app.lint_keyboard_layout(keyboard_data), max(1, repeat // 10))
+            }
+    return results
+
+def get_control_address():
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(tempfile.mkdtemp(), "control.sock")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{probe.getsockname()[1]}"
+
+def bench_control(commands):
+    # The client runs on its own thread while this one keeps calling
+    # update_loop(), as the app's main loop would, so every command pays the
+    # real hand-off to the render loop and back.
+    stub_typing_backends()
+    address = get_control_address()
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not app.start_control_server(address):
+            return results
+        connection = control.connect(address)
+        batch_size = 50
+        runs = [
+            ("load", 1, lambda count: control.send_command(connection, {"cmd": "load", "keyboard": make_keyboard(60, "control"), "select": True})),
+            ("roundtrip", commands // 10, lambda count: [control.send_command(connection, {"cmd": "ping"}) for _ in range(count)]),
+            ("pipelined", commands, lambda count: control.send_commands(connection, [{"cmd": "state"}] * count)),
+            ("batched", commands, lambda count: control.send_commands(connection, [[{"cmd": "key", "action": "a"}] * batch_size] * (count // batch_size)))
+        ]
+        for name, count, run_client in runs:
+            finished = threading.Event()
+
+            def client():
+                try:
+                    run_client(count)
+                finally:
+                    finished.set()
+            start = time.perf_counter()
+            threading.Thread(target=client, daemon=True).start()
+            while not finished.is_set():
+                app.update_loop()
+            elapsed = time.perf_counter() - start
+            if name != "load":
+                results[f"control_{name}"] = {"commands_per_s": count / elapsed, "command_ms": elapsed / count * 1000}
+        connection[0].close()
+        app.stop_control_server()
+        app.keyboards = []
+        app.selected_keyboard = None
+        app.state = "start"
+    return results
+
+def bench_remote(keystrokes):
+    # A host agent runs in this process on loopback with a no-op injector, so
+    # the numbers cover framing, the link thread, TCP and acknowledgements.
+    typed = []
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent = host_agent.start_agent("127.0.0.1:0", lambda text, shift, ctrl: typed.append(text))
+        app.start_remote_link(f"127.0.0.1:{agent['port']}")
+        link = app.remote_link
+        deadline = time.perf_counter() + 10
+        while not link["connected"] and time.perf_counter() < deadline:
+            time.sleep(0.001)
+
+        def wait_for_acks():
+            deadline = time.perf_counter() + 60
+            while link["unacked"] and time.perf_counter() < deadline:
+                time.sleep(0.0001)
+
+        for _ in range(keystrokes // 20):
+            app.send_remote_key("a")
+            wait_for_acks()
+        round_trips = sorted(link["ack_ms"])
+        start = time.perf_counter()
+        for _ in range(keystrokes):
+            app.send_remote_key("b")
+        wait_for_acks()
+        elapsed = time.perf_counter() - start
+        results["remote_loopback"] = {
+            "round_trip_p50_ms": app.exact_percentile(round_trips, 0.5),
+            "round_trip_p95_ms": app.exact_percentile(round_trips, 0.95),
+            "keys_per_s": keystrokes / elapsed,
+            "streamed_key_ms": elapsed / keystrokes * 1000,
+            "delivered": len(typed)
+        }
+        app.stop_remote_link()
+        host_agent.stop_agent(agent)
+    return results
+
+def bench_reload(sizes, repeat):
+    # One key is nudged back and forth, as when a designer tweaks a layout file;
+    # the incremental apply is compared with throwing the baked layer away.
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for size in sizes:
+            keyboard_data = make_keyboard(size, "reload")
+            app.keyboards = [keyboard_data]
+            app.selected_keyboard = keyboard_data
+            app.state = "keyboard"
+            app.draw_keyboard()
+            variants = []
+            for offset in [7, 0]:
+                variant = {"name": keyboard_data["name"], "keys": copy.deepcopy(keyboard_data["keys"])}
+                variant["keys"][size // 2]["x"] += offset
+                variants.append(variant)
+            updates = [copy.deepcopy(variants[i % 2]) for i in range(repeat)]
+            start = time.perf_counter()
+            for update in updates:
+                app.apply_layout_update(keyboard_data, update)
+                app.draw_keyboard()
+            incremental_ms = (time.perf_counter() - start) / repeat * 1000
+
+            def full_reload():
+                app.invalidate_keyboard_layer(keyboard_data)
+                app.draw_keyboard()
+            results[f"reload_{size}"] = {"incremental_ms": incremental_ms, "full_rebake_ms": time_call(full_reload, repeat)}
+        app.keyboards = []
+        app.selected_keyboard = None
+        app.state = "start"
+    return results
+
+# Timings kept for comparison only: the legacy truncation, the full rebake that
+# incremental reloads replace, and the startup target are not code paths to gate.
+REFERENCE_LABELS = {"legacy_ms", "full_rebake_ms", "target_ms"}
+
+def compare_to_baseline(results, baseline, tolerance, min_delta_ms):
+    regressions = []
+    for name, timings in results.items():
+        for label, value in timings.items():
+            if not label.endswith("_ms") or label in REFERENCE_LABELS:
+                continue
+            old = baseline.get(name, {}).get(label)
+            if old is None:
+                continue
+            if value > old * (1 + tolerance) and value - old > min_delta_ms:
+                regressions.append(f"{name}.{label}: {old:.3f} -> {value:.3f} ms (+{(value / old - 1) * 100 if old else float('inf'):.0f}%)")
+    return regressions
+
+def run(args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.setup()
+    results = {}
+    groups = set(args.only.split(","))
+    if "startup" in groups:
+        results.update(bench_startup(args.startup_runs))
+    if "clipboard" in groups:
+        results.update(bench_clipboard(args.clipboard_calls))
+    if "layouts" in groups:
+        results.update(bench_layouts([int(size) for size in args.layout_sizes.split(",")], args.draw_repeat))
+    if "truncate" in groups:
+        results.update(bench_truncate(args.text_size, args.repeat))
+    if "dispatch" in groups:
+        results.update(bench_dispatch(args.dispatch_taps, args.dispatch_hold_ms))
+    if "motion" in groups:
+        results.update(bench_motion([int(rate) for rate in args.motion_rates.split(",")], 200))
+    if "select" in groups:
+        results.update(bench_select([int(size) for size in args.select_sizes.split(",")], 120))
+    if "snap" in groups:
+        results.update(bench_snap([int(size) for size in args.layout_sizes.split(",")], 2000))
+    if "spec" in groups:
+        results.update(bench_spec([int(size) for size in args.spec_sizes.split(",")], 10))
+    if "lint" in groups:
+        results.update(bench_lint([int(size) for size in args.layout_sizes.split(",")], 20))
+    if "control" in groups:
+        results.update(bench_control(args.control_commands))
+    if "remote" in groups:
+        results.update(bench_remote(args.remote_keys))
+    if "reload" in groups:
+        results.update(bench_reload([int(size) for size in args.layout_sizes.split(",")][:3], 20))
+    if "soak" in groups:
+        results.update(bench_typing_soak(args.soak_keystrokes, 20))
+    pygame.quit()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmarks for the virtual keyboard")
+    parser.add_argument("--only", default="startup,clipboard,layouts,truncate,dispatch,motion,select,snap,spec,lint,control,remote,reload,soak", help="Comma-separated benchmark groups to run")
+    parser.add_argument("--layout-sizes", default="10,100,1000,5000", help="Key counts for the synthetic layouts")
+    parser.add_argument("--draw-repeat", type=int, default=50, help="Iterations per warm draw measurement")
+    parser.add_argument("--text-size", type=int, default=100_000, help="Characters in the truncation benchmark string")
+    parser.add_argument("--repeat", type=int, default=1000, help="Iterations for warm (cached) measurements")
+    parser.add_argument("--soak-keystrokes", type=int, default=172_800, help="Synthetic keystrokes in the typing soak (24h at 2/s)")
+    parser.add_argument("--dispatch-taps", type=int, default=40, help="Taps and swipes per mode in the dispatch benchmark")
+    parser.add_argument("--dispatch-hold-ms", type=float, default=60, help="Time each finger rests on a key in the dispatch benchmark")
+    parser.add_argument("--motion-rates", default="1,4,16,64", help="Motion events per frame in the motion benchmark")
+    parser.add_argument("--select-sizes", default="100,300,1000", help="Key counts for the configure screen selection benchmark")
+    parser.add_argument("--spec-sizes", default="100,1000,10000", help="Key counts for the layout spec compiler benchmark")
+    parser.add_argument("--control-commands", type=int, default=5000, help="Commands per mode in the control server benchmark")
+    parser.add_argument("--remote-keys", type=int, default=20000, help="Keystrokes streamed in the remote mode benchmark")
+    parser.add_argument("--clipboard-calls", type=int, default=50, help="Calls per clipboard provider and operation")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Fresh interpreter launches in the startup benchmark")
+    parser.add_argument("--json", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Fail if any *_ms result regressed against this JSON results file")
+    parser.add_argument("--save-baseline", help="Write results to this file for later --baseline runs")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown over the baseline, as a fraction")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05, help="Ignore slowdowns smaller than this many ms")
+    args = parser.parse_args()
+    results = run(args)
+    for name, timings in results.items():
+        print(name + ": " + ", ".join(f"{label}={value:.3f}" for label, value in timings.items()))
+    report = {
+        "meta": {"python": platform.python_version(), "pygame": pygame.version.ver, "platform": platform.platform(), "time": time.time()},
+        "results": results
+    }
+    for path in [args.json, args.save_baseline]:
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+DEFAULT_CONTROL_ADDRESS = os.environ.get("VK_CONTROL", "127.0.0.1:8765" if os.name == "nt" else "/tmp/virtual-keyboard.sock")
+
+def connect(address=DEFAULT_CONTROL_ADDRESS, timeout=10):
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        sock = socket.create_connection((host or "127.0.0.1", int(port)), timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    return sock, sock.makefile("rb")
+
+def send_commands(connection, commands):
+    # Every command is written before any response is read, so the server can
+    # work through them back to back; responses arrive in the same order.
+    sock, responses = connection
+    sock.sendall(b"".join((json.dumps(command) + "\n").encode("utf-8") for command in commands))
+    results = []
+    for _ in commands:
+        line = responses.readline()
+        if not line:
+            raise ConnectionError("Control server closed the connection")
+        results.append(json.loads(line))
+    return results
+
+def send_command(connection, command):
+    return send_commands(connection, [command])[0]
+
+def read_layout_file(path):
+    # Layout specs are sent as text and compiled by the app.
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".kbd"):
+            return {"spec": f.read()}
+        return {"keyboard": json.load(f)}
+
+def build_command(args):
+    if args.command == "load":
+        return {"cmd": "load", **read_layout_file(args.file), "select": args.select}
+    if args.command == "replace":
+        return {"cmd": "replace", "keyboard_id": args.keyboard_id, **read_layout_file(args.file)}
+    if args.command == "select":
+        return {"cmd": "select", "name": args.name}
+    if args.command == "key":
+        return [{"cmd": "key", "action": action} for action in args.actions]
+    if args.command == "tap":
+        return {"cmd": "tap", "char": args.char, "direction": args.direction}
+    return {"cmd": args.command}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send commands to a virtual keyboard started with --control")
+    parser.add_argument("--control", default=DEFAULT_CONTROL_ADDRESS, help="Unix socket path or HOST:PORT of the control server")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in ["ping", "state", "list", "metrics"]:
+        commands.add_parser(name)
+    load = commands.add_parser("load", help="Add a keyboard from a saved JSON file or a .kbd layout spec")
+    load.add_argument("file")
+    load.add_argument("--select", action="store_true", help="Open the keyboard once it is loaded")
+    replace = commands.add_parser("replace", help="Replace a keyboard's layout, keeping its id")
+    replace.add_argument("keyboard_id")
+    replace.add_argument("file")
+    select = commands.add_parser("select", help="Open a keyboard by name")
+    select.add_argument("name")
+    key = commands.add_parser("key", help="Send key actions as if their keys were pressed")
+    key.add_argument("actions", nargs="+")
+    tap = commands.add_parser("tap", help="Fire a key of the open keyboard by its label")
+    tap.add_argument("char")
+    tap.add_argument("--direction", default="Tap")
+    commands.add_parser("batch", help="Pipeline one JSON command per line from stdin")
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        requests = []
+        for number, line in enumerate(sys.stdin, 1):
+            if line.strip():
+                try:
+                    requests.append(json.loads(line))
+                except ValueError as e:
+                    parser.error(f"stdin line {number}: {e}")
+    else:
+        requests = [build_command(args)]
+    connection = connect(args.control)
+    try:
+        responses = send_commands(connection, requests)
+    finally:
+        connection[0].close()
+    failed = False
+    for response in responses:
+        print(json.dumps(response, indent=None if args.command in ["batch", "key"] else 2))
+        failed = failed or any(not item.get("ok") for item in (response if isinstance(response, list) else [response]))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import concurrent.futures
+import hmac
+import importlib.util
+import os
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+
+# The app is keyboard.py, the same name as the "keyboard" typing package it
+# uses as a backend, so it is loaded under another name to leave that one free.
+app_spec = importlib.util.spec_from_file_location("vk_app", os.path.join(os.path.dirname(os.path.abspath(__file__)), "keyboard.py"))
+app = importlib.util.module_from_spec(app_spec)
+sys.modules["vk_app"] = app
+app_spec.loader.exec_module(app)
+
+# Keyboard sessions remembered for skipping resent keys, least recently used
+# first; a keyboard gets a new session id every time it starts.
+SESSION_LIMIT = 256
+
+def type_key(text, shift, ctrl):
+    try:
+        if not app.inject_key(text, shift, ctrl):
+            print(f"No typing method available, dropped '{text}'")
+    except Exception as e:
+        print(f"Key send error: {e}\n{traceback.format_exc()}")
+
+async def handle_ui(reader, writer, agent):
+    peer = writer.get_extra_info("peername")
+    try:
+        kind, flags, seq, length = app.REMOTE_HEADER.unpack(await reader.readexactly(app.REMOTE_HEADER.size))
+        payload = await reader.readexactly(length)
+        if kind != app.REMOTE_HELLO or not hmac.compare_digest(payload[16:], agent["token"]):
+            print(f"Rejected connection from {peer}: bad hello or token")
+            return
+        session = payload[:16]
+        sessions = agent["sessions"]
+        sessions.setdefault(session, 0)
+        sessions.move_to_end(session)
+        while len(sessions) > SESSION_LIMIT:
+            sessions.popitem(last=False)
+        agent["writers"].add(writer)
+        print(f"Keyboard connected from {peer}")
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, flags, seq, length = app.REMOTE_HEADER.unpack(await reader.readexactly(app.REMOTE_HEADER.size))
+            payload = await reader.readexactly(length)
+            if kind != app.REMOTE_KEY:
+                continue
+            # Keys resent after a reconnect are acknowledged again but typed once.
+            # The key is claimed before it is typed, because the old connection
+            # can still be typing it when the resent copy arrives.
+            if seq > sessions.get(session, 0):
+                sessions[session] = seq
+                sessions.move_to_end(session)
+                await loop.run_in_executor(agent["injector"], agent["inject"], payload.decode("utf-8"),
+                                           bool(flags & app.REMOTE_SHIFT), bool(flags & app.REMOTE_CTRL))
+            writer.write(app.pack_remote_frame(app.REMOTE_ACK, seq))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        print(f"Keyboard disconnected: {peer}")
+    finally:
+        agent["writers"].discard(writer)
+        writer.close()
+
+def start_agent(address, inject=type_key, token=""):
+    # Runs the agent's event loop on a background thread; keys are injected
+    # one at a time on a single worker so they are typed in order.
+    host, port = app.parse_remote_address(address)
+    # Without a token any HELLO is accepted, so only this machine may connect.
+    if host not in app.LOOPBACK_HOSTS and not token:
+        print(f"Host agent refused: {host} is not a loopback address, so a --token is required")
+        return None
+    agent = {
+        "token": token.encode("utf-8"),
+        "inject": inject,
+        "injector": concurrent.futures.ThreadPoolExecutor(max_workers=1),
+        "sessions": OrderedDict(),
+        "writers": set(),
+        "loop": asyncio.new_event_loop()
+    }
+    started = threading.Event()
+
+    def run():
+        loop = agent["loop"]
+        asyncio.set_event_loop(loop)
+        try:
+            agent["server"] = loop.run_until_complete(asyncio.start_server(lambda r, w: handle_ui(r, w, agent), host, port))
+            agent["port"] = agent["server"].sockets[0].getsockname()[1]
+        except Exception as e:
+            print(f"Host agent failed to start: {e}\n{traceback.format_exc()}")
+            started.set()
+            return
+        started.set()
+        loop.run_forever()
+        agent["server"].close()
+        # stop_agent() closed every connection, so the handlers are finishing.
+        tasks = asyncio.all_tasks(loop)
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+        loop.close()
+
+    agent["thread"] = threading.Thread(target=run, daemon=True)
+    agent["thread"].start()
+    started.wait(5)
+    if "port" not in agent:
+        return None
+    print(f"Host agent listening on {host}:{agent['port']}")
+    return agent
+
+def stop_agent(agent):
+    def close():
+        for writer in list(agent["writers"]):
+            writer.close()
+        agent["loop"].stop()
+    agent["loop"].call_soon_threadsafe(close)
+    agent["thread"].join(2)
+    agent["injector"].shutdown()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Type keystrokes sent by a virtual keyboard started with --remote")
+    parser.add_argument("--listen", default=f"127.0.0.1:{app.REMOTE_DEFAULT_PORT}",
+                        help="HOST:PORT to accept keyboards on; use the LAN address, with --token, to accept a tablet")
+    parser.add_argument("--token", default=os.environ.get("VK_REMOTE_TOKEN", ""), help="Shared token keyboards must send; required unless --listen is a loopback address")
+    parser.add_argument("--dry-run", action="store_true", help="Print received keys instead of typing them")
+    args = parser.parse_args(argv)
+    if args.dry_run:
+        inject = lambda text, shift, ctrl: print(f"Key: {text!r} shift={shift} ctrl={ctrl}")
+    else:
+        app.ensure_backends()
+        if app.pyautogui is None and app.keyboard is None:
+            print("Host agent: neither pyautogui nor keyboard could be loaded, so keys can't be typed; install one or use --dry-run")
+            return 1
+        inject = type_key
+    agent = start_agent(args.listen, inject, args.token)
+    if agent is None:
+        return 1
+    try:
+        agent["thread"].join()
+    except KeyboardInterrupt:
+        stop_agent(agent)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,4 +1,7 @@
+import argparse
 import asyncio
+import os
+import sys
 import platform
 import math
 import uuid
@@ -6,35 +9,99 @@ import copy
 import time
 import traceback
 import json
+import threading
+import queue
+import socket
+import struct
+import bisect
+import heapq
+import re
+import functools
+import gzip
+import hashlib
+import importlib.machinery
+import importlib.util
+import stat
+from collections import OrderedDict, deque
 import pygame
 
-try:
-    import pyperclip
-except ImportError:
-    print("Warning: pyperclip not installed. Clipboard functionality may be limited.")
-    pyperclip = None
-
-try:
-    import pyautogui
-    pyautogui.FAILSAFE = False
-    pyautogui.PAUSE = 0.05
-except ImportError:
-    print("Warning: pyautogui not installed. Typing may be limited.")
-    pyautogui = None
-
-try:
-    import keyboard
-except ImportError:
-    print("Warning: keyboard not installed. Falling back to pyautogui.")
-    keyboard = None
+# Typing and clipboard backends are imported on a background thread once the
+# first frame is up; pyautogui alone pulls in PIL and its screenshot helpers.
+pyperclip = None
+pyautogui = None
+keyboard = None
+backends_ready = threading.Event()
+backend_loader = None
+font_path_index = {}
+font_path_index_loaded = False
 
 js = None
 
-def setup():
-    global screen, font, small_font, tiny_font, state, keyboards, selected_key, swipe_start, swipe_direction, selected_keyboard, current_keys, dragged_key, configuring_key, label_text, text_active, active_input, action_texts, scroll_offset, max_scroll, dragged_scroll, keyboard_name_text, last_typed_text, SPECIAL_KEYS, last_arrow_click, input_buffer, show_keyboard, scroll_start_y, load_code_text, active_modifiers, caps_lock_active, feedback_message, feedback_timer, last_key_action_time
+def import_keyboard_backend():
+    # This app is itself keyboard.py and its folder comes first on sys.path,
+    # so a plain "import keyboard" finds the app again. The package is looked
+    # up on the rest of the path and loaded under its own name, which its
+    # relative imports need. When that name already belongs to the app, as
+    # it does under benchmarks.py, the backend is left out.
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    search_path = [entry for entry in sys.path if os.path.abspath(entry or os.curdir) != app_dir]
+    spec = importlib.machinery.PathFinder.find_spec("keyboard", search_path)
+    if spec is None:
+        raise ImportError("no keyboard package outside the app folder")
+    loaded = sys.modules.get("keyboard")
+    if loaded is not None:
+        if getattr(loaded, "__file__", None) == spec.origin:
+            return loaded
+        raise ImportError("the name 'keyboard' is taken by this app's keyboard.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["keyboard"] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules["keyboard"]
+        raise
+    return module
+
+def load_backends():
+    global pyperclip, pyautogui, keyboard
+    try:
+        try:
+            import pyperclip as pyperclip_module
+            pyperclip = pyperclip_module
+        except Exception:
+            print("Warning: pyperclip not installed. Clipboard functionality may be limited.")
+
+        try:
+            import pyautogui as pyautogui_module
+            pyautogui_module.FAILSAFE = False
+            pyautogui_module.PAUSE = 0.05
+            pyautogui = pyautogui_module
+        except Exception:
+            print("Warning: pyautogui not installed. Typing may be limited.")
+
+        try:
+            keyboard = import_keyboard_backend()
+        except Exception as e:
+            print(f"Warning: keyboard backend unavailable ({e}). Falling back to pyautogui.")
+    finally:
+        backends_ready.set()
+
+def start_backend_loader():
+    global backend_loader
+    if backend_loader is None:
+        backend_loader = threading.Thread(target=load_backends, daemon=True)
+        backend_loader.start()
+
+def ensure_backends():
+    if not backends_ready.is_set():
+        start_backend_loader()
+        backends_ready.wait()
+
+def setup(renderer="software"):
+    global renderer_backend, gpu_window, gpu_renderer, gpu_fullscreen, frame_texture, texture_cache, text_surface_cache, glyph_width_cache, truncate_cache, layout_view_cache, font_cache, thumbnail_cache, thumbnail_pending, thumbnail_queue, thumbnail_lock, thumbnail_thread, help_surface_cache, last_frame_time, scroll_velocity, scroll_remainder, last_scroll_sample, pending_resize, last_resize_time, screen, font, small_font, tiny_font, state, keyboards, selected_key, swipe_start, swipe_direction, selected_keyboard, current_keys, key_drag, key_selection, box_select, key_mods, configure_label_cache, configure_text_cache, snap_index, configuring_key, label_buffer, text_active, active_input, action_texts, scroll_offset, max_scroll, dragged_scroll, keyboard_name_text, last_typed_text, SPECIAL_KEYS, last_arrow_click, input_buffer, input_history_version, input_tail_cache, typed_digest, typed_count, show_keyboard, scroll_start_y, load_code_buffer, active_modifiers, caps_lock_active, feedback_message, feedback_timer, last_key_action_time, key_press_time, key_dispatched, keyboard_layer_cache, latched_layer, oneshot_layer, editing_layers, editing_layer
     pygame.display.init()
     pygame.font.init()
-    pygame.event.set_allowed([pygame.QUIT, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEMOTION, pygame.KEYDOWN, pygame.VIDEORESIZE])
+    pygame.event.set_allowed([pygame.QUIT, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEMOTION, pygame.KEYDOWN, pygame.KEYUP, pygame.VIDEORESIZE, pygame.WINDOWSIZECHANGED, pygame.CLIPBOARDUPDATE])
     
     info = pygame.display.Info()
     screen_width = info.current_w
@@ -42,12 +109,43 @@ def setup():
     window_width = int(screen_width * 0.9)
     window_height = int(screen_height * 0.9)
     
-    screen = pygame.display.set_mode((window_width, window_height), pygame.RESIZABLE)
-    pygame.display.set_caption("Virtual Touchscreen Keyboard")
+    renderer_backend = "software"
+    gpu_window = None
+    gpu_renderer = None
+    gpu_fullscreen = False
+    frame_texture = None
+    texture_cache = {}
+    text_surface_cache = {}
+    glyph_width_cache = {}
+    truncate_cache = {}
+    layout_view_cache = {}
+    font_cache = {}
+    thumbnail_cache = OrderedDict()
+    thumbnail_pending = {}
+    thumbnail_queue = queue.Queue()
+    thumbnail_lock = threading.Lock()
+    thumbnail_thread = None
+    help_surface_cache = None
+    last_frame_time = time.perf_counter()
+    scroll_velocity = 0
+    scroll_remainder = 0
+    last_scroll_sample = 0
+    pending_resize = None
+    last_resize_time = 0
+    if renderer == "gpu":
+        try:
+            init_gpu_renderer((window_width, window_height))
+        except Exception as e:
+            print(f"GPU renderer unavailable, falling back to software: {e}\n{traceback.format_exc()}")
+    if renderer_backend == "software":
+        screen = pygame.display.set_mode((window_width, window_height), pygame.RESIZABLE)
+        pygame.display.set_caption("Virtual Touchscreen Keyboard")
+    print(f"Using {renderer_backend} renderer")
+    init_clipboard()
     
-    font = pygame.font.SysFont("arial", 14)
-    small_font = pygame.font.SysFont("arial", 10)
-    tiny_font = pygame.font.SysFont("arial", 8)
+    font = get_font(14)
+    small_font = get_font(10)
+    tiny_font = get_font(8)
     
     state = "start"
     keyboards = []
@@ -56,9 +154,15 @@ def setup():
     swipe_direction = None
     selected_keyboard = None
     current_keys = []
-    dragged_key = None
+    key_drag = None
+    key_selection = {}
+    box_select = None
+    key_mods = 0
+    configure_label_cache = {}
+    configure_text_cache = {}
+    snap_index = {}
     configuring_key = None
-    label_text = ""
+    label_buffer = TextBuffer()
     text_active = False
     active_input = None
     action_texts = {}
@@ -67,22 +171,568 @@ def setup():
     dragged_scroll = False
     keyboard_name_text = ""
     last_typed_text = ""
-    input_buffer = ""
+    input_buffer = deque(maxlen=INPUT_HISTORY_LIMIT)
+    input_history_version = 0
+    input_tail_cache = None
+    typed_digest = hashlib.sha256()
+    typed_count = 0
     show_keyboard = False
     scroll_start_y = 0
-    load_code_text = ""
+    load_code_buffer = TextBuffer()
     active_modifiers = {"Shift": False, "Ctrl": False, "Alt": False, "Tab": False, "Windows": False}
     caps_lock_active = False
     feedback_message = ""
     feedback_timer = 0
     last_key_action_time = 0
+    key_press_time = 0
+    key_dispatched = False
     SPECIAL_KEYS = [
         "", "Shift", "Ctrl", "Alt", "Tab", "Enter", "Backspace", "Space",
-        "Esc", "Delete", "CapsLock", "Windows", "Up", "Down", "Left", "Right"
+        "Esc", "Delete", "CapsLock", "Windows", "Up", "Down", "Left", "Right",
+        "Layer:base", "Layer:shift", "Layer:symbol", "Layer:fn", "Once:shift", "Once:symbol", "Once:fn"
     ]
     last_arrow_click = 0
+    keyboard_layer_cache = {}
+    latched_layer = "base"
+    oneshot_layer = None
+    editing_layers = None
+    editing_layer = "base"
 
 DIRECTIONS = ["Tap", "Up", "Down", "Left", "Right", "Up-Left", "Up-Right", "Down-Left", "Down-Right"]
+MODIFIER_KEYS = ["Shift", "Ctrl", "Alt", "Tab", "Windows", "CapsLock"]
+# Key geometry lives in this logical space and is scaled uniformly to the window.
+LAYOUT_WIDTH = 800
+LAYOUT_HEIGHT = 400
+FONT_FAMILY = "arial"
+FONT_CACHE_VERSION = 1
+RESIZE_SETTLE_DELAY = 0.15
+LIST_ITEM_HEIGHT = 60
+LIST_VIEWPORT_TOP = 40
+LIST_VIEWPORT_BOTTOM = 280
+THUMBNAIL_SIZE = (80, 40)
+LABEL_GRID_CELL = 64
+HIT_GRID_CELL = 40
+SWIPE_THRESHOLD = 10
+# Degrees a motion must clear the nearest octant edge by before --dispatch early
+# commits to its direction.
+SWIPE_COMMIT_MARGIN = 12
+LAYER_NAMES = ["base", "shift", "symbol", "fn"]
+FIELD_VIEWPORT_CHARS = 512
+INPUT_HISTORY_LIMIT = 4096
+INPUT_TAIL_CHARS = 256
+SCROLL_FRICTION = 4.0
+THUMBNAIL_CACHE_LIMIT = 512
+CONFIGURE_AREA_TOP = 50
+CONFIGURE_TEXT_CACHE_LIMIT = 4096
+ARRANGE_BUTTONS = [
+    ("align_left", "Align L"),
+    ("align_top", "Align T"),
+    ("distribute_x", "Space H"),
+    ("distribute_y", "Space V")
+]
+# Layout pixels within which a dragged selection snaps to another key's edge or center.
+SNAP_DISTANCE = 6
+NUDGE_KEYS = {pygame.K_LEFT: (-1, 0), pygame.K_RIGHT: (1, 0), pygame.K_UP: (0, -1), pygame.K_DOWN: (0, 1)}
+LIST_ROW_BUTTONS = [
+    ("select", 40, 160),
+    ("edit", 210, 60),
+    ("delete", 280, 80),
+    ("duplicate", 370, 80),
+    ("select", 460, THUMBNAIL_SIZE[0])
+]
+ACTION_LABEL_ANCHORS = {
+    "Up": ("center", (0, -1)),
+    "Down": ("center", (0, 1)),
+    "Left": ("midright", (-1, 0)),
+    "Right": ("midleft", (1, 0)),
+    "Up-Left": ("bottomright", (-1, -1)),
+    "Up-Right": ("bottomleft", (1, -1)),
+    "Down-Left": ("topright", (-1, 1)),
+    "Down-Right": ("topleft", (1, 1))
+}
+
+# Fixed histogram bucket edges in ms, each 25% above the previous (0.01ms to ~5s).
+PROFILE_BUCKETS_MS = [0.01 * 1.25 ** i for i in range(60)]
+PROFILE_HUD_REFRESH = 0.25
+PROFILE_HOTKEY_FRAMES = 300
+profile_histograms = {}
+cache_stats = {}
+frame_stamps = deque(maxlen=120)
+show_profiler_hud = False
+profiler_hud_cache = None
+frame_profiler = None
+profile_frames_left = 0
+profile_output = "keyboard.prof"
+
+def record_timing(name, elapsed_ms):
+    histogram = profile_histograms.get(name)
+    if histogram is None:
+        histogram = {"counts": [0] * (len(PROFILE_BUCKETS_MS) + 1), "count": 0, "total_ms": 0.0, "max_ms": 0.0}
+        profile_histograms[name] = histogram
+    histogram["counts"][bisect.bisect_left(PROFILE_BUCKETS_MS, elapsed_ms)] += 1
+    histogram["count"] += 1
+    histogram["total_ms"] += elapsed_ms
+    if elapsed_ms > histogram["max_ms"]:
+        histogram["max_ms"] = elapsed_ms
+
+def histogram_percentile(histogram, fraction):
+    target = histogram["count"] * fraction
+    seen = 0
+    for i, count in enumerate(histogram["counts"]):
+        seen += count
+        if count and seen >= target:
+            return PROFILE_BUCKETS_MS[i] if i < len(PROFILE_BUCKETS_MS) else histogram["max_ms"]
+    return 0.0
+
+def profiled(name):
+    def wrap(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_timing(name, (time.perf_counter() - start) * 1000)
+        return timed
+    return wrap
+
+def count_cache(name, hit):
+    stats = cache_stats.get(name)
+    if stats is None:
+        stats = cache_stats[name] = [0, 0]
+    stats[0 if hit else 1] += 1
+
+def reset_profile():
+    profile_histograms.clear()
+    cache_stats.clear()
+    frame_stamps.clear()
+
+def get_profiler_hud():
+    global profiler_hud_cache
+    now = time.perf_counter()
+    if profiler_hud_cache and now - profiler_hud_cache[0] < PROFILE_HUD_REFRESH:
+        return profiler_hud_cache[1]
+    lines = []
+    fps = (len(frame_stamps) - 1) / (frame_stamps[-1] - frame_stamps[0]) if len(frame_stamps) > 1 and frame_stamps[-1] > frame_stamps[0] else 0.0
+    frame = profile_histograms.get("frame")
+    if frame:
+        lines.append(f"FPS {fps:.1f}  frame p50 {histogram_percentile(frame, 0.5):.2f}ms p99 {histogram_percentile(frame, 0.99):.2f}ms")
+    else:
+        lines.append(f"FPS {fps:.1f}")
+    for name in sorted(profile_histograms):
+        if name == "frame":
+            continue
+        histogram = profile_histograms[name]
+        lines.append(f"{name}: n={histogram['count']} p50 {histogram_percentile(histogram, 0.5):.2f} p99 {histogram_percentile(histogram, 0.99):.2f} max {histogram['max_ms']:.2f}ms")
+    for name in sorted(cache_stats):
+        hits, misses = cache_stats[name]
+        lines.append(f"{name} cache: {100 * hits / max(1, hits + misses):.1f}% hit ({hits}/{hits + misses})")
+    if profile_frames_left:
+        lines.append(f"cProfile: {profile_frames_left} frames left")
+    rendered = [small_font.render(line, True, (255, 255, 255)) for line in lines]
+    hud = pygame.Surface((max(text.get_width() for text in rendered) + 8, sum(text.get_height() for text in rendered) + 8), pygame.SRCALPHA)
+    hud.fill((0, 0, 0, 180))
+    y = 4
+    for text in rendered:
+        hud.blit(text, (4, y))
+        y += text.get_height()
+    profiler_hud_cache = (now, hud)
+    return hud
+
+def start_frame_profile(frames):
+    global profile_frames_left
+    if frame_profiler is None and frames > 0:
+        profile_frames_left = frames
+        set_feedback_message(f"Profiling next {frames} frames")
+
+def begin_profiled_frame():
+    global frame_profiler
+    frame_stamps.append(time.perf_counter())
+    if profile_frames_left and frame_profiler is None:
+        import cProfile
+        frame_profiler = cProfile.Profile()
+        frame_profiler.enable()
+
+def end_profiled_frame(elapsed_ms):
+    global frame_profiler, profile_frames_left
+    record_timing("frame", elapsed_ms)
+    if frame_profiler is None:
+        return
+    profile_frames_left -= 1
+    if profile_frames_left > 0:
+        return
+    frame_profiler.disable()
+    try:
+        import pstats
+        frame_profiler.dump_stats(profile_output)
+        pstats.Stats(frame_profiler).sort_stats("cumulative").print_stats(20)
+        set_feedback_message(f"Profile written to {profile_output}")
+    except Exception as e:
+        set_feedback_message("Profile dump failed")
+        print(f"Profile dump error: {e}\n{traceback.format_exc()}")
+    frame_profiler = None
+
+KEYSTROKE_TRACE_LIMIT = 2048
+LATENCY_EXPORT_EVERY = 100
+LATENCY_QUANTILES = [0.5, 0.95, 0.99]
+keystroke_trace = None
+keystroke_traces = deque(maxlen=KEYSTROKE_TRACE_LIMIT)
+latency_export_path = None
+
+def begin_keystroke_trace(received, pressed=None, dispatch="release"):
+    # pygame does not expose SDL's event timestamp, so a trace starts when the
+    # frame fetched the event; "queue" is the time spent behind earlier events.
+    global keystroke_trace
+    now = time.perf_counter()
+    keystroke_trace = {"timestamp": time.time(), "start": received, "pressed": received if pressed is None else pressed,
+                       "dispatch": dispatch, "last": now, "stages": {"queue": (now - received) * 1000}}
+
+def mark_keystroke_stage(stage):
+    if keystroke_trace is None:
+        return
+    now = time.perf_counter()
+    stages = keystroke_trace["stages"]
+    stages[stage] = stages.get(stage, 0.0) + (now - keystroke_trace["last"]) * 1000
+    keystroke_trace["last"] = now
+
+def cancel_keystroke_trace():
+    global keystroke_trace
+    keystroke_trace = None
+
+def finish_keystroke_trace(direction):
+    global keystroke_trace
+    if keystroke_trace is None:
+        return
+    trace = keystroke_trace
+    keystroke_trace = None
+    now = time.perf_counter()
+    total_ms = (now - trace["start"]) * 1000
+    press_ms = (now - trace["pressed"]) * 1000
+    # Only the gesture direction is kept; the typed text never leaves the process.
+    keystroke_traces.append({"timestamp": trace["timestamp"], "direction": direction, "dispatch": trace["dispatch"],
+                             "total_ms": total_ms, "press_ms": press_ms, "stages": trace["stages"]})
+    record_timing("keystroke", total_ms)
+    record_timing("keystroke.press", press_ms)
+    for stage, elapsed_ms in trace["stages"].items():
+        record_timing(f"keystroke.{stage}", elapsed_ms)
+    if latency_export_path and len(keystroke_traces) % LATENCY_EXPORT_EVERY == 0:
+        export_latency_report(latency_export_path)
+
+def exact_percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def summarize_keystroke_latency():
+    samples = {"total": [trace["total_ms"] for trace in keystroke_traces],
+               "press": [trace.get("press_ms", trace["total_ms"]) for trace in keystroke_traces]}
+    for trace in keystroke_traces:
+        for stage, elapsed_ms in trace["stages"].items():
+            samples.setdefault(stage, []).append(elapsed_ms)
+    summary = {}
+    for stage, values in samples.items():
+        values.sort()
+        summary[stage] = {"count": len(values), "sum_ms": sum(values)}
+        for quantile in LATENCY_QUANTILES:
+            summary[stage][f"p{round(quantile * 100)}_ms"] = exact_percentile(values, quantile)
+    return summary
+
+def format_prometheus_latency(summary):
+    lines = [
+        "# HELP vk_keystroke_latency_seconds Dispatching touch event to key injection, by stage; stage=\"press\" is measured from touch-down.",
+        "# TYPE vk_keystroke_latency_seconds summary"
+    ]
+    for stage, stats in sorted(summary.items()):
+        for quantile in LATENCY_QUANTILES:
+            lines.append(f'vk_keystroke_latency_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[f"p{round(quantile * 100)}_ms"] / 1000:.6f}')
+        lines.append(f'vk_keystroke_latency_seconds_sum{{stage="{stage}"}} {stats["sum_ms"] / 1000:.6f}')
+        lines.append(f'vk_keystroke_latency_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    return "\n".join(lines) + "\n"
+
+def export_latency_report(path):
+    try:
+        summary = summarize_keystroke_latency()
+        if path.endswith((".prom", ".txt")):
+            content = format_prometheus_latency(summary)
+        else:
+            content = json.dumps({"generated": time.time(), "summary": summary, "traces": list(keystroke_traces)}, indent=2)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        print(f"Wrote keystroke latency report to {path}")
+        return True
+    except Exception as e:
+        print(f"Latency export error: {e}\n{traceback.format_exc()}")
+        return False
+
+SESSION_FORMAT_VERSION = 1
+REPLAY_PASTE_EVENT = pygame.event.custom_type()
+RECORDED_EVENT_TYPES = {
+    "QUIT": pygame.QUIT,
+    "MOUSEBUTTONDOWN": pygame.MOUSEBUTTONDOWN,
+    "MOUSEBUTTONUP": pygame.MOUSEBUTTONUP,
+    "MOUSEMOTION": pygame.MOUSEMOTION,
+    "KEYDOWN": pygame.KEYDOWN,
+    "KEYUP": pygame.KEYUP,
+    "VIDEORESIZE": pygame.VIDEORESIZE,
+    "WINDOWSIZECHANGED": pygame.WINDOWSIZECHANGED
+}
+RECORDED_EVENT_NAMES = {event_type: name for name, event_type in RECORDED_EVENT_TYPES.items()}
+session_recorder = None
+session_replay = None
+injection_enabled = True
+dispatch_mode = "release"
+snap_grid = 10
+input_time = time.perf_counter()
+
+def start_recording(path):
+    # One gzip'd JSON line per frame: [t] or [t, events], t in ms since the
+    # recording started. Every frame is kept because scroll momentum depends on dt.
+    global session_recorder
+    session_file = gzip.open(path, "wt", encoding="utf-8")
+    session_file.write(json.dumps({"version": SESSION_FORMAT_VERSION, "size": list(screen.get_size()), "platform": platform.system()}) + "\n")
+    session_recorder = {"path": path, "file": session_file, "start": time.perf_counter(), "frame": None, "frames": 0}
+    print(f"Recording session to {path}")
+
+def record_session_event(name, attrs):
+    if session_recorder is not None and session_recorder["frame"] is not None:
+        session_recorder["frame"].append([name, attrs])
+
+def record_event(event):
+    name = RECORDED_EVENT_NAMES.get(event.type)
+    if name is None or session_recorder is None:
+        return
+    attrs = {}
+    for field, value in event.dict.items():
+        if isinstance(value, (bool, int, float, str)):
+            attrs[field] = value
+        elif isinstance(value, (tuple, list)) and all(isinstance(item, (int, float)) for item in value):
+            attrs[field] = list(value)
+    record_session_event(name, attrs)
+
+def flush_recorded_frame():
+    frame_events = session_recorder["frame"]
+    if frame_events is None:
+        return
+    entry = [session_recorder["frame_time"], frame_events] if frame_events else [session_recorder["frame_time"]]
+    session_recorder["file"].write(json.dumps(entry, separators=(",", ":")) + "\n")
+    session_recorder["frames"] += 1
+    session_recorder["frame"] = None
+
+def start_replay(path, speed="max", inject=False):
+    global session_replay, injection_enabled
+    session_file = gzip.open(path, "rt", encoding="utf-8")
+    header = json.loads(session_file.readline())
+    if header.get("version") != SESSION_FORMAT_VERSION:
+        raise ValueError(f"Unsupported session format {header.get('version')}")
+    if tuple(header["size"]) != screen.get_size():
+        resize_screen(tuple(header["size"]))
+    injection_enabled = inject
+    session_replay = {"path": path, "file": session_file, "speed": speed, "start": time.perf_counter(), "frames": 0, "summary": None, "done": False}
+    print(f"Replaying {path} at {speed} speed" + ("" if inject else " (typing not injected)"))
+
+def get_frame_events():
+    # Every input-driven timer reads input_time, which a replay takes from the
+    # recording so debounce and momentum behave the same at any replay speed.
+    global input_time
+    if session_replay is None:
+        input_time = time.perf_counter()
+        events = pygame.event.get()
+    else:
+        events = [event for event in pygame.event.get() if event.type == pygame.QUIT]
+        events.extend(next_replay_frame())
+    if session_recorder is not None:
+        flush_recorded_frame()
+        session_recorder["frame"] = []
+        session_recorder["frame_time"] = round((input_time - session_recorder["start"]) * 1000, 2)
+    return events
+
+def coalesce_motion_events(events, keep_path=False):
+    # High-rate touch panels report several motions per frame. A run of motion
+    # events with no other event between them is collapsed to the latest
+    # position per pointer, with the relative movement summed, so dragging and
+    # scrolling cost the same at any report rate. keep_path is for a gesture
+    # recogniser that has to see every sample.
+    if keep_path:
+        return events
+    coalesced = []
+    latest = {}
+    merged = {}
+    for event in events:
+        if event.type == pygame.MOUSEMOTION:
+            pointer = ("mouse", getattr(event, "which", 0))
+        elif event.type == pygame.FINGERMOTION:
+            pointer = ("finger", event.touch_id, event.finger_id)
+        else:
+            latest.clear()
+            coalesced.append(event)
+            continue
+        index = latest.get(pointer)
+        if index is None:
+            latest[pointer] = len(coalesced)
+            coalesced.append(event)
+            continue
+        merged.setdefault(index, []).append(coalesced[index])
+        coalesced[index] = event
+    for index, earlier in merged.items():
+        attrs = dict(coalesced[index].dict)
+        if "rel" in attrs:
+            attrs["rel"] = (sum(event.rel[0] for event in earlier) + attrs["rel"][0], sum(event.rel[1] for event in earlier) + attrs["rel"][1])
+        if "dx" in attrs:
+            attrs["dx"] += sum(event.dx for event in earlier)
+            attrs["dy"] += sum(event.dy for event in earlier)
+        coalesced[index] = pygame.event.Event(coalesced[index].type, attrs)
+    return coalesced
+
+def next_replay_frame():
+    global input_time
+    while True:
+        line = session_replay["file"].readline()
+        if not line:
+            session_replay["done"] = True
+            return []
+        entry = json.loads(line)
+        if isinstance(entry, dict):
+            session_replay["summary"] = entry.get("summary")
+            continue
+        break
+    frame_time = session_replay["start"] + entry[0] / 1000
+    if session_replay["speed"] == "real":
+        delay = frame_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    input_time = frame_time
+    session_replay["frames"] += 1
+    events = []
+    for name, attrs in entry[1] if len(entry) > 1 else []:
+        if name == "PASTE":
+            events.append(pygame.event.Event(REPLAY_PASTE_EVENT, attrs))
+            continue
+        for field, value in attrs.items():
+            if isinstance(value, list):
+                attrs[field] = tuple(value)
+        events.append(pygame.event.Event(RECORDED_EVENT_TYPES[name], attrs))
+    return events
+
+def summarize_session(frames):
+    frame = profile_histograms.get("frame")
+    summary = {"typed_entries": typed_count, "typed_sha256": typed_digest.hexdigest(), "frames": frames}
+    if frame:
+        for quantile in LATENCY_QUANTILES:
+            summary[f"frame_p{round(quantile * 100)}_ms"] = histogram_percentile(frame, quantile)
+    return summary
+
+def finish_session():
+    global session_recorder, session_replay
+    if session_recorder is not None:
+        try:
+            flush_recorded_frame()
+            session_recorder["file"].write(json.dumps({"summary": summarize_session(session_recorder["frames"])}) + "\n")
+            session_recorder["file"].close()
+            print(f"Recorded {session_recorder['frames']} frames to {session_recorder['path']}")
+        except Exception as e:
+            print(f"Session recording error: {e}\n{traceback.format_exc()}")
+        session_recorder = None
+    if session_replay is not None:
+        session_replay["file"].close()
+        recorded = session_replay["summary"] or {}
+        replayed = summarize_session(session_replay["frames"])
+        print(f"Replayed {session_replay['frames']} frames in {time.perf_counter() - session_replay['start']:.2f}s")
+        for field, value in replayed.items():
+            print(f"  {field}: recorded={recorded.get(field)} replayed={value}")
+        if recorded:
+            print("Typed output " + ("matches" if recorded.get("typed_sha256") == replayed["typed_sha256"] else "DIFFERS from") + " the recording")
+        session_replay = None
+
+def init_gpu_renderer(size):
+    global renderer_backend, gpu_window, gpu_renderer, screen
+    from pygame._sdl2 import video
+    gpu_window = video.Window("Virtual Touchscreen Keyboard", size=size, resizable=True)
+    try:
+        gpu_renderer = video.Renderer(gpu_window, accelerated=-1, vsync=True)
+    except Exception:
+        gpu_window.destroy()
+        gpu_window = None
+        raise
+    # Screens that still paint in software draw into this surface, which
+    # present_frame() uploads as a single streaming texture.
+    screen = pygame.Surface(size)
+    renderer_backend = "gpu"
+
+def resize_screen(size):
+    global screen, frame_texture, last_resize_time
+    if renderer_backend == "gpu":
+        screen = pygame.Surface(size)
+        frame_texture = None
+    else:
+        screen = pygame.display.set_mode(size, pygame.RESIZABLE)
+    last_resize_time = time.time()
+
+def toggle_fullscreen():
+    global gpu_fullscreen
+    if renderer_backend == "gpu":
+        gpu_fullscreen = not gpu_fullscreen
+        if gpu_fullscreen:
+            gpu_window.set_fullscreen(desktop=True)
+        else:
+            gpu_window.set_windowed()
+        resize_screen(gpu_window.size)
+    else:
+        pygame.display.toggle_fullscreen()
+
+def new_layer_surface(size):
+    surface = pygame.Surface(size)
+    if pygame.display.get_surface():
+        surface = surface.convert()
+    return surface
+
+@profiled("render_text")
+def render_text(text_font, text, color):
+    cache_key = (id(text_font), text, color)
+    text_surf = text_surface_cache.get(cache_key)
+    count_cache("text", text_surf is not None)
+    if text_surf is None:
+        if len(text_surface_cache) > 256:
+            text_surface_cache.clear()
+        text_surf = text_font.render(text, True, color)
+        text_surface_cache[cache_key] = text_surf
+    return text_surf
+
+def get_surface_texture(surface):
+    from pygame._sdl2 import video
+    entry = texture_cache.get(id(surface))
+    if entry is None or entry[0] is not surface:
+        if len(texture_cache) > 512:
+            texture_cache.clear()
+        entry = (surface, video.Texture.from_surface(gpu_renderer, surface))
+        texture_cache[id(surface)] = entry
+    return entry[1]
+
+def present_layers(background, overlays):
+    gpu_renderer.draw_color = (255, 255, 255, 255)
+    gpu_renderer.clear()
+    get_surface_texture(background).draw(dstrect=(0, 0))
+    if show_profiler_hud:
+        overlays = overlays + [(get_profiler_hud(), (0, 0))]
+    for surface, pos in overlays:
+        get_surface_texture(surface).draw(dstrect=(pos[0], pos[1]))
+    gpu_renderer.present()
+
+def present_frame():
+    global frame_texture
+    if show_profiler_hud:
+        screen.blit(get_profiler_hud(), (0, 0))
+    if renderer_backend == "gpu":
+        from pygame._sdl2 import video
+        if frame_texture is None or (frame_texture.width, frame_texture.height) != screen.get_size():
+            frame_texture = video.Texture(gpu_renderer, screen.get_size(), streaming=True)
+        frame_texture.update(screen)
+        gpu_renderer.clear()
+        frame_texture.draw(dstrect=(0, 0))
+        gpu_renderer.present()
+    else:
+        pygame.display.flip()
 
 def set_feedback_message(message, duration=2.0):
     global feedback_message, feedback_timer
@@ -90,12 +740,30 @@ def set_feedback_message(message, duration=2.0):
     feedback_timer = time.time() + duration
     print(f"Feedback set: {message}")
 
-def copy_to_clipboard(text):
+def init_clipboard():
+    global clipboard_provider, clipboard_text, clipboard_fresh, clipboard_requests, clipboard_results, clipboard_thread
+    clipboard_text = None
+    clipboard_fresh = False
+    clipboard_requests = queue.Queue()
+    clipboard_results = queue.Queue()
+    clipboard_thread = None
+    if platform.system() == "Emscripten":
+        clipboard_provider = "js"
+    else:
+        # SDL's clipboard lives in-process and reports external changes with
+        # CLIPBOARDUPDATE; pyperclip runs a helper per call, so it goes off-thread.
+        clipboard_provider = "pyperclip"
+        try:
+            pygame.scrap.init()
+            if pygame.scrap.get_init():
+                clipboard_provider = "scrap"
+        except Exception as e:
+            print(f"SDL clipboard unavailable: {e}")
+    print(f"Clipboard provider: {clipboard_provider}")
+
+def write_clipboard_text(text, provider):
     try:
-        if not text:
-            print("Clipboard write failed: Empty text")
-            return False
-        if platform.system() == "Emscripten":
+        if provider == "js":
             if js is None:
                 print("Clipboard write failed: js module not available")
                 return False
@@ -112,7 +780,12 @@ def copy_to_clipboard(text):
             except Exception as e:
                 print(f"Clipboard write failed in Emscripten: {e}")
                 return False
+        elif provider == "scrap":
+            pygame.scrap.put(pygame.SCRAP_TEXT, text.encode("utf-8"))
+            print(f"Clipboard write success: {text[:50]}...")
+            return True
         else:
+            ensure_backends()
             if pyperclip is None:
                 print("Clipboard write failed: pyperclip not installed")
                 return False
@@ -123,9 +796,9 @@ def copy_to_clipboard(text):
         print(f"Clipboard write failed: {e}\n{traceback.format_exc()}")
         return False
 
-def get_clipboard_text():
+def read_clipboard_text(provider):
     try:
-        if platform.system() == "Emscripten":
+        if provider == "js":
             if js is None:
                 print("Clipboard read failed: js module not available")
                 return ""
@@ -141,7 +814,13 @@ def get_clipboard_text():
             except Exception as e:
                 print(f"Clipboard read failed in Emscripten: {e}")
                 return ""
+        elif provider == "scrap":
+            data = pygame.scrap.get(pygame.SCRAP_TEXT)
+            text = data.decode("utf-8", "replace").rstrip("\0") if data else ""
+            print(f"Clipboard read success: {text[:50]}..." if text else "Clipboard read empty")
+            return text
         else:
+            ensure_backends()
             if pyperclip is None:
                 print("Clipboard read failed: pyperclip not installed")
                 return ""
@@ -152,26 +831,373 @@ def get_clipboard_text():
         print(f"Clipboard read failed: {e}\n{traceback.format_exc()}")
         return ""
 
+def clipboard_worker():
+    while True:
+        request = clipboard_requests.get()
+        if request[0] == "write":
+            clipboard_results.put(("write", write_clipboard_text(request[1], "pyperclip"), None))
+        else:
+            clipboard_results.put(("read", read_clipboard_text("pyperclip"), request[1]))
+
+def queue_clipboard_request(request):
+    global clipboard_thread
+    clipboard_requests.put(request)
+    if clipboard_thread is None:
+        clipboard_thread = threading.Thread(target=clipboard_worker, name="clipboard", daemon=True)
+        clipboard_thread.start()
+
+def copy_to_clipboard(text):
+    global clipboard_provider, clipboard_text, clipboard_fresh
+    if not text:
+        print("Clipboard write failed: Empty text")
+        return False
+    if clipboard_fresh and text == clipboard_text:
+        print("Clipboard already holds this text")
+        return True
+    if clipboard_provider == "pyperclip":
+        queue_clipboard_request(("write", text))
+        return True
+    if write_clipboard_text(text, clipboard_provider):
+        clipboard_text = text
+        clipboard_fresh = True
+        return True
+    if clipboard_provider == "scrap":
+        print("SDL clipboard write failed, switching to pyperclip")
+        clipboard_provider = "pyperclip"
+        queue_clipboard_request(("write", text))
+        return True
+    return False
+
+def request_clipboard_paste(target_buffer):
+    global clipboard_text, clipboard_fresh
+    if session_replay is not None:
+        return
+    if clipboard_fresh:
+        apply_clipboard_paste(clipboard_text, target_buffer)
+    elif clipboard_provider == "pyperclip":
+        queue_clipboard_request(("read", target_buffer))
+    else:
+        clipboard_text = read_clipboard_text(clipboard_provider)
+        clipboard_fresh = clipboard_provider == "scrap"
+        apply_clipboard_paste(clipboard_text, target_buffer)
+
+def apply_clipboard_paste(text, target_buffer):
+    record_session_event("PASTE", {"text": text})
+    if not text:
+        set_feedback_message("Clipboard empty")
+        return
+    if not text_active or target_buffer is not label_buffer:
+        print("Paste dropped: field no longer active")
+        return
+    label_buffer.insert(text)
+    set_feedback_message("Text pasted")
+    print(f"Pasted text: {text[:50]}...")
+
+def process_clipboard_results():
+    while True:
+        try:
+            kind, result, target_buffer = clipboard_results.get_nowait()
+        except queue.Empty:
+            return
+        if kind == "read":
+            apply_clipboard_paste(result, target_buffer)
+        elif not result:
+            set_feedback_message("Copy failed")
+
+class TextBuffer:
+    # Gap buffer: edits at the cursor are amortized O(1) however long the text is.
+    def __init__(self, text=""):
+        self.chars = list(text) + [""] * 64
+        self.gap_start = len(text)
+        self.gap_end = len(self.chars)
+        self.anchor = None
+        self.scroll = 0
+        self.cached_text = text
+
+    def __len__(self):
+        return len(self.chars) - (self.gap_end - self.gap_start)
+
+    @property
+    def cursor(self):
+        return self.gap_start
+
+    def text(self):
+        if self.cached_text is None:
+            self.cached_text = "".join(self.chars[:self.gap_start]) + "".join(self.chars[self.gap_end:])
+        return self.cached_text
+
+    def slice(self, start, end):
+        start = max(0, start)
+        end = min(len(self), end)
+        if start >= end:
+            return ""
+        gap = self.gap_end - self.gap_start
+        if end <= self.gap_start:
+            return "".join(self.chars[start:end])
+        if start >= self.gap_start:
+            return "".join(self.chars[start + gap:end + gap])
+        return "".join(self.chars[start:self.gap_start]) + "".join(self.chars[self.gap_end:end + gap])
+
+    def move_gap(self, position):
+        position = max(0, min(len(self), position))
+        if position < self.gap_start:
+            count = self.gap_start - position
+            self.chars[self.gap_end - count:self.gap_end] = self.chars[position:self.gap_start]
+            self.gap_start = position
+            self.gap_end -= count
+        elif position > self.gap_start:
+            count = position - self.gap_start
+            self.chars[self.gap_start:self.gap_start + count] = self.chars[self.gap_end:self.gap_end + count]
+            self.gap_start += count
+            self.gap_end += count
+
+    def ensure_gap(self, size):
+        if self.gap_end - self.gap_start < size:
+            extra = max(size, len(self.chars))
+            self.chars[self.gap_end:self.gap_end] = [""] * extra
+            self.gap_end += extra
+
+    def set_text(self, text):
+        self.__init__(text)
+
+    def move_cursor(self, position, select=False):
+        if select and self.anchor is None:
+            self.anchor = self.cursor
+        elif not select:
+            self.anchor = None
+        self.move_gap(position)
+
+    def selection(self):
+        if self.anchor is None or self.anchor == self.cursor:
+            return None
+        return (min(self.anchor, self.cursor), max(self.anchor, self.cursor))
+
+    def selected_text(self):
+        selection = self.selection()
+        return self.slice(*selection) if selection else ""
+
+    def select_all(self):
+        self.move_gap(len(self))
+        self.anchor = 0
+
+    def delete_selection(self):
+        selection = self.selection()
+        self.anchor = None
+        if not selection:
+            return False
+        self.move_gap(selection[1])
+        self.gap_start = selection[0]
+        self.cached_text = None
+        return True
+
+    def insert(self, text):
+        self.delete_selection()
+        if not text:
+            return
+        self.ensure_gap(len(text))
+        self.chars[self.gap_start:self.gap_start + len(text)] = text
+        self.gap_start += len(text)
+        self.cached_text = None
+
+    def delete_back(self):
+        if not self.delete_selection() and self.gap_start > 0:
+            self.gap_start -= 1
+            self.cached_text = None
+
+    def delete_forward(self):
+        if not self.delete_selection() and self.gap_end < len(self.chars):
+            self.gap_end += 1
+            self.cached_text = None
+
+def estimate_prefix_fit(text, text_font, max_width):
+    glyph_widths = glyph_width_cache.setdefault(id(text_font), {})
+    total = 0
+    for i, char in enumerate(text):
+        width = glyph_widths.get(char)
+        if width is None:
+            width = text_font.size(char)[0]
+            glyph_widths[char] = width
+        total += width
+        if total > max_width:
+            return i
+    return len(text)
+
+def measure_prefix_fit(text, text_font, max_width):
+    # Cached glyph advances give a first guess; font.size() on a few short
+    # prefixes (gallop + binary search) then finds the exact kerned cut.
+    guess = estimate_prefix_fit(text, text_font, max_width)
+    lo = 0
+    probe = max(1, guess)
+    while probe <= len(text) and text_font.size(text[:probe])[0] <= max_width:
+        lo = probe
+        probe = min(len(text) + 1, probe + max(1, probe // 8))
+    hi = min(probe, len(text) + 1)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if text_font.size(text[:mid])[0] <= max_width:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+@profiled("truncate_text")
 def truncate_text(text, font, max_width):
     if not text:
         return text
-    text_width = font.size(text)[0]
-    if text_width <= max_width:
-        return text
-    ellipsis = "..."
-    ellipsis_width = font.size(ellipsis)[0]
-    available_width = max_width - ellipsis_width
-    if available_width <= 0:
-        return ellipsis
-    truncated = ""
-    for i in range(len(text)):
-        if font.size(text[:i+1])[0] > available_width:
+    cache_key = (id(font), text, max_width)
+    truncated = truncate_cache.get(cache_key)
+    count_cache("truncate", truncated is not None)
+    if truncated is not None:
+        return truncated
+    if measure_prefix_fit(text, font, max_width) == len(text):
+        truncated = text
+    else:
+        ellipsis = "..."
+        ellipsis_width = font.size(ellipsis)[0]
+        available_width = max_width - ellipsis_width
+        if available_width <= 0:
+            truncated = ellipsis
+        else:
+            truncated = text[:measure_prefix_fit(text, font, available_width)] + ellipsis
+    if len(truncate_cache) > 256:
+        truncate_cache.clear()
+    truncate_cache[cache_key] = truncated
+    return truncated
+
+def get_field_viewport(buffer, text_font, max_width):
+    # Only the characters around the cursor are sliced out and measured, so a
+    # multi-MB paste costs the same per frame as a short label.
+    cursor = buffer.cursor
+    start = max(min(buffer.scroll, cursor), cursor - FIELD_VIEWPORT_CHARS)
+    left = buffer.slice(start, cursor)
+    if text_font.size(left)[0] > max_width:
+        start = cursor - measure_prefix_fit(left[::-1], text_font, max_width)
+    buffer.scroll = start
+    visible = buffer.slice(start, start + FIELD_VIEWPORT_CHARS)
+    visible = visible[:measure_prefix_fit(visible, text_font, max_width)]
+    return visible, start
+
+@profiled("draw_field_text")
+def draw_field_text(surface, text_font, pos, max_width, inactive_text, active):
+    if not active:
+        display_text = truncate_text(inactive_text, text_font, max_width)
+        surface.blit(render_text(text_font, display_text, (0, 0, 0)), pos)
+        return
+    visible, start = get_field_viewport(label_buffer, text_font, max_width)
+    text_height = text_font.get_height()
+    selection = label_buffer.selection()
+    if selection and selection[1] > start and selection[0] < start + len(visible):
+        x0 = text_font.size(visible[:max(0, selection[0] - start)])[0]
+        x1 = text_font.size(visible[:max(0, selection[1] - start)])[0]
+        pygame.draw.rect(surface, (170, 200, 255), (pos[0] + x0, pos[1], x1 - x0, text_height))
+    surface.blit(text_font.render(visible, True, (0, 0, 0)), pos)
+    cursor_x = pos[0] + text_font.size(visible[:label_buffer.cursor - start])[0]
+    pygame.draw.line(surface, (0, 0, 0), (cursor_x, pos[1]), (cursor_x, pos[1] + text_height - 1))
+
+def record_typed_text(text):
+    global input_history_version, typed_count
+    typed_digest.update(text.encode("utf-8") + b"\0")
+    typed_count += 1
+    if text == "Backspace":
+        if input_buffer:
+            last = input_buffer.pop()
+            if len(last) > 1 and last not in SPECIAL_KEYS:
+                input_buffer.append(last[:-1])
+    else:
+        input_buffer.append(text)
+    input_history_version += 1
+
+def clear_input_history():
+    global input_history_version
+    input_buffer.clear()
+    input_history_version += 1
+
+def get_input_tail(text_font, max_width):
+    # Walk the ring buffer from the newest entry and keep only what fits; the
+    # rendered line is cached until the history or the view changes.
+    global input_tail_cache
+    cache_key = (input_history_version, id(text_font), max_width)
+    if input_tail_cache and input_tail_cache[0] == cache_key:
+        return input_tail_cache[1]
+    parts = []
+    length = 0
+    for entry in reversed(input_buffer):
+        parts.append(entry)
+        length += len(entry)
+        if length >= INPUT_TAIL_CHARS:
             break
-        truncated = text[:i+1]
-    return truncated + ellipsis
+    tail = "".join(reversed(parts))[-INPUT_TAIL_CHARS:]
+    prefix = "Buffer: "
+    available = max_width - text_font.size(prefix)[0]
+    fit = measure_prefix_fit(tail[::-1], text_font, available)
+    if fit < len(tail) or length > len(tail) or len(parts) < len(input_buffer):
+        fit = measure_prefix_fit(tail[::-1], text_font, available - text_font.size("...")[0])
+        prefix += "..."
+    surface = text_font.render(prefix + tail[len(tail) - fit:], True, (0, 0, 0))
+    input_tail_cache = (cache_key, surface)
+    return surface
+
+INJECT_KEY_NAMES = {
+    "Backspace": "backspace",
+    "Space": "space",
+    "Enter": "enter",
+    "Tab": "tab",
+    "Delete": "delete",
+    "Esc": "esc",
+    "Up": "up",
+    "Down": "down",
+    "Left": "left",
+    "Right": "right",
+    "Windows": "win",
+    "CapsLock": "capslock"
+}
+
+def inject_key(text, shift=False, ctrl=False):
+    # Types one key action on this machine. Used by send_key() and by the remote
+    # host agent; returns False when neither typing library is available.
+    if pyautogui is not None:
+        print("Ensuring target window focus")
+        pyautogui.click()
+        time.sleep(0.1)
+    else:
+        print("Warning: pyautogui not available for focus")
+    mark_keystroke_stage("focus")
+    
+    text_to_send = text.upper() if shift else text
+    if pyautogui is not None:
+        print("Using pyautogui for typing")
+        if text in INJECT_KEY_NAMES:
+            pyautogui.press(INJECT_KEY_NAMES[text])
+            print(f"Pressed '{INJECT_KEY_NAMES[text]}'")
+        elif text in ["Shift", "Ctrl", "Alt", "Tab", "Windows"]:
+            print(f"Skipping modifier '{text}'")
+        elif ctrl and text.lower() in ["c", "v", "x", "a", "z"]:
+            pyautogui.hotkey("ctrl", text.lower())
+            print(f"Hotkey 'ctrl+{text.lower()}'")
+        else:
+            pyautogui.write(text_to_send, interval=0.05)
+            print(f"Typed '{text_to_send}'")
+    elif keyboard is not None:
+        print("Falling back to keyboard library")
+        if text in INJECT_KEY_NAMES:
+            keyboard.press_and_release(INJECT_KEY_NAMES[text])
+            print(f"Pressed '{INJECT_KEY_NAMES[text]}'")
+        elif text in ["Shift", "Ctrl", "Alt", "Tab", "Windows"]:
+            print(f"Skipping modifier '{text}'")
+        elif ctrl and text.lower() in ["c", "v", "x", "a", "z"]:
+            keyboard.press_and_release(f"ctrl+{text.lower()}")
+            print(f"Hotkey 'ctrl+{text.lower()}'")
+        else:
+            keyboard.write(text_to_send)
+            print(f"Typed '{text_to_send}'")
+    else:
+        return False
+    mark_keystroke_stage("write")
+    return True
 
+@profiled("send_key")
 def send_key(text):
-    global input_buffer, active_modifiers, caps_lock_active, last_typed_text
+    global active_modifiers, caps_lock_active, last_typed_text, oneshot_layer
     
     if not text:
         print("send_key: No text provided")
@@ -193,6 +1219,12 @@ def send_key(text):
         print(f"Modifier {text} set to True")
         return
     
+    if text.startswith(("Layer:", "Once:")):
+        switch_layer(text)
+        return
+    
+    ensure_backends()
+    mark_keystroke_stage("backend")
     if platform.system() == "Emscripten":
         try:
             key_map = {
@@ -273,89 +1305,85 @@ def send_key(text):
             }}
             '''
             js.eval(js_code)
+            mark_keystroke_stage("write")
             set_feedback_message(f"Typed: {text}")
             last_typed_text = text
             print(f"Emscripten: Typed '{text}' to browser")
         except Exception as e:
             set_feedback_message(f"Typing error: {str(e)}")
             print(f"Key send error (Emscripten): {e}\n{traceback.format_exc()}")
+    elif not injection_enabled:
+        text_to_send = text.upper() if active_modifiers["Shift"] or caps_lock_active else text
+        print(f"Injection disabled, not typing '{text_to_send}'")
+        mark_keystroke_stage("write")
+        set_feedback_message(f"Typed: {text}")
+        last_typed_text = text
+        record_typed_text(text)
+    elif remote_link is not None:
+        try:
+            send_remote_key(text, active_modifiers["Shift"] or caps_lock_active, active_modifiers["Ctrl"])
+            mark_keystroke_stage("write")
+            set_feedback_message(f"Sent: {text}")
+            last_typed_text = text
+            record_typed_text(text)
+        except Exception as e:
+            set_feedback_message(f"Remote send error: {str(e)}")
+            print(f"Key send error (remote): {e}\n{traceback.format_exc()}")
     else:
         try:
             print(f"Attempting to type '{text}' on {platform.system()}")
-            if pyautogui is not None:
-                print("Ensuring target window focus")
-                pyautogui.click()
-                time.sleep(0.1)
-            else:
-                print("Warning: pyautogui not available for focus")
-            
-            key_map = {
-                "Backspace": "backspace",
-                "Space": "space",
-                "Enter": "enter",
-                "Tab": "tab",
-                "Delete": "delete",
-                "Esc": "esc",
-                "Up": "up",
-                "Down": "down",
-                "Left": "left",
-                "Right": "right",
-                "Windows": "win",
-                "CapsLock": "capslock"
-            }
-            
-            if pyautogui is not None:
-                print("Using pyautogui for typing")
-                if text in key_map and key_map[text]:
-                    pyautogui.press(key_map[text])
-                    print(f"Pressed '{key_map[text]}'")
-                elif text in ["Shift", "Ctrl", "Alt", "Tab", "Windows"]:
-                    print(f"Skipping modifier '{text}'")
-                    return
-                else:
-                    text_to_send = text.upper() if active_modifiers["Shift"] or caps_lock_active else text
-                    if active_modifiers["Ctrl"] and text.lower() in ["c", "v", "x", "a", "z"]:
-                        pyautogui.hotkey("ctrl", text.lower())
-                        print(f"Hotkey 'ctrl+{text.lower()}'")
-                    else:
-                        pyautogui.write(text_to_send, interval=0.05)
-                        print(f"Typed '{text_to_send}'")
-                set_feedback_message(f"Typed: {text}")
-                last_typed_text = text
-            elif keyboard is not None:
-                print("Falling back to keyboard library")
-                if text in key_map and key_map[text]:
-                    keyboard.press_and_release(key_map[text])
-                    print(f"Pressed '{key_map[text]}'")
-                elif text in ["Shift", "Ctrl", "Alt", "Tab", "Windows"]:
-                    print(f"Skipping modifier '{text}'")
-                    return
-                else:
-                    text_to_send = text.upper() if active_modifiers["Shift"] or caps_lock_active else text
-                    if active_modifiers["Ctrl"] and text.lower() in ["c", "v", "x", "a", "z"]:
-                        keyboard.press_and_release(f"ctrl+{text.lower()}")
-                        print(f"Hotkey 'ctrl+{text.lower()}'")
-                    else:
-                        keyboard.write(text_to_send)
-                        print(f"Typed '{text_to_send}'")
-                set_feedback_message(f"Typed: {text}")
-                last_typed_text = text
-            else:
+            if not inject_key(text, active_modifiers["Shift"] or caps_lock_active, active_modifiers["Ctrl"]):
                 print("No typing method available")
                 set_feedback_message("Typing failed: Install pyautogui or keyboard")
                 return
-            
-            input_buffer += text
+            set_feedback_message(f"Typed: {text}")
+            last_typed_text = text
+            record_typed_text(text)
             print(f"Success: Typed '{text}' on {platform.system()}")
         except Exception as e:
             error_msg = f"Typing error: {str(e)}"
             set_feedback_message(error_msg)
             print(f"Key send error ({platform.system()}): {error_msg}\n{traceback.format_exc()}")
-            input_buffer += text
+            record_typed_text(text)
     
     active_modifiers = {key: False for key in active_modifiers}
+    oneshot_layer = None
     print("Modifiers reset")
 
+def switch_layer(action):
+    # "Layer:<name>" latches a layer (pressing it again returns to base);
+    # "Once:<name>" applies to the next key only, like a one-shot Shift.
+    global latched_layer, oneshot_layer
+    mode, layer_name = action.split(":", 1)
+    if layer_name not in LAYER_NAMES:
+        set_feedback_message(f"Unknown layer: {layer_name}")
+        print(f"Unknown layer '{layer_name}'")
+        return
+    if mode == "Once":
+        oneshot_layer = layer_name
+    else:
+        latched_layer = "base" if latched_layer == layer_name else layer_name
+        oneshot_layer = None
+    set_feedback_message(f"Layer: {get_active_layer_name(selected_keyboard) if selected_keyboard else layer_name}")
+    print(f"Layer switch '{action}'")
+
+def get_layer_keys(keyboard_data, layer_name):
+    if layer_name == "base":
+        return keyboard_data["keys"]
+    return keyboard_data.get("layers", {}).get(layer_name)
+
+def get_active_layer_name(keyboard_data):
+    layers = keyboard_data.get("layers")
+    if not layers:
+        return "base"
+    if oneshot_layer and (oneshot_layer == "base" or oneshot_layer in layers):
+        return oneshot_layer
+    if latched_layer != "base" and latched_layer in layers:
+        return latched_layer
+    if (active_modifiers.get("Shift") or caps_lock_active) and "shift" in layers:
+        return "shift"
+    return "base"
+
 def create_default_keyboard():
     keyboard = create_new_keyboard()
     keyboard["name"] = ""
@@ -372,6 +1400,7 @@ def create_new_key(last_key=None):
         return copy.deepcopy(last_key)
     return {"char": "", "x": 40, "y": 40, "width": 40, "height": 40, "actions": actions}
 
+@profiled("draw_start_screen")
 def draw_start_screen():
     screen.fill((255, 255, 255))
     screen_width = screen.get_width()
@@ -405,239 +1434,1227 @@ def draw_start_screen():
     color = (100, 100, 255) if active_input == "start_load_code" else (200, 200, 200)
     pygame.draw.rect(screen, color, paste_input_rect)
     pygame.draw.rect(screen, (0, 0, 0), paste_input_rect, 1)
-    display_text = label_text if active_input == "start_load_code" else (load_code_text or "Paste JSON code here")
-    display_text = truncate_text(display_text, small_font, paste_input_rect.width - 10)
-    text_surf = small_font.render(display_text, True, (0, 0, 0))
-    screen.blit(text_surf, (paste_input_rect.x + 5, paste_input_rect.y + 12))
+    paste_active = active_input == "start_load_code"
+    draw_field_text(screen, small_font, (paste_input_rect.x + 5, paste_input_rect.y + 12), paste_input_rect.width - 10,
+                    None if paste_active else (load_code_buffer.text() or "Paste JSON code here"), paste_active)
     
     if feedback_message and time.time() < feedback_timer:
         text_surf = font.render(feedback_message, True, (255, 0, 0))
         screen.blit(text_surf, (20, start_screen_y - 20))
     
-    pygame.display.flip()
+    present_frame()
     return add_button_rect, save_button_rect, load_button_rect, paste_input_rect, delete_code_button_rect, help_button_rect
 
+HELP_TEXT = [
+    "How to Use the Virtual Touchscreen Keyboard",
+    "",
+    "This application lets you create, configure, and use a virtual touchscreen keyboard to type into applications like Google Docs, websites, or system fields (e.g., Windows search bar).",
+    "",
+    "1. Start Screen:",
+    "- 'Add Keyboard': Click to create a new keyboard layout.",
+    "- 'Save': Copies the current keyboard's JSON data to your clipboard.",
+    "- 'Load': Pastes JSON data from the clipboard to load a saved keyboard.",
+    "- 'Paste JSON code here': Click to paste JSON data for loading.",
+    "- 'Delete All Code': Clears the JSON input field.",
+    "- Text fields: Left/Right/Home/End move the cursor, Shift extends the selection, Ctrl+A/C/X/V select, copy, cut and paste.",
+    "- '?': Shows this help guide.",
+    "",
+    "2. Creating a Keyboard:",
+    "- Click 'Add Keyboard' to enter the configuration screen.",
+    "- Name your keyboard by clicking the name field and typing.",
+    "- Click 'Add Key' to create a new key (starts blank).",
+    "- Click 'Duplicate Key' to copy the selected key.",
+    "- Drag keys to position them on the left side of the screen.",
+    "- Select a key to configure it on the right panel.",
+    "",
+    "3. Configuring Keys:",
+    "- 'Tap', 'Up', 'Down', etc.: Set actions for each gesture.",
+    "  - Click a field to type a character (e.g., 'a') or special key (e.g., 'Enter').",
+    "  - Use up/down arrows to cycle through special keys (Shift, Ctrl, etc.).",
+    "  - 'Tap' sets the key's display character.",
+    "- 'Width' and 'Height': Adjust key size (20-200 pixels).",
+    "- 'Delete Key': Removes the selected key.",
+    "- 'Done': Saves the keyboard and returns to the keyboard list.",
+    "",
+    "4. Special Keys:",
+    "- Supported: Shift, Ctrl, Alt, Tab, Windows, CapsLock, Enter, Backspace, Space, Esc, Delete, Up, Down, Left, Right.",
+    "- Modifiers (Shift, Ctrl, etc.) turn blue when active.",
+    "- CapsLock toggles uppercase; other modifiers reset after a non-modifier key.",
+    "",
+    "5. Keyboard List:",
+    "- Shows all saved keyboards.",
+    "- 'Select': Use a keyboard for typing.",
+    "- 'Edit': Modify a keyboard's layout.",
+    "- 'Delete': Remove a keyboard.",
+    "- 'Duplicate': Create a copy of the keyboard.",
+    "- 'Add Keyboard', 'Save', 'Load', 'Delete All Code': Same as start screen.",
+    "- Scroll by dragging if there are many keyboards.",
+    "",
+    "6. Typing with the Keyboard:",
+    "- Select a keyboard from the list to enter typing mode.",
+    "- Click a key to perform its 'Tap' action (e.g., type 'a').",
+    "- Swipe in a direction (Up, Down, etc.) for other actions.",
+    "- Keys type into the active application, website, or system field.",
+    "- Ensure the target (e.g., Google Docs, Windows search bar) is focused before typing.",
+    "- Key actions have a 0.2-second cooldown to prevent repeats.",
+    "- The keyboard stays on top and doesn't take focus, so typing goes to the target.",
+    "- 'Back': Return to the keyboard list.",
+    "",
+    "7. Typing in Google Docs or Websites:",
+    "- Open the website (e.g., Google Docs in Chrome).",
+    "- Click into the text field to focus it.",
+    "- Use the virtual keyboard to type letters, numbers, or special keys.",
+    "- Examples: 'Enter' adds a new line, 'Tab' moves focus, 'Ctrl+C' copies text.",
+    "- Shift or CapsLock for uppercase; Ctrl for shortcuts (e.g., Ctrl+V).",
+    "",
+    "8. Typing in System Fields (e.g., Windows Search):",
+    "- Click the search bar or press Win key to focus it.",
+    "- Use the keyboard to type (e.g., 'hi' to search for 'hi').",
+    "- Special keys like 'Enter' or 'Tab' work as expected.",
+    "",
+    "9. Saving and Loading:",
+    "- 'Save': Copies the keyboard's JSON to the clipboard.",
+    "- Paste the JSON into the 'Paste JSON code here' field and click 'Load'.",
+    "- JSON includes the keyboard name and key configurations.",
+    "",
+    "10. Troubleshooting:",
+    "- Install dependencies: Run 'pip install pygame pyperclip pyautogui keyboard' (and 'pyobjc' for macOS).",
+    "- ALSA/XDG errors: Set 'SDL_AUDIODRIVER=directsound' or disable audio.",
+    "- Typing fails: Ensure the target is focused; try clicking it first.",
+    "- JSON errors: Check for valid format (must have 'name' and 'keys').",
+    "- Errors: Check the console for details; ensure all libraries are installed.",
+    "",
+    "For additional support or to share feedback, please email 2424lplp@gmail.com. Response times may vary, so we appreciate your patience."
+]
+
+def wrap_text(text, text_font, max_width):
+    if text_font.size(text)[0] <= max_width:
+        return [text]
+    indent = text[:len(text) - len(text.lstrip(" "))]
+    lines = []
+    line = ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else indent + word
+        if line and text_font.size(candidate)[0] > max_width:
+            lines.append(line)
+            line = indent + word
+        else:
+            line = candidate
+    lines.append(line)
+    return lines
+
+def get_help_surface(width):
+    # The whole guide is wrapped and rasterized once per window width; scrolling
+    # only changes which slice of it is blitted.
+    global help_surface_cache
+    if help_surface_cache and help_surface_cache["width"] == width:
+        return help_surface_cache["surface"]
+    line_height = 20
+    margin = 20
+    wrapped = []
+    for line in HELP_TEXT:
+        wrapped.extend(wrap_text(line, small_font, width - margin))
+    surface = new_layer_surface((width, margin + len(wrapped) * line_height))
+    surface.fill((255, 255, 255))
+    for i, line in enumerate(wrapped):
+        if line:
+            surface.blit(small_font.render(line, True, (0, 0, 0)), (0, margin + i * line_height))
+    help_surface_cache = {"width": width, "surface": surface}
+    print(f"Rendered help text: {len(wrapped)} lines at width {width}")
+    return surface
+
+def update_scroll_momentum(dt):
+    global scroll_offset, scroll_velocity, scroll_remainder
+    if dragged_scroll:
+        return
+    if state not in ["list", "help"] or abs(scroll_velocity) < 5:
+        scroll_velocity = 0
+        scroll_remainder = 0
+        return
+    delta = scroll_velocity * dt + scroll_remainder
+    step = int(delta)
+    scroll_remainder = delta - step
+    scroll_offset += step
+    scroll_velocity *= math.exp(-SCROLL_FRICTION * dt)
+    if scroll_offset <= 0 or scroll_offset >= max_scroll:
+        scroll_offset = max(0, min(scroll_offset, max_scroll))
+        scroll_velocity = 0
+
+@profiled("draw_help_screen")
 def draw_help_screen():
     global scroll_offset, max_scroll
     screen.fill((255, 255, 255))
     canvas_width = screen.get_width() - 40
     canvas_height = screen.get_height() - 100
-    line_height = 20
     margin = 20
     mouse_pos = pygame.mouse.get_pos()
     
-    help_text = [
-        "How to Use the Virtual Touchscreen Keyboard",
-        "",
-        "This application lets you create, configure, and use a virtual touchscreen keyboard to type into applications like Google Docs, websites, or system fields (e.g., Windows search bar).",
-        "",
-        "1. Start Screen:",
-        "- 'Add Keyboard': Click to create a new keyboard layout.",
-        "- 'Save': Copies the current keyboard's JSON data to your clipboard.",
-        "- 'Load': Pastes JSON data from the clipboard to load a saved keyboard.",
-        "- 'Paste JSON code here': Click to paste JSON data for loading.",
-        "- 'Delete All Code': Clears the JSON input field.",
-        "- '?': Shows this help guide.",
-        "",
-        "2. Creating a Keyboard:",
-        "- Click 'Add Keyboard' to enter the configuration screen.",
-        "- Name your keyboard by clicking the name field and typing.",
-        "- Click 'Add Key' to create a new key (starts blank).",
-        "- Click 'Duplicate Key' to copy the selected key.",
-        "- Drag keys to position them on the left side of the screen.",
-        "- Select a key to configure it on the right panel.",
-        "",
-        "3. Configuring Keys:",
-        "- 'Tap', 'Up', 'Down', etc.: Set actions for each gesture.",
-        "  - Click a field to type a character (e.g., 'a') or special key (e.g., 'Enter').",
-        "  - Use up/down arrows to cycle through special keys (Shift, Ctrl, etc.).",
-        "  - 'Tap' sets the key's display character.",
-        "- 'Width' and 'Height': Adjust key size (20-200 pixels).",
-        "- 'Delete Key': Removes the selected key.",
-        "- 'Done': Saves the keyboard and returns to the keyboard list.",
-        "",
-        "4. Special Keys:",
-        "- Supported: Shift, Ctrl, Alt, Tab, Windows, CapsLock, Enter, Backspace, Space, Esc, Delete, Up, Down, Left, Right.",
-        "- Modifiers (Shift, Ctrl, etc.) turn blue when active.",
-        "- CapsLock toggles uppercase; other modifiers reset after a non-modifier key.",
-        "",
-        "5. Keyboard List:",
-        "- Shows all saved keyboards.",
-        "- 'Select': Use a keyboard for typing.",
-        "- 'Edit': Modify a keyboard's layout.",
-        "- 'Delete': Remove a keyboard.",
-        "- 'Duplicate': Create a copy of the keyboard.",
-        "- 'Add Keyboard', 'Save', 'Load', 'Delete All Code': Same as start screen.",
-        "- Scroll by dragging if there are many keyboards.",
-        "",
-        "6. Typing with the Keyboard:",
-        "- Select a keyboard from the list to enter typing mode.",
-        "- Click a key to perform its 'Tap' action (e.g., type 'a').",
-        "- Swipe in a direction (Up, Down, etc.) for other actions.",
-        "- Keys type into the active application, website, or system field.",
-        "- Ensure the target (e.g., Google Docs, Windows search bar) is focused before typing.",
-        "- Key actions have a 0.2-second cooldown to prevent repeats.",
-        "- The keyboard stays on top and doesn't take focus, so typing goes to the target.",
-        "- 'Back': Return to the keyboard list.",
-        "",
-        "7. Typing in Google Docs or Websites:",
-        "- Open the website (e.g., Google Docs in Chrome).",
-        "- Click into the text field to focus it.",
-        "- Use the virtual keyboard to type letters, numbers, or special keys.",
-        "- Examples: 'Enter' adds a new line, 'Tab' moves focus, 'Ctrl+C' copies text.",
-        "- Shift or CapsLock for uppercase; Ctrl for shortcuts (e.g., Ctrl+V).",
-        "",
-        "8. Typing in System Fields (e.g., Windows Search):",
-        "- Click the search bar or press Win key to focus it.",
-        "- Use the keyboard to type (e.g., 'hi' to search for 'hi').",
-        "- Special keys like 'Enter' or 'Tab' work as expected.",
-        "",
-        "9. Saving and Loading:",
-        "- 'Save': Copies the keyboard's JSON to the clipboard.",
-        "- Paste the JSON into the 'Paste JSON code here' field and click 'Load'.",
-        "- JSON includes the keyboard name and key configurations.",
-        "",
-        "10. Troubleshooting:",
-        "- Install dependencies: Run 'pip install pygame pyperclip pyautogui keyboard' (and 'pyobjc' for macOS).",
-        "- ALSA/XDG errors: Set 'SDL_AUDIODRIVER=directsound' or disable audio.",
-        "- Typing fails: Ensure the target is focused; try clicking it first.",
-        "- JSON errors: Check for valid format (must have 'name' and 'keys').",
-        "- Errors: Check the console for details; ensure all libraries are installed.",
-        "",
-        "For additional support or to share feedback, please email 2424lplp@gmail.com. Response times may vary, so we appreciate your patience."
-    ]
-    
-    total_height = len(help_text) * line_height
-    max_scroll = max(0, total_height - canvas_height + 60)
+    help_surface = get_help_surface(canvas_width)
+    max_scroll = max(0, help_surface.get_height() - margin - canvas_height + 60)
     scroll_offset = max(0, min(scroll_offset, max_scroll))
-    
-    for i, line in enumerate(help_text):
-        y = margin + i * line_height - scroll_offset
-        if y < -line_height or y > canvas_height:
-            continue
-        text_surf = small_font.render(line, True, (0, 0, 0))
-        screen.blit(text_surf, (margin, y))
+    screen.blit(help_surface, (margin, 0), pygame.Rect(0, scroll_offset, canvas_width, canvas_height + margin))
     
     back_button_rect = pygame.Rect(screen.get_width() - 120, screen.get_height() - 60, 100, 40)
     color = (255, 100, 100) if back_button_rect.collidepoint(mouse_pos) else (200, 200, 200)
     pygame.draw.rect(screen, color, back_button_rect)
     pygame.draw.rect(screen, (0, 0, 0), back_button_rect, 1)
-    text_surf = font.render("Back", True, (0, 0, 0))
+    text_surf = render_text(font, "Back", (0, 0, 0))
     text_rect = text_surf.get_rect(center=back_button_rect.center)
     screen.blit(text_surf, text_rect)
     
     if feedback_message and time.time() < feedback_timer:
-        text_surf = font.render(feedback_message, True, (255, 0, 0))
+        text_surf = render_text(font, feedback_message, (255, 0, 0))
         screen.blit(text_surf, (margin, canvas_height + 20))
     
-    pygame.display.flip()
+    present_frame()
+    return back_button_rect
+
+def get_font_cache_path():
+    if platform.system() == "Windows":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "virtual-keyboard", "fonts.json")
+
+def load_font_path_index():
+    global font_path_index_loaded
+    font_path_index_loaded = True
+    if platform.system() == "Emscripten":
+        return
+    try:
+        with open(get_font_cache_path(), "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("version") != FONT_CACHE_VERSION:
+            return
+        for name, path in cached.get("fonts", {}).items():
+            if path is None or os.path.isfile(path):
+                font_path_index[name] = path
+        print(f"Loaded {len(font_path_index)} font paths from cache")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Font cache read failed: {e}")
+
+def save_font_path_index():
+    if platform.system() == "Emscripten":
+        return
+    try:
+        cache_path = get_font_cache_path()
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": FONT_CACHE_VERSION, "fonts": font_path_index}, f)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        print(f"Font cache write failed: {e}")
+
+def resolve_font_path(name):
+    # Font discovery scans every installed font; it runs at most once per
+    # family and the answer is kept on disk for the next launch.
+    if not font_path_index_loaded:
+        load_font_path_index()
+    if name not in font_path_index:
+        try:
+            font_path_index[name] = pygame.font.match_font(name)
+        except Exception as e:
+            print(f"Font lookup failed for {name}: {e}")
+            font_path_index[name] = None
+        save_font_path_index()
+    return font_path_index[name]
+
+def get_font(size):
+    size = max(1, int(size))
+    cached_font = font_cache.get(size)
+    if cached_font is None:
+        # A None path is pygame's bundled TTF, the same fallback SysFont uses.
+        try:
+            cached_font = pygame.font.Font(resolve_font_path(FONT_FAMILY), size)
+        except Exception as e:
+            print(f"Font load failed, using bundled font: {e}")
+            cached_font = pygame.font.Font(None, size)
+        font_cache[size] = cached_font
+    return cached_font
+
+def make_view(scale, offset):
+    return {
+        "scale": scale,
+        "offset": offset,
+        "font": get_font(round(14 * scale)),
+        "small_font": get_font(round(10 * scale))
+    }
+
+def get_layout_view(size):
+    view = layout_view_cache.get(size)
+    if view is None:
+        if len(layout_view_cache) > 8:
+            layout_view_cache.clear()
+        scale = min(size[0] / LAYOUT_WIDTH, size[1] / LAYOUT_HEIGHT)
+        offset = (round((size[0] - LAYOUT_WIDTH * scale) / 2), round((size[1] - LAYOUT_HEIGHT * scale) / 2))
+        view = make_view(scale, offset)
+        layout_view_cache[size] = view
+    return view
+
+def scale_length(length, view):
+    return round(length * view["scale"])
+
+def layout_to_screen_rect(x, y, width, height, view):
+    scale = view["scale"]
+    return pygame.Rect(round(view["offset"][0] + x * scale), round(view["offset"][1] + y * scale),
+                       round(width * scale), round(height * scale))
+
+def key_screen_rect(key, view):
+    return layout_to_screen_rect(key["x"], key["y"], key["width"], key["height"], view)
+
+def screen_to_layout(pos, view):
+    return ((pos[0] - view["offset"][0]) / view["scale"], (pos[1] - view["offset"][1]) / view["scale"])
+
+def build_hit_grid(keys):
+    # Key indices per grid cell, in list order, so the first hit matches a linear scan.
+    hit_grid = {}
+    for index, key in enumerate(keys):
+        for cell_x in range(int(key["x"] // HIT_GRID_CELL), int((key["x"] + key["width"]) // HIT_GRID_CELL) + 1):
+            for cell_y in range(int(key["y"] // HIT_GRID_CELL), int((key["y"] + key["height"]) // HIT_GRID_CELL) + 1):
+                hit_grid.setdefault((cell_x, cell_y), []).append(index)
+    return hit_grid
+
+def find_key_at(keys, layout_pos, hit_grid=None):
+    if hit_grid is None:
+        candidates = keys
+    else:
+        candidates = [keys[index] for index in hit_grid.get((int(layout_pos[0] // HIT_GRID_CELL), int(layout_pos[1] // HIT_GRID_CELL)), ())]
+    for key in candidates:
+        if (key["x"] <= layout_pos[0] <= key["x"] + key["width"] and
+            key["y"] <= layout_pos[1] <= key["y"] + key["height"]):
+            return key
+    return None
+
+def find_keys_in_rect(keys, rect, hit_grid=None):
+    # Every key touching a layout-space rect, in list order.
+    x, y, width, height = rect
+    if hit_grid is None:
+        indices = range(len(keys))
+    else:
+        indices = sorted({index
+                          for cell_x in range(int(x // HIT_GRID_CELL), int((x + width) // HIT_GRID_CELL) + 1)
+                          for cell_y in range(int(y // HIT_GRID_CELL), int((y + height) // HIT_GRID_CELL) + 1)
+                          for index in hit_grid.get((cell_x, cell_y), ())})
+    found = []
+    for index in indices:
+        key = keys[index]
+        if (key["x"] <= x + width and x <= key["x"] + key["width"] and
+            key["y"] <= y + height and y <= key["y"] + key["height"]):
+            found.append(key)
+    return found
+
+def normalize_keyboard_layout(keyboard_data):
+    layout_size = keyboard_data.pop("layout_size", None)
+    if not layout_size or tuple(layout_size) == (LAYOUT_WIDTH, LAYOUT_HEIGHT):
+        return keyboard_data
+    scale = min(LAYOUT_WIDTH / layout_size[0], LAYOUT_HEIGHT / layout_size[1])
+    for keys in [keyboard_data["keys"]] + list(keyboard_data.get("layers", {}).values()):
+        for key in keys:
+            for field in ["x", "y", "width", "height"]:
+                key[field] = round(key[field] * scale)
+    print(f"Rescaled layout from {layout_size[0]}x{layout_size[1]} by {scale:.3f}")
+    return keyboard_data
+
+def validate_keyboard_json(keyboard_data):
+    if not isinstance(keyboard_data, dict):
+        return "Must be an object"
+    if "name" not in keyboard_data or "keys" not in keyboard_data:
+        return "Missing 'name' or 'keys'"
+    if not isinstance(keyboard_data["keys"], list):
+        return "'keys' must be a list"
+    layers = keyboard_data.get("layers", {})
+    if not isinstance(layers, dict) or not all(name in LAYER_NAMES[1:] and isinstance(keys, list) for name, keys in layers.items()):
+        return "bad 'layers'"
+    return None
+
+# Layout specs describe a keyboard row by row, one token per key:
+#   label[/up/down/left/right/up-left/up-right/down-left/down-right][:width]
+# Swipe actions after the label are positional, or named with u=, d=, l=, r=,
+# ul=, ur=, dl= and dr=; "^" stands for the label in upper case. ~ is an empty
+# gap, {1..12} or {a..z} expands one token into many, @name inserts a template
+# defined with "template name = tokens", and a backslash makes the next
+# character literal. "row:height*count tokens" adds rows; widths and heights
+# are in units, which include the gap between the keys they span.
+LAYOUT_SPEC_SUFFIX = ".kbd"
+SPEC_DIRECTION_CODES = {"u": "Up", "d": "Down", "l": "Left", "r": "Right",
+                        "ul": "Up-Left", "ur": "Up-Right", "dl": "Down-Left", "dr": "Down-Right"}
+SPEC_RANGE = re.compile(r"\{(\w+|[^\s{}])\.\.(\w+|[^\s{}])\}")
+# Keys across the base layout and its layers; ranges, templates and repeated
+# rows are checked against it before they are expanded.
+SPEC_KEY_LIMIT = 10000
+
+def escape_spec_text(text):
+    # Escaped characters are parked in a private-use plane until the line has
+    # been split, so they never count as separators.
+    return re.sub(r"\\(.)", lambda match: chr(0xF0000 + ord(match.group(1))), text)
+
+def unescape_spec_text(text):
+    return re.sub("[\U000F0000-\U000FFFFF]", lambda match: chr(ord(match.group(0)) - 0xF0000), text)
+
+def expand_spec_ranges(token):
+    ranges = SPEC_RANGE.findall(token)
+    if not ranges:
+        return [token]
+    values = []
+    for start, end in ranges:
+        if start.isdigit() and end.isdigit():
+            if abs(int(end) - int(start)) >= SPEC_KEY_LIMIT:
+                raise ValueError(f"range {{{start}..{end}}} has more than {SPEC_KEY_LIMIT} keys")
+            step = 1 if int(end) >= int(start) else -1
+            values.append([str(value) for value in range(int(start), int(end) + step, step)])
+        elif len(start) == 1 and len(end) == 1:
+            step = 1 if end >= start else -1
+            values.append([chr(value) for value in range(ord(start), ord(end) + step, step)])
+        else:
+            raise ValueError(f"bad range {{{start}..{end}}}")
+    if len({len(items) for items in values}) > 1:
+        raise ValueError(f"ranges in {token!r} differ in length")
+    # Several ranges in one token advance together.
+    expanded = []
+    for items in zip(*values):
+        parts = iter(items)
+        expanded.append(SPEC_RANGE.sub(lambda match: next(parts), token))
+    return expanded
+
+def parse_spec_key(token):
+    # Returns (width, label, actions), with label None for a gap.
+    width = 1.0
+    head, separator, tail = token.rpartition(":")
+    if separator and head:
+        try:
+            width = float(tail)
+            token = head
+        except ValueError:
+            pass
+    if token == "~":
+        return (width, None, None)
+    segments = token.split("/")
+    label = unescape_spec_text(segments[0])
+    actions = dict.fromkeys(DIRECTIONS, "")
+    actions["Tap"] = label
+    for position, segment in enumerate(segments[1:]):
+        code, equals, value = segment.partition("=")
+        if equals and code in SPEC_DIRECTION_CODES:
+            direction = SPEC_DIRECTION_CODES[code]
+        elif position + 1 < len(DIRECTIONS):
+            direction, value = DIRECTIONS[position + 1], segment
+        else:
+            raise ValueError(f"too many actions in {token!r}")
+        actions[direction] = label.upper() if value == "^" else unescape_spec_text(value)
+    return (width, label, actions)
+
+def compile_layout_spec(text):
+    # Compiles a layout spec into the same {"name", "keys"} structure a saved
+    # keyboard has. Parsed tokens are cached, so repeated keys and rows cost a
+    # dict copy each.
+    name = "Untitled"
+    unit_width, unit_height = 40.0, 40.0
+    gap = 4.0
+    origin_x, origin_y = 0.0, 0.0
+    templates = {}
+    parsed_tokens = {}
+    keys = []
+    layers = {}
+    current_keys = keys
+    key_count = 0
+    y = origin_y
+    right = bottom = 0
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            escaped = "\\" in line
+            if escaped:
+                line = escape_spec_text(line)
+            words = line.split()
+            directive = words[0]
+            if directive == "name":
+                name = unescape_spec_text(line[4:].strip()) if escaped else line[4:].strip()
+            elif directive == "unit":
+                unit_width = float(words[1])
+                unit_height = float(words[2]) if len(words) > 2 else unit_width
+            elif directive == "gap":
+                gap = float(words[1])
+            elif directive == "origin":
+                origin_x, origin_y = float(words[1]), float(words[2])
+                y = origin_y
+            elif directive == "space":
+                y += float(words[1]) * (unit_height + gap)
+            elif directive == "layer":
+                if words[1] not in LAYER_NAMES[1:]:
+                    raise ValueError(f"layer must be one of {LAYER_NAMES[1:]}")
+                current_keys = layers.setdefault(words[1], [])
+                y = origin_y
+            elif directive == "template":
+                tokens = []
+                for token in words[3:] if words[2:3] == ["="] else words[2:]:
+                    tokens.extend(templates[token[1:]] if token.startswith("@") else expand_spec_ranges(token))
+                    if len(tokens) > SPEC_KEY_LIMIT:
+                        raise ValueError(f"template {words[1]!r} has more than {SPEC_KEY_LIMIT} keys")
+                templates[words[1]] = tokens
+            elif directive.startswith("row"):
+                options, star, repeat = directive[3:].partition("*")
+                if options and not options.startswith(":"):
+                    raise ValueError(f"unknown directive {directive!r}")
+                try:
+                    height = float(options[1:]) if options else 1.0
+                except ValueError:
+                    raise ValueError(f"bad row height {options[1:]!r} in {directive!r}")
+                if not (math.isfinite(height) and height > 0):
+                    raise ValueError(f"row height must be a positive number, not {options[1:]!r}")
+                if star and not repeat.isdigit():
+                    raise ValueError(f"bad row count {repeat!r} in {directive!r}")
+                count = int(repeat) if star else 1
+                row = []
+                for token in words[1:]:
+                    for expanded in (templates[token[1:]] if token.startswith("@") else expand_spec_ranges(token)):
+                        parsed = parsed_tokens.get(expanded)
+                        if parsed is None:
+                            parsed = parsed_tokens[expanded] = parse_spec_key(expanded)
+                        row.append(parsed)
+                    if len(row) > SPEC_KEY_LIMIT:
+                        raise ValueError(f"row has more than {SPEC_KEY_LIMIT} keys")
+                labelled = sum(1 for _, label, _ in row if label is not None)
+                key_count += labelled * count
+                if key_count > SPEC_KEY_LIMIT:
+                    raise ValueError(f"more than {SPEC_KEY_LIMIT} keys")
+                key_height = height * (unit_height + gap) - gap
+                for _ in range(count):
+                    x = origin_x
+                    top = round(y)
+                    key_bottom = round(y + key_height)
+                    for width, label, actions in row:
+                        span = width * (unit_width + gap)
+                        if label is not None:
+                            left = round(x)
+                            key_right = round(x + span - gap)
+                            current_keys.append({"char": label, "x": left, "y": top, "width": key_right - left,
+                                                 "height": key_bottom - top, "actions": dict(actions)})
+                            right = max(right, key_right)
+                        x += span
+                    bottom = max(bottom, key_bottom)
+                    y += height * (unit_height + gap)
+            else:
+                raise ValueError(f"unknown directive {directive!r}")
+        except KeyError as e:
+            raise ValueError(f"line {line_number}: unknown template {e.args[0]!r}")
+        except IndexError:
+            raise ValueError(f"line {line_number}: missing value for {words[0]!r}")
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}")
+    keyboard_data = {"name": name, "keys": keys}
+    if layers:
+        keyboard_data["layers"] = layers
+    # A spec bigger than the layout space is scaled down to fit on load.
+    if right > LAYOUT_WIDTH or bottom > LAYOUT_HEIGHT:
+        keyboard_data["layout_size"] = [max(LAYOUT_WIDTH, right), max(LAYOUT_HEIGHT, bottom)]
+    return keyboard_data
+
+def parse_keyboard_text(text):
+    # Pasted or loaded text is a saved keyboard if it is a JSON object and a
+    # layout spec otherwise.
+    if text.lstrip().startswith("{"):
+        return json.loads(text)
+    return compile_layout_spec(text)
+
+def keyboard_to_json(keyboard_data):
+    json_data = {"name": keyboard_data["name"], "layout_size": [LAYOUT_WIDTH, LAYOUT_HEIGHT], "keys": keyboard_data["keys"]}
+    if keyboard_data.get("layers"):
+        json_data["layers"] = keyboard_data["layers"]
+    return json_data
+
+def get_key_label_color(key_label):
+    if key_label in MODIFIER_KEYS and (active_modifiers.get(key_label, False) or (key_label == "CapsLock" and caps_lock_active)):
+        return (0, 0, 255)
+    return (0, 0, 0)
+
+def render_action_label(action_text, view):
+    max_width = scale_length(80, view)
+    text = view["small_font"].render(action_text, True, (0, 0, 0))
+    if text.get_width() > max_width:
+        font_size = max(round(6 * view["scale"]), int(10 * view["scale"] * max_width / text.get_width()))
+        text = get_font(font_size).render(action_text, True, (0, 0, 0))
+    return text
+
+def get_action_label_base(key_rect, direction, view):
+    near = scale_length(4, view)
+    far = scale_length(8, view)
+    if direction == "Up":
+        return (key_rect.centerx, key_rect.y - far)
+    elif direction == "Down":
+        return (key_rect.centerx, key_rect.bottom + far)
+    elif direction == "Left":
+        return (key_rect.x - near, key_rect.centery)
+    elif direction == "Right":
+        return (key_rect.right + near, key_rect.centery)
+    elif direction == "Up-Left":
+        return (key_rect.x - near, key_rect.y - near)
+    elif direction == "Up-Right":
+        return (key_rect.right + near, key_rect.y - near)
+    elif direction == "Down-Left":
+        return (key_rect.x - near, key_rect.bottom + near)
+    return (key_rect.right + near, key_rect.bottom + near)
+
+def label_cells(rect):
+    for cell_x in range(rect.left // LABEL_GRID_CELL, max(rect.left, rect.right - 1) // LABEL_GRID_CELL + 1):
+        for cell_y in range(rect.top // LABEL_GRID_CELL, max(rect.top, rect.bottom - 1) // LABEL_GRID_CELL + 1):
+            yield (cell_x, cell_y)
+
+def add_label_rect(label_grid, rect):
+    for cell in label_cells(rect):
+        label_grid.setdefault(cell, []).append(rect)
+
+def label_collides(label_grid, rect):
+    # Placed labels are bucketed by grid cell so a collision check only looks
+    # at neighbours instead of every label on the layout.
+    for cell in label_cells(rect):
+        candidates = label_grid.get(cell)
+        if candidates and rect.collidelist(candidates) != -1:
+            return True
+    return False
+
+@profiled("place_action_label")
+def place_action_label(text, key_rect, direction, view, label_grid):
+    anchor, offset_dir = ACTION_LABEL_ANCHORS[direction]
+    base_pos = get_action_label_base(key_rect, direction, view)
+    text_rect = text.get_rect(**{anchor: base_pos})
+    step = 5 * view["scale"]
+    offset = 0
+    max_offset = 50 * view["scale"]
+    while offset < max_offset:
+        if not label_collides(label_grid, text_rect):
+            break
+        offset += step
+        new_pos = (base_pos[0] + round(offset * offset_dir[0]), base_pos[1] + round(offset * offset_dir[1]))
+        text_rect = text.get_rect(**{anchor: new_pos})
+    return text_rect
+
+def get_label_text(text_cache, text_key, view):
+    text = text_cache.get(text_key)
+    if text is None:
+        if text_key[0] == "char":
+            text = view["font"].render(text_key[1], True, text_key[2])
+        else:
+            text = render_action_label(text_key[1], view)
+        text_cache[text_key] = text
+    return text
+
+def place_key_labels(key, view, text_cache, label_grid, modifier_captions=True):
+    key_rect = key_screen_rect(key, view)
+    key_label = key["char"] or " "
+    text_key = ("char", key_label, get_key_label_color(key_label))
+    text = get_label_text(text_cache, text_key, view)
+    text_rect = text.get_rect(center=key_rect.center)
+    # A hidden caption still keeps swipe labels off its space.
+    labels = [(text_key, text if modifier_captions or key_label not in MODIFIER_KEYS else None, text_rect)]
+    add_label_rect(label_grid, text_rect)
+    for direction in DIRECTIONS[1:]:
+        action_text = key["actions"][direction]
+        if not action_text:
+            continue
+        text_key = ("action", action_text)
+        text = get_label_text(text_cache, text_key, view)
+        text_rect = place_action_label(text, key_rect, direction, view, label_grid)
+        labels.append((text_key, text, text_rect))
+        add_label_rect(label_grid, text_rect)
+    return (key_rect, labels)
+
+def layout_key_labels(keys, view, text_cache, modifier_captions=True):
+    # Where every key and label goes, in drawing order. A label's position
+    # depends on the labels placed before it, so the keys are walked in order.
+    label_grid = {}
+    return [place_key_labels(key, view, text_cache, label_grid, modifier_captions) for key in keys]
+
+def get_label_reach(key, view, text_cache):
+    # Every position place_action_label() might try for this key's labels.
+    key_rect = key_screen_rect(key, view)
+    max_offset = 50 * view["scale"]
+    reach = []
+    for direction in DIRECTIONS[1:]:
+        action_text = key["actions"][direction]
+        if not action_text:
+            continue
+        text = get_label_text(text_cache, ("action", action_text), view)
+        anchor, offset_dir = ACTION_LABEL_ANCHORS[direction]
+        base_pos = get_action_label_base(key_rect, direction, view)
+        far_pos = (base_pos[0] + round(max_offset * offset_dir[0]), base_pos[1] + round(max_offset * offset_dir[1]))
+        reach.append(text.get_rect(**{anchor: base_pos}).union(text.get_rect(**{anchor: far_pos})))
+    return reach
+
+def relayout_key_labels(keys, view, text_cache, old_layout, changed, modifier_captions=True):
+    # Labels are placed again only for keys that changed or that could land
+    # on a label that moved; every other entry is reused. Returns the new
+    # layout and the screen areas that now look different.
+    label_grid = {}
+    moved_grid = {}
+    dirty = []
+    new_layout = []
+    changed = set(changed)
+    for index, key in enumerate(keys):
+        old_entry = old_layout[index] if index < len(old_layout) else None
+        if old_entry is not None and index not in changed and (not moved_grid or
+                not any(label_collides(moved_grid, rect) for rect in get_label_reach(key, view, text_cache))):
+            for text_key, text, text_rect in old_entry[1]:
+                add_label_rect(label_grid, text_rect)
+            new_layout.append(old_entry)
+            continue
+        entry = place_key_labels(key, view, text_cache, label_grid, modifier_captions)
+        new_layout.append(entry)
+        if old_entry is not None and old_entry[0] == entry[0] and \
+                [(text_key, text_rect) for text_key, text, text_rect in old_entry[1]] == [(text_key, text_rect) for text_key, text, text_rect in entry[1]]:
+            continue
+        for layout_entry in [old_entry, entry]:
+            if layout_entry is not None:
+                dirty.append(layout_entry[0])
+                for text_key, text, text_rect in layout_entry[1]:
+                    dirty.append(text_rect)
+                    add_label_rect(moved_grid, text_rect)
+    for old_entry in old_layout[len(keys):]:
+        dirty.append(old_entry[0])
+        dirty.extend(text_rect for text_key, text, text_rect in old_entry[1])
+    return new_layout, dirty
+
+def draw_key_rect(surface, key_rect, color):
+    pygame.draw.rect(surface, color, key_rect)
+    # Same pixels as draw.rect(..., 1), but draw.rect outlines the clipped rect
+    # rather than clipping the outline, which would break clipped redraws.
+    pygame.draw.lines(surface, (0, 0, 0), True, [key_rect.topleft, (key_rect.right - 1, key_rect.top),
+                                                  (key_rect.right - 1, key_rect.bottom - 1), (key_rect.left, key_rect.bottom - 1)])
+
+def draw_key_entries(surface, keys, entries, highlighted_keys=()):
+    highlighted = {id(key) for key in highlighted_keys}
+    for key, (key_rect, labels) in zip(keys, entries):
+        draw_key_rect(surface, key_rect, (100, 100, 255) if id(key) in highlighted else (200, 200, 200))
+        for text_key, text, text_rect in labels:
+            if text is not None:
+                surface.blit(text, text_rect)
+
+@profiled("draw_keys")
+def draw_keys(surface, keys, view, highlighted_keys=(), modifier_captions=True, text_cache=None):
+    entries = layout_key_labels(keys, view, {} if text_cache is None else text_cache, modifier_captions)
+    draw_key_entries(surface, keys, entries, highlighted_keys)
+    return entries
+
+LINT_KINDS = ["bounds", "overlap", "unreachable", "label"]
+
+def update_interval_tree(tree, edges, size, top, bottom, index, add):
+    # Segment tree over the gaps between sorted y edges: an interval is kept
+    # in the O(log n) nodes that exactly cover it.
+    low = bisect.bisect_left(edges, top) + size
+    high = bisect.bisect_left(edges, bottom) + size
+    nodes = []
+    while low < high:
+        if low & 1:
+            nodes.append(low)
+            low += 1
+        if high & 1:
+            high -= 1
+            nodes.append(high)
+        low >>= 1
+        high >>= 1
+    for node in nodes:
+        if add:
+            tree.setdefault(node, set()).add(index)
+        else:
+            tree[node].discard(index)
+
+def find_rect_overlaps(rects, others=None):
+    # Sweep line over x: rects enter by left edge and leave once the sweep
+    # passes their right edge. Each list's active rects are kept ordered by
+    # y-interval twice over: a segment tree finds those containing a new
+    # rect's top edge, and a list sorted by top edge finds those starting
+    # inside it. Only overlapping rects are ever visited, so k pairs cost
+    # O((n + k) log n). Returns the (index, other_index) pairs that share area,
+    # within rects or, given others, between rects and others.
+    groups = [rects] if others is None else [rects, others]
+    edges = sorted({edge for group_rects in groups for x, y, width, height in group_rects
+                    if width > 0 and height > 0 for edge in (y, y + height)})
+    size = 1
+    while size < len(edges):
+        size *= 2
+    trees = [{} for _ in groups]
+    tops = [[] for _ in groups]
+    events = sorted((rect[0], group, index) for group, group_rects in enumerate(groups) for index, rect in enumerate(group_rects))
+    leaving = []
+    pairs = []
+    for left, group, index in events:
+        x, y, width, height = groups[group][index]
+        if width <= 0 or height <= 0:
+            continue
+        while leaving and leaving[0][0] <= left:
+            right, old_group, top, old_index = heapq.heappop(leaving)
+            del tops[old_group][bisect.bisect_left(tops[old_group], (top, old_index))]
+            update_interval_tree(trees[old_group], edges, size, top, top + groups[old_group][old_index][3], old_index, False)
+        other_group = len(groups) - 1 - group
+        found = []
+        node = bisect.bisect_left(edges, y) + size
+        while node:
+            found.extend(trees[other_group].get(node, ()))
+            node >>= 1
+        other_tops = tops[other_group]
+        start = bisect.bisect_right(other_tops, (y, math.inf))
+        end = bisect.bisect_left(other_tops, (y + height, -1))
+        found.extend(other_index for top, other_index in other_tops[start:end])
+        for other_index in found:
+            if others is None:
+                pairs.append((min(index, other_index), max(index, other_index)))
+            else:
+                pairs.append((index, other_index) if group == 0 else (other_index, index))
+        bisect.insort(tops[group], (y, index))
+        update_interval_tree(trees[group], edges, size, y, y + height, index, True)
+        heapq.heappush(leaving, (x + width, group, y, index))
+    return pairs
+
+def rect_covered(rect, covers):
+    # The rect is cut along every cover edge that crosses it; it is hidden
+    # when some cover contains the middle of every piece.
+    x, y, width, height = rect
+    xs = sorted({x, x + width} | {edge for cover in covers for edge in (cover[0], cover[0] + cover[2]) if x < edge < x + width})
+    ys = sorted({y, y + height} | {edge for cover in covers for edge in (cover[1], cover[1] + cover[3]) if y < edge < y + height})
+    for left, right in zip(xs, xs[1:]):
+        for top, bottom in zip(ys, ys[1:]):
+            middle_x = (left + right) / 2
+            middle_y = (top + bottom) / 2
+            if not any(cover[0] <= middle_x <= cover[0] + cover[2] and cover[1] <= middle_y <= cover[1] + cover[3] for cover in covers):
+                return False
+    return True
+
+def describe_lint_key(index, key):
+    return f"key {index} ({key['char']!r})"
+
+def lint_keyboard_layout(keyboard_data):
+    # Geometry problems that the editor allows but the keyboard can't show or
+    # hit properly. Overlaps come from find_rect_overlaps(), so a layout costs
+    # O(n log n) plus the label placement the keyboard screen does anyway.
+    issues = []
+    layout_rect = pygame.Rect(0, 0, LAYOUT_WIDTH, LAYOUT_HEIGHT)
+    view = make_view(1, (0, 0))
+    text_cache = {}
+    for layer_name in LAYER_NAMES:
+        keys = get_layer_keys(keyboard_data, layer_name)
+        if not keys:
+            continue
+
+        def add_issue(kind, indices, message):
+            issues.append({"kind": kind, "layer": layer_name, "keys": indices, "message": message})
+        rects = [(key["x"], key["y"], key["width"], key["height"]) for key in keys]
+        for index, (x, y, width, height) in enumerate(rects):
+            if width <= 0 or height <= 0:
+                add_issue("bounds", [index], f"{describe_lint_key(index, keys[index])} has no area ({width}x{height})")
+            elif x < 0 or y < 0 or x + width > LAYOUT_WIDTH or y + height > LAYOUT_HEIGHT:
+                add_issue("bounds", [index], f"{describe_lint_key(index, keys[index])} is outside the {LAYOUT_WIDTH}x{LAYOUT_HEIGHT} layout")
+        # find_key_at() returns the first key in list order, so a key whose
+        # whole area is under earlier keys can never be hit.
+        covers = {}
+        for first, second in sorted(find_rect_overlaps(rects)):
+            add_issue("overlap", [first, second], f"{describe_lint_key(first, keys[first])} overlaps {describe_lint_key(second, keys[second])}")
+            covers.setdefault(second, []).append(rects[first])
+        for index in sorted(covers):
+            if rect_covered(rects[index], covers[index]):
+                add_issue("unreachable", [index], f"{describe_lint_key(index, keys[index])} is hidden under earlier keys and can't be pressed")
+        # Swipe labels go where the keyboard screen would place them; the
+        # caption is centred on its own key and skipped.
+        labels = []
+        for index, (key_rect, entries) in enumerate(layout_key_labels(keys, view, text_cache)):
+            for text_key, text, text_rect in entries[1:]:
+                labels.append((index, text_key[1], text_rect))
+                if not layout_rect.contains(text_rect):
+                    add_issue("bounds", [index], f"{describe_lint_key(index, keys[index])} swipe label {text_key[1]!r} is off-screen")
+        for label_index, key_index in sorted(find_rect_overlaps([tuple(text_rect) for index, action_text, text_rect in labels], rects)):
+            index, action_text, text_rect = labels[label_index]
+            if index != key_index:
+                # Keys are drawn in list order, so a later key paints over the label.
+                where = "under" if key_index > index else "over"
+                add_issue("label", [index, key_index], f"{describe_lint_key(index, keys[index])} swipe label {action_text!r} is drawn {where} {describe_lint_key(key_index, keys[key_index])}")
+    return issues
+
+def summarize_layout_lint(issues):
+    counts = {kind: 0 for kind in LINT_KINDS}
+    for issue in issues:
+        counts[issue["kind"]] += 1
+    return ", ".join(f"{count} {kind}" for kind, count in counts.items() if count)
+
+def report_layout_lint(keyboard_data, context):
+    # Prints every issue and returns the short summary for the feedback line.
+    # Only explicit loads and saves lint; placing the labels takes long enough
+    # that --layouts-dir reloads skip it to keep their frames smooth.
+    issues = lint_keyboard_layout(keyboard_data)
+    for issue in issues:
+        print(f"Lint ({context}) {keyboard_data['name']!r} {issue['layer']}: {issue['message']}")
+    return summarize_layout_lint(issues)
+
+def lint_layout_files(paths):
+    global font_cache, active_modifiers, caps_lock_active
+    # Command line lint: labels only need fonts, so no window is opened.
+    pygame.font.init()
+    font_cache = {}
+    active_modifiers = {}
+    caps_lock_active = False
+    failed = False
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                keyboard_data = parse_keyboard_text(f.read())
+            error = validate_keyboard_json(keyboard_data)
+            if error:
+                raise ValueError(error)
+            issues = lint_keyboard_layout(normalize_keyboard_layout(keyboard_data))
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}")
+            failed = True
+            continue
+        for issue in issues:
+            print(f"{path}: {issue['layer']}: {issue['kind']}: {issue['message']}")
+        print(f"{path}: {summarize_layout_lint(issues) or 'no issues'}")
+        failed = failed or bool(issues)
+    return 1 if failed else 0
+
+def get_key_patch(layer, key, pressed):
+    view = layer["view"]
+    key_label = key["char"] or " "
+    label_color = get_key_label_color(key_label)
+    patch_id = (id(key), pressed, label_color)
+    patch = layer["patches"].get(patch_id)
+    if patch is None:
+        surface = layer["surface"]
+        key_rect = key_screen_rect(key, view)
+        caption_rect = view["font"].render(key_label, True, label_color).get_rect(center=key_rect.center)
+        patch_rect = key_rect.union(caption_rect).clip(surface.get_rect())
+        if not patch_rect.width or not patch_rect.height:
+            return None
+        # Redraw the baked entries under this key, clipped and in layout order,
+        # so overlapping labels stack exactly as in a full redraw, then keep
+        # only that patch.
+        label_layout_grid = get_label_layout_grid(layer)
+        indices = sorted({index for cell in label_cells(patch_rect) for index in label_layout_grid.get(cell, ())})
+        entries = []
+        for index in indices:
+            key_rect, labels = layer["label_layout"][index]
+            # Captions take the current modifier colour, and the modifier
+            # captions left out of the bake are drawn.
+            text_key = ("char", labels[0][0][1], get_key_label_color(labels[0][0][1]))
+            caption = (text_key, get_label_text(layer["text_cache"], text_key, view), labels[0][2])
+            entries.append((key_rect, [caption] + labels[1:]))
+        saved = surface.subsurface(patch_rect).copy()
+        surface.set_clip(patch_rect)
+        surface.fill((255, 255, 255))
+        draw_key_entries(surface, [layer["keys"][index] for index in indices], entries, [key] if pressed else ())
+        surface.set_clip(None)
+        patch = (surface.subsurface(patch_rect).copy(), patch_rect)
+        surface.blit(saved, patch_rect)
+        layer["patches"][patch_id] = patch
+    return patch
+
+def get_label_layout_grid(layer):
+    # Indices of the label layout entries whose key or labels touch each label
+    # grid cell, built on the first key patch of a layer.
+    label_layout_grid = layer.get("label_layout_grid")
+    if label_layout_grid is None:
+        label_layout_grid = {}
+        for index, (key_rect, labels) in enumerate(layer["label_layout"]):
+            for rect in [key_rect] + [text_rect for text_key, text, text_rect in labels]:
+                for cell in label_cells(rect):
+                    label_layout_grid.setdefault(cell, []).append(index)
+        layer["label_layout_grid"] = label_layout_grid
+    return label_layout_grid
+
+def invalidate_keyboard_layer(keyboard_data=None):
+    if keyboard_data is None:
+        keyboard_layer_cache.clear()
+    else:
+        for cache_key in [cache_key for cache_key in keyboard_layer_cache if cache_key[0] == keyboard_data["id"]]:
+            del keyboard_layer_cache[cache_key]
+    texture_cache.clear()
+
+def get_resize_preview(layer, size, view):
+    # While the window edge is being dragged, stretch the last bake instead of
+    # rebaking on every VIDEORESIZE; the real bake happens once resizing settles.
+    preview = layer.get("preview")
+    if preview is None or preview["size"] != size:
+        ratio = view["scale"] / layer["view"]["scale"]
+        old_offset = layer["view"]["offset"]
+        stretched_size = (max(1, round(layer["size"][0] * ratio)), max(1, round(layer["size"][1] * ratio)))
+        surface = new_layer_surface(size)
+        surface.fill((255, 255, 255))
+        surface.blit(pygame.transform.scale(layer["surface"], stretched_size),
+                     (view["offset"][0] - round(old_offset[0] * ratio), view["offset"][1] - round(old_offset[1] * ratio)))
+        preview = {
+            "size": size,
+            "view": view,
+            "keys": layer["keys"],
+            "surface": surface,
+            "back_button_rect": layout_to_screen_rect(650, 365, 100, 20, view),
+            "hit_grid": layer["hit_grid"],
+            "tap_only": layer["tap_only"],
+            "modifier_keys": [],
+            "patches": None
+        }
+        layer["preview"] = preview
+    return preview
+
+def draw_keyboard_layer_chrome(surface, keyboard_data, layer_name, view):
+    back_button_rect = layout_to_screen_rect(650, 365, 100, 20, view)
+    pygame.draw.rect(surface, (255, 100, 100), back_button_rect)
+    pygame.draw.rect(surface, (0, 0, 0), back_button_rect, 1)
+    text = view["font"].render("Back", True, (0, 0, 0))
+    text_rect = text.get_rect(center=back_button_rect.center)
+    surface.blit(text, text_rect)
+    if keyboard_data.get("layers"):
+        text = view["font"].render(f"Layer: {layer_name}", True, (0, 0, 0))
+        surface.blit(text, text.get_rect(midright=layout_to_screen_rect(640, 375, 0, 0, view).topleft))
     return back_button_rect
 
+def get_keyboard_layer(keyboard_data, layer_name="base"):
+    # Static keys, captions and swipe labels are baked once per layout, keyboard
+    # layer and window size; draw_keyboard() only blits this and paints the
+    # pressed/modifier keys on top.
+    size = screen.get_size()
+    view = get_layout_view(size)
+    keys = get_layer_keys(keyboard_data, layer_name)
+    cache_key = (keyboard_data["id"], layer_name)
+    layer = keyboard_layer_cache.get(cache_key)
+    if layer and layer["keys"] is keys:
+        if layer["size"] == size:
+            count_cache("layer", True)
+            return layer
+        if time.time() - last_resize_time < RESIZE_SETTLE_DELAY:
+            return get_resize_preview(layer, size, view)
+    
+    count_cache("layer", False)
+    surface = new_layer_surface(size)
+    surface.fill((255, 255, 255))
+    text_cache = {}
+    label_layout = draw_keys(surface, keys, view, modifier_captions=False, text_cache=text_cache)
+    back_button_rect = draw_keyboard_layer_chrome(surface, keyboard_data, layer_name, view)
+    
+    layer = {
+        "size": size,
+        "view": view,
+        "keys": keys,
+        "surface": surface,
+        "back_button_rect": back_button_rect,
+        "hit_grid": layer["hit_grid"] if layer and layer["keys"] is keys else build_hit_grid(keys),
+        # Keys with no swipe actions can only ever tap, so they are sent on press.
+        "tap_only": {id(key) for key in keys if not any(key["actions"].get(direction) for direction in DIRECTIONS[1:])},
+        "modifier_keys": [key for key in keys if key["char"] in MODIFIER_KEYS],
+        "text_cache": text_cache,
+        "label_layout": label_layout,
+        "patches": {}
+    }
+    keyboard_layer_cache[cache_key] = layer
+    texture_cache.clear()
+    print(f"Baked keyboard layer '{layer_name}' for '{keyboard_data['name']}' at {size[0]}x{size[1]}")
+    return layer
+
+def prebake_keyboard_layers(keyboard_data):
+    # Every layer is baked as soon as the active one is, so a layer flip is a
+    # cache hit and a single blit.
+    for layer_name in ["base"] + list(keyboard_data.get("layers", {})):
+        get_keyboard_layer(keyboard_data, layer_name)
+
+def get_selected_keys():
+    # The key being configured is always part of the selection. Keys come back
+    # in list order, and keys no longer in the layout are left out.
+    return [key for key in current_keys if key is configuring_key or key_selection.get(id(key)) is key]
+
+def focus_configuring_key(key):
+    global configuring_key, label_buffer, action_texts, text_active, active_input
+    configuring_key = key
+    label_buffer = TextBuffer()
+    action_texts = {direction: key["actions"][direction] for direction in DIRECTIONS} if key else {}
+    text_active = False
+    active_input = None
+
+def get_keys_bounds(keys):
+    return (min(key["x"] for key in keys), min(key["y"] for key in keys),
+            max(key["x"] + key["width"] for key in keys), max(key["y"] + key["height"] for key in keys))
+
+def clamp_keys_offset(bounds, dx, dy):
+    # Keys move as one block, which stops as a whole at the layout edge.
+    left, top, right, bottom = bounds
+    return (max(-left, min(dx, LAYOUT_WIDTH - right)), max(-top, min(dy, LAYOUT_HEIGHT - bottom)))
+
+def nudge_keys(keys, dx, dy):
+    if keys:
+        dx, dy = clamp_keys_offset(get_keys_bounds(keys), dx, dy)
+        for key in keys:
+            key["x"] += dx
+            key["y"] += dy
+
+def arrange_keys(keys, action):
+    if action == "align_left":
+        left = min(key["x"] for key in keys)
+        for key in keys:
+            key["x"] = left
+    elif action == "align_top":
+        top = min(key["y"] for key in keys)
+        for key in keys:
+            key["y"] = top
+    elif len(keys) > 2:
+        # The outermost keys stay put and the gaps between the rest are evened out.
+        axis, size = ("x", "width") if action == "distribute_x" else ("y", "height")
+        keys = sorted(keys, key=lambda item: item[axis])
+        span = keys[-1][axis] + keys[-1][size] - keys[0][axis]
+        gap = (span - sum(key[size] for key in keys)) / (len(keys) - 1)
+        position = keys[0][axis]
+        for key in keys:
+            key[axis] = round(position)
+            position += key[size] + gap
+
+def get_key_edges(x, y, width, height):
+    return {"x": (x, x + width / 2, x + width), "y": (y, y + height / 2, y + height)}
+
+def get_snap_index():
+    # Left/center/right and top/middle/bottom of every key as sorted
+    # (position, key index, edge) entries per axis. Between drags only the keys
+    # whose geometry changed are taken out and put back in; a larger edit or a
+    # key added or removed rebuilds the index.
+    geometry = [(key["x"], key["y"], key["width"], key["height"]) for key in current_keys]
+    old_geometry = snap_index.get("geometry")
+    changed = None
+    if old_geometry is not None and len(old_geometry) == len(geometry):
+        changed = [index for index, (old, new) in enumerate(zip(old_geometry, geometry)) if old != new]
+    if changed is None or len(changed) > len(geometry) // 4 + 1:
+        for axis in ["x", "y"]:
+            snap_index[axis] = sorted((position, index, edge) for index, box in enumerate(geometry)
+                                      for edge, position in enumerate(get_key_edges(*box)[axis]))
+    else:
+        for index in changed:
+            old_edges = get_key_edges(*old_geometry[index])
+            new_edges = get_key_edges(*geometry[index])
+            for axis in ["x", "y"]:
+                entries = snap_index[axis]
+                for edge in range(3):
+                    del entries[bisect.bisect_left(entries, (old_edges[axis][edge], index, edge))]
+                    bisect.insort(entries, (new_edges[axis][edge], index, edge))
+    snap_index["geometry"] = geometry
+    return snap_index
+
+def find_snap(entries, positions, moving):
+    # The closest indexed edge within SNAP_DISTANCE of any of the positions,
+    # as (shift, position, key index), ignoring keys that are being dragged.
+    best = None
+    for position in positions:
+        start = bisect.bisect_left(entries, (position - SNAP_DISTANCE,))
+        end = bisect.bisect_right(entries, (position + SNAP_DISTANCE, float("inf")))
+        for target, index, edge in entries[start:end]:
+            if index not in moving and (best is None or abs(target - position) < abs(best[0])):
+                best = (target - position, target, index)
+    return best
+
+def snap_key_drag(drag, dx, dy):
+    # Snaps the moved block to the nearest key edge or center on each axis,
+    # falling back to the grid, and returns the offset with guide lines to draw.
+    left, top, right, bottom = drag["bounds"]
+    wanted = {"x": dx, "y": dy}
+    snaps = {}
+    for axis, low, high in [("x", left, right), ("y", top, bottom)]:
+        offset = wanted[axis]
+        positions = (low + offset, (low + high) / 2 + offset, high + offset)
+        snap = find_snap(drag["snap"][axis], positions, drag["moving_set"])
+        if snap is not None:
+            wanted[axis] = round(offset + snap[0])
+            snaps[axis] = snap
+        elif snap_grid:
+            wanted[axis] = offset + round(positions[0] / snap_grid) * snap_grid - positions[0]
+    dx, dy = clamp_keys_offset(drag["bounds"], wanted["x"], wanted["y"])
+    guides = []
+    # A guide is only drawn if clamping left the block on it.
+    if "x" in snaps and dx == wanted["x"]:
+        key = current_keys[snaps["x"][2]]
+        target = snaps["x"][1]
+        guides.append(((target, min(top + dy, key["y"])), (target, max(bottom + dy, key["y"] + key["height"]))))
+    if "y" in snaps and dy == wanted["y"]:
+        key = current_keys[snaps["y"][2]]
+        target = snaps["y"][1]
+        guides.append(((min(left + dx, key["x"]), target), (max(right + dx, key["x"] + key["width"]), target)))
+    return dx, dy, guides
+
+def begin_key_drag(origin):
+    # Each key moves from where it started rather than by the step since the
+    # last event, so clamping and rounding never build up.
+    keys = get_selected_keys()
+    moving = {id(key) for key in keys}
+    moving_indices = [index for index, key in enumerate(current_keys) if id(key) in moving]
+    return {"origin": origin, "keys": [(key, key["x"], key["y"]) for key in keys], "bounds": get_keys_bounds(keys),
+            "moving": moving_indices, "moving_set": set(moving_indices), "snap": get_snap_index(),
+            "entries": get_configure_label_layout(), "offset": (0, 0), "guides": []}
+
+def move_key_drag(drag, pos, snap=True):
+    dx, dy = clamp_keys_offset(drag["bounds"], pos[0] - drag["origin"][0], pos[1] - drag["origin"][1])
+    guides = []
+    if snap:
+        dx, dy, guides = snap_key_drag(drag, dx, dy)
+    for key, x, y in drag["keys"]:
+        key["x"] = x + dx
+        key["y"] = y + dy
+    drag["offset"] = (dx, dy)
+    drag["guides"] = guides
+
+def get_configure_label_layout():
+    # Placing labels is the slow part of drawing a large layout, so it is only
+    # redone when a key has changed since the last frame.
+    stamp = [(key["x"], key["y"], key["width"], key["height"], key["char"], tuple(key["actions"].values())) for key in current_keys]
+    if configure_label_cache.get("stamp") != stamp:
+        if len(configure_text_cache) > CONFIGURE_TEXT_CACHE_LIMIT:
+            configure_text_cache.clear()
+        configure_label_cache["stamp"] = stamp
+        configure_label_cache["entries"] = layout_key_labels(current_keys, make_view(1, (0, CONFIGURE_AREA_TOP)), configure_text_cache)
+    return configure_label_cache["entries"]
+
+def get_key_drag_layers(drag):
+    # The keys that stay put are drawn once onto the background and the dragged
+    # ones once onto a transparent block, using the label placement from the
+    # start of the drag, so a drag frame is two blits however many keys move.
+    if drag.get("background") is None or drag["background"].get_size() != screen.get_size():
+        moving = drag["moving_set"]
+        entries = drag["entries"]
+        background = pygame.Surface(screen.get_size())
+        background.fill((255, 255, 255))
+        draw_key_entries(background, [key for index, key in enumerate(current_keys) if index not in moving],
+                         [entry for index, entry in enumerate(entries) if index not in moving])
+        moving_entries = [entries[index] for index in drag["moving"]]
+        bounds = moving_entries[0][0].unionall([text_rect for key_rect, labels in moving_entries for text_key, text, text_rect in labels] +
+                                               [key_rect for key_rect, labels in moving_entries])
+        block = pygame.Surface(bounds.size, pygame.SRCALPHA)
+        moving_keys = [current_keys[index] for index in drag["moving"]]
+        draw_key_entries(block, moving_keys, [(key_rect.move(-bounds.x, -bounds.y),
+                                               [(text_key, text, text_rect.move(-bounds.x, -bounds.y)) for text_key, text, text_rect in labels])
+                                              for key_rect, labels in moving_entries], moving_keys)
+        drag["background"] = background
+        drag["block"] = (block, bounds.topleft)
+    return drag["background"], drag["block"]
+
+@profiled("draw_configure_screen")
 def draw_configure_screen():
-    screen.fill((255, 255, 255))
+    if key_drag is not None:
+        background, (block, block_pos) = get_key_drag_layers(key_drag)
+        screen.blit(background, (0, 0))
+    else:
+        screen.fill((255, 255, 255))
     input_rects = {}
     
     keyboard_name_rect = pygame.Rect(30, 15, 150, 20)
     color = (100, 100, 255) if active_input == "keyboard_name" else (200, 200, 200)
     pygame.draw.rect(screen, color, keyboard_name_rect)
     pygame.draw.rect(screen, (0, 0, 0), keyboard_name_rect, 1)
-    display_name = label_text if active_input == "keyboard_name" else (keyboard_name_text or selected_keyboard["name"])
-    display_name = truncate_text(display_name, font, keyboard_name_rect.width - 10)
-    text = font.render(display_name, True, (0, 0, 0))
-    screen.blit(text, (keyboard_name_rect.x + 5, keyboard_name_rect.y + 3))
+    draw_field_text(screen, font, (keyboard_name_rect.x + 5, keyboard_name_rect.y + 3), keyboard_name_rect.width - 10,
+                    keyboard_name_text or selected_keyboard["name"], active_input == "keyboard_name")
     input_rects["keyboard_name"] = keyboard_name_rect
 
-    keyboard_area_start_y = 50
-    text_rects = []
-    modifier_keys = ["Shift", "Ctrl", "Alt", "Tab", "Windows", "CapsLock"]
-    for key in current_keys:
-        color = (100, 100, 255) if key == dragged_key or key == configuring_key else (200, 200, 200)
-        key_rect = pygame.Rect(key["x"], key["y"] + keyboard_area_start_y, key["width"], key["height"])
-        pygame.draw.rect(screen, color, key_rect)
-        pygame.draw.rect(screen, (0, 0, 0), key_rect, 1)
-        key_label = key["char"] or " "
-        text_color = (0, 0, 255) if key_label in modifier_keys and (active_modifiers.get(key_label, False) or (key_label == "CapsLock" and caps_lock_active)) else (0, 0, 0)
-        text = font.render(key_label, True, text_color)
-        text_rect = text.get_rect(center=(key["x"] + key["width"] // 2, key["y"] + keyboard_area_start_y + key["height"] // 2))
-        screen.blit(text, text_rect)
-        text_rects.append(text_rect)
-
-        for direction in DIRECTIONS[1:]:
-            action_text = key["actions"][direction]
-            if not action_text:
-                continue
-            font_size = 10
-            temp_font = small_font
-            temp_text = temp_font.render(action_text, True, (0, 0, 0))
-            if temp_text.get_width() > 80:
-                font_size = max(6, int(10 * 80 / temp_text.get_width()))
-                temp_font = pygame.font.SysFont("arial", font_size)
-                temp_text = temp_font.render(action_text, True, (0, 0, 0))
-            text = temp_text
-
-            if direction == "Up":
-                base_pos = (key["x"] + key["width"] // 2, key["y"] + keyboard_area_start_y - 8)
-                text_rect = text.get_rect(center=base_pos)
-                offset_dir = (0, -1)
-            elif direction == "Down":
-                base_pos = (key["x"] + key["width"] // 2, key["y"] + keyboard_area_start_y + key["height"] + 8)
-                text_rect = text.get_rect(center=base_pos)
-                offset_dir = (0, 1)
-            elif direction == "Left":
-                base_pos = (key["x"] - 4, key["y"] + keyboard_area_start_y + key["height"] // 2)
-                text_rect = text.get_rect(midright=base_pos)
-                offset_dir = (-1, 0)
-            elif direction == "Right":
-                base_pos = (key["x"] + key["width"] + 4, key["y"] + keyboard_area_start_y + key["height"] // 2)
-                text_rect = text.get_rect(midleft=base_pos)
-                offset_dir = (1, 0)
-            elif direction == "Up-Left":
-                base_pos = (key["x"] - 4, key["y"] + keyboard_area_start_y - 4)
-                text_rect = text.get_rect(bottomright=base_pos)
-                offset_dir = (-1, -1)
-            elif direction == "Up-Right":
-                base_pos = (key["x"] + key["width"] + 4, key["y"] + keyboard_area_start_y - 4)
-                text_rect = text.get_rect(bottomleft=base_pos)
-                offset_dir = (1, -1)
-            elif direction == "Down-Left":
-                base_pos = (key["x"] - 4, key["y"] + keyboard_area_start_y + key["height"] + 4)
-                text_rect = text.get_rect(topright=base_pos)
-                offset_dir = (-1, 1)
-            elif direction == "Down-Right":
-                base_pos = (key["x"] + key["width"] + 4, key["y"] + keyboard_area_start_y + key["height"] + 4)
-                text_rect = text.get_rect(topleft=base_pos)
-                offset_dir = (1, 1)
-
-            offset = 0
-            max_offset = 50
-            while offset < max_offset:
-                collides = False
-                for other_rect in text_rects:
-                    if text_rect.colliderect(other_rect):
-                        collides = True
-                        break
-                if not collides:
-                    break
-                offset += 5
-                new_x = base_pos[0] + offset * offset_dir[0]
-                new_y = base_pos[1] + offset * offset_dir[1]
-                if direction in ["Up", "Down"]:
-                    text_rect = text.get_rect(center=(new_x, new_y))
-                elif direction == "Left":
-                    text_rect = text.get_rect(midright=(new_x, new_y))
-                elif direction == "Right":
-                    text_rect = text.get_rect(midleft=(new_x, new_y))
-                elif direction == "Up-Left":
-                    text_rect = text.get_rect(bottomright=(new_x, new_y))
-                elif direction == "Up-Right":
-                    text_rect = text.get_rect(bottomleft=(new_x, new_y))
-                elif direction == "Down-Left":
-                    text_rect = text.get_rect(topright=(new_x, new_y))
-                elif direction == "Down-Right":
-                    text_rect = text.get_rect(topleft=(new_x, new_y))
-
-            screen.blit(text, text_rect)
-            text_rects.append(text_rect)
+    selection = get_selected_keys()
+    if key_drag is None:
+        draw_key_entries(screen, current_keys, get_configure_label_layout(), selection)
+    if box_select is not None:
+        pygame.draw.rect(screen, (100, 100, 255), box_select["rect"].move(0, CONFIGURE_AREA_TOP), 1)
+    if key_drag is not None:
+        screen.blit(block, (block_pos[0] + key_drag["offset"][0], block_pos[1] + key_drag["offset"][1]))
+        for start, end in key_drag["guides"]:
+            pygame.draw.line(screen, (255, 0, 160), (start[0], start[1] + CONFIGURE_AREA_TOP), (end[0], end[1] + CONFIGURE_AREA_TOP))
 
     config_panel_x = screen.get_width() - 250
     config_panel_y = 50
@@ -651,10 +2668,8 @@ def draw_configure_screen():
             color = (100, 100, 255) if active_input == direction else (200, 200, 200)
             pygame.draw.rect(screen, color, action_rect)
             pygame.draw.rect(screen, (0, 0, 0), action_rect, 1)
-            action_text = label_text if active_input == direction else action_texts.get(direction, configuring_key["actions"][direction])
-            action_text = truncate_text(action_text, small_font, action_rect.width - 10)
-            text = small_font.render(action_text, True, (0, 0, 0))
-            screen.blit(text, (action_rect.x + 5, action_rect.y + 3))
+            draw_field_text(screen, small_font, (action_rect.x + 5, action_rect.y + 3), action_rect.width - 10,
+                            action_texts.get(direction, configuring_key["actions"][direction]), active_input == direction)
             input_rects[direction] = action_rect
             
             up_arrow_rect = pygame.Rect(action_rect.right + 4, y, 10, 10)
@@ -672,7 +2687,7 @@ def draw_configure_screen():
         color = (100, 100, 255) if active_input == "width" else (200, 200, 200)
         pygame.draw.rect(screen, color, width_rect)
         pygame.draw.rect(screen, (0, 0, 0), width_rect, 1)
-        width_text = label_text if active_input == "width" else (str(configuring_key["width"]) if configuring_key else "40")
+        width_text = label_buffer.text() if active_input == "width" else (str(configuring_key["width"]) if configuring_key else "40")
         width_text = truncate_text(width_text, font, width_rect.width - 10)
         text = font.render("Width: " + width_text, True, (0, 0, 0))
         screen.blit(text, (config_panel_x, dimension_y))
@@ -682,11 +2697,22 @@ def draw_configure_screen():
         color = (100, 100, 255) if active_input == "height" else (200, 200, 200)
         pygame.draw.rect(screen, color, height_rect)
         pygame.draw.rect(screen, (0, 0, 0), height_rect, 1)
-        height_text = label_text if active_input == "height" else (str(configuring_key["height"]) if configuring_key else "40")
+        height_text = label_buffer.text() if active_input == "height" else (str(configuring_key["height"]) if configuring_key else "40")
         height_text = truncate_text(height_text, font, height_rect.width - 10)
         text = font.render("Height: " + height_text, True, (0, 0, 0))
         screen.blit(text, (config_panel_x, dimension_y + 25))
         input_rects["height"] = height_rect
+
+        if len(selection) > 1:
+            text = small_font.render(f"{len(selection)} keys selected", True, (0, 0, 0))
+            screen.blit(text, (config_panel_x, config_panel_y - 20))
+            for i, (action, caption) in enumerate(ARRANGE_BUTTONS):
+                arrange_rect = pygame.Rect(config_panel_x + i * 60, dimension_y + 55, 55, 20)
+                pygame.draw.rect(screen, (100, 200, 100), arrange_rect)
+                pygame.draw.rect(screen, (0, 0, 0), arrange_rect, 1)
+                text = small_font.render(caption, True, (0, 0, 0))
+                screen.blit(text, text.get_rect(center=arrange_rect.center))
+                input_rects[action] = arrange_rect
     else:
         text = font.render("No key selected", True, (255, 0, 0))
         screen.blit(text, (config_panel_x, config_panel_y))
@@ -719,67 +2745,120 @@ def draw_configure_screen():
     text_rect = text.get_rect(center=delete_key_button.center)
     screen.blit(text, text_rect)
     
-    pygame.display.flip()
-    return add_key_button, done_button, delete_key_button, input_rects, duplicate_key_button
+    layer_button = pygame.Rect(510, 365, 100, 20)
+    pygame.draw.rect(screen, (100, 200, 100), layer_button)
+    pygame.draw.rect(screen, (0, 0, 0), layer_button, 1)
+    text = font.render(f"Layer: {editing_layer}", True, (0, 0, 0))
+    text_rect = text.get_rect(center=layer_button.center)
+    screen.blit(text, text_rect)
+    
+    present_frame()
+    return add_key_button, done_button, delete_key_button, input_rects, duplicate_key_button, layer_button
 
+def render_thumbnail(geometry):
+    surface = pygame.Surface(THUMBNAIL_SIZE)
+    surface.fill((255, 255, 255))
+    scale = min(THUMBNAIL_SIZE[0] / LAYOUT_WIDTH, THUMBNAIL_SIZE[1] / LAYOUT_HEIGHT)
+    for x, y, width, height in geometry:
+        rect = pygame.Rect(int(x * scale), int(y * scale), max(1, int(width * scale)), max(1, int(height * scale)))
+        pygame.draw.rect(surface, (200, 200, 200), rect)
+        pygame.draw.rect(surface, (0, 0, 0), rect, 1)
+    return surface
+
+def thumbnail_worker():
+    while True:
+        keyboard_id, keys, geometry = thumbnail_queue.get()
+        try:
+            surface = render_thumbnail(geometry)
+            with thumbnail_lock:
+                thumbnail_cache[keyboard_id] = (keys, surface)
+                thumbnail_cache.move_to_end(keyboard_id)
+                while len(thumbnail_cache) > THUMBNAIL_CACHE_LIMIT:
+                    thumbnail_cache.popitem(last=False)
+                if thumbnail_pending.get(keyboard_id) is keys:
+                    del thumbnail_pending[keyboard_id]
+        except Exception as e:
+            print(f"Thumbnail render error: {e}\n{traceback.format_exc()}")
+
+def get_thumbnail(keyboard_data):
+    global thumbnail_thread
+    keyboard_id = keyboard_data["id"]
+    keys = keyboard_data["keys"]
+    with thumbnail_lock:
+        entry = thumbnail_cache.get(keyboard_id)
+        count_cache("thumbnail", bool(entry and entry[0] is keys))
+        if entry and entry[0] is keys:
+            thumbnail_cache.move_to_end(keyboard_id)
+            return entry[1]
+        if thumbnail_pending.get(keyboard_id) is keys:
+            return None
+        thumbnail_pending[keyboard_id] = keys
+    # Snapshot geometry here so the worker never reads dicts the UI may be editing.
+    geometry = [(key["x"], key["y"], key["width"], key["height"]) for key in keys]
+    thumbnail_queue.put((keyboard_id, keys, geometry))
+    if thumbnail_thread is None:
+        thumbnail_thread = threading.Thread(target=thumbnail_worker, name="thumbnails", daemon=True)
+        thumbnail_thread.start()
+    return None
+
+def get_visible_list_rows():
+    first = max(0, (scroll_offset - LIST_VIEWPORT_TOP) // LIST_ITEM_HEIGHT)
+    last = min(len(keyboards), (scroll_offset + LIST_VIEWPORT_BOTTOM - LIST_VIEWPORT_TOP) // LIST_ITEM_HEIGHT + 1)
+    return range(first, last)
+
+def get_keyboard_list_hit(pos):
+    if not 0 <= pos[1] < LIST_VIEWPORT_BOTTOM:
+        return None
+    row_offset = pos[1] - LIST_VIEWPORT_TOP + scroll_offset
+    if row_offset < 0:
+        return None
+    idx, row_y = divmod(row_offset, LIST_ITEM_HEIGHT)
+    if idx >= len(keyboards) or row_y >= 40:
+        return None
+    for button_name, x, width in LIST_ROW_BUTTONS:
+        if x <= pos[0] < x + width:
+            return idx, button_name
+    return None
+
+@profiled("draw_keyboard_list")
 def draw_keyboard_list():
     global scroll_offset, max_scroll
     screen.fill((255, 255, 255))
-    keyboard_buttons = []
-    item_height = 60
-    canvas_height = 400
     mouse_pos = pygame.mouse.get_pos()
+    hover = get_keyboard_list_hit(mouse_pos)
     
-    max_scroll = max(0, item_height * len(keyboards) - canvas_height + 60)
+    viewport_height = LIST_VIEWPORT_BOTTOM - LIST_VIEWPORT_TOP
+    max_scroll = max(0, LIST_ITEM_HEIGHT * len(keyboards) - viewport_height)
     scroll_offset = max(0, min(scroll_offset, max_scroll))
     
-    for i in range(len(keyboards)):
-        y = 40 + i * item_height - scroll_offset
-        if y < -40 or y > canvas_height:
-            continue
-        select_button = pygame.Rect(40, y, 160, 40)
-        color = (100, 100, 255) if select_button.collidepoint(mouse_pos) else (200, 200, 200)
-        pygame.draw.rect(screen, color, select_button)
-        outline_color = (0, 0, 0)
-        pygame.draw.rect(screen, outline_color, select_button, 2)
-        text = font.render(keyboards[i]["name"], True, (0, 0, 0))
-        text_rect = text.get_rect(center=select_button.center)
-        screen.blit(text, text_rect)
-        
-        edit_button = pygame.Rect(210, y, 60, 40)
-        color = (100, 100, 255) if edit_button.collidepoint(mouse_pos) else (200, 200, 200)
-        pygame.draw.rect(screen, color, edit_button)
-        pygame.draw.rect(screen, outline_color, edit_button, 2)
-        text = font.render("Edit", True, (0, 0, 0))
-        text_rect = text.get_rect(center=edit_button.center)
-        screen.blit(text, text_rect)
-        
-        delete_button = pygame.Rect(280, y, 80, 40)
-        color = (100, 100, 255) if delete_button.collidepoint(mouse_pos) else (200, 200, 200)
-        pygame.draw.rect(screen, color, delete_button)
-        pygame.draw.rect(screen, outline_color, delete_button, 2)
-        text = font.render("Delete", True, (0, 0, 0))
-        text_rect = text.get_rect(center=delete_button.center)
-        screen.blit(text, text_rect)
-        
-        duplicate_button = pygame.Rect(370, y, 80, 40)
-        color = (100, 100, 255) if duplicate_button.collidepoint(mouse_pos) else (200, 200, 200)
-        pygame.draw.rect(screen, color, duplicate_button)
-        pygame.draw.rect(screen, outline_color, duplicate_button, 2)
-        text = font.render("Duplicate", True, (0, 0, 0))
-        text_rect = text.get_rect(center=duplicate_button.center)
-        screen.blit(text, text_rect)
+    screen.set_clip(pygame.Rect(0, 0, screen.get_width(), LIST_VIEWPORT_BOTTOM))
+    for i in get_visible_list_rows():
+        y = LIST_VIEWPORT_TOP + i * LIST_ITEM_HEIGHT - scroll_offset
+        for button_name, x, width in LIST_ROW_BUTTONS[:4]:
+            button_rect = pygame.Rect(x, y, width, 40)
+            color = (100, 100, 255) if hover == (i, button_name) else (200, 200, 200)
+            pygame.draw.rect(screen, color, button_rect)
+            pygame.draw.rect(screen, (0, 0, 0), button_rect, 2)
+            label = keyboards[i]["name"] if button_name == "select" else button_name.capitalize()
+            text = render_text(font, label, (0, 0, 0))
+            screen.blit(text, text.get_rect(center=button_rect.center))
         
-        keyboard_buttons.append((select_button, edit_button, delete_button, i, duplicate_button))
+        thumbnail_rect = pygame.Rect(LIST_ROW_BUTTONS[4][1], y, *THUMBNAIL_SIZE)
+        thumbnail = get_thumbnail(keyboards[i])
+        if thumbnail:
+            screen.blit(thumbnail, thumbnail_rect)
+        else:
+            pygame.draw.rect(screen, (240, 240, 240), thumbnail_rect)
+        pygame.draw.rect(screen, (0, 0, 0), thumbnail_rect, 1)
+    screen.set_clip(None)
     
     load_input_rect = pygame.Rect(40, 300, 410, 40)
     color = (100, 100, 255) if active_input == "load_code" else (200, 200, 200)
     pygame.draw.rect(screen, color, load_input_rect)
     pygame.draw.rect(screen, (0, 0, 0), load_input_rect, 1)
-    display_text = label_text if active_input == "load_code" else (load_code_text or "Paste JSON code here")
-    display_text = truncate_text(display_text, small_font, load_input_rect.width - 10)
-    text = small_font.render(display_text, True, (0, 0, 0))
-    screen.blit(text, (load_input_rect.x + 5, load_input_rect.y + 12))
+    paste_active = active_input == "load_code"
+    draw_field_text(screen, small_font, (load_input_rect.x + 5, load_input_rect.y + 12), load_input_rect.width - 10,
+                    None if paste_active else (load_code_buffer.text() or "Paste JSON code here"), paste_active)
     
     save_button_rect = pygame.Rect(40, 350, 80, 40)
     color = (100, 100, 255) if save_button_rect.collidepoint(mouse_pos) else (200, 200, 200)
@@ -817,120 +2896,75 @@ def draw_keyboard_list():
         text_surf = font.render(feedback_message, True, (255, 0, 0))
         screen.blit(text_surf, (40, 280))
     
-    pygame.display.flip()
-    return add_button_rect, save_button_rect, load_button_rect, load_input_rect, keyboard_buttons, None, delete_code_button_rect
+    present_frame()
+    return add_button_rect, save_button_rect, load_button_rect, load_input_rect, delete_code_button_rect
 
+@profiled("draw_keyboard")
 def draw_keyboard():
-    screen.fill((255, 255, 255))
+    back_button_rect = None
     if selected_keyboard:
-        text_rects = []
-        modifier_keys = ["Shift", "Ctrl", "Alt", "Tab", "Windows", "CapsLock"]
-        for key in selected_keyboard["keys"]:
-            color = (100, 100, 255) if key == selected_key else (200, 200, 200)
-            key_rect = pygame.Rect(key["x"], key["y"], key["width"], key["height"])
-            pygame.draw.rect(screen, color, key_rect)
-            pygame.draw.rect(screen, (0, 0, 0), key_rect, 1)
-            key_label = key["char"] or " "
-            text_color = (0, 0, 255) if key_label in modifier_keys and (active_modifiers.get(key_label, False) or (key_label == "CapsLock" and caps_lock_active)) else (0, 0, 0)
-            text = font.render(key_label, True, text_color)
-            text_rect = text.get_rect(center=(key["x"] + key["width"] // 2, key["y"] + key["height"] // 2))
-            screen.blit(text, text_rect)
-            text_rects.append(text_rect)
-            
-            for direction in DIRECTIONS[1:]:
-                action_text = key["actions"][direction]
-                if not action_text:
-                    continue
-                font_size = 10
-                temp_font = small_font
-                temp_text = temp_font.render(action_text, True, (0, 0, 0))
-                if temp_text.get_width() > 80:
-                    font_size = max(6, int(10 * 80 / temp_text.get_width()))
-                    temp_font = pygame.font.SysFont("arial", font_size)
-                    temp_text = temp_font.render(action_text, True, (0, 0, 0))
-                text = temp_text
-                
-                if direction == "Up":
-                    base_pos = (key["x"] + key["width"] // 2, key["y"] - 8)
-                    text_rect = text.get_rect(center=base_pos)
-                    offset_dir = (0, -1)
-                elif direction == "Down":
-                    base_pos = (key["x"] + key["width"] // 2, key["y"] + key["height"] + 8)
-                    text_rect = text.get_rect(center=base_pos)
-                    offset_dir = (0, 1)
-                elif direction == "Left":
-                    base_pos = (key["x"] - 4, key["y"] + key["height"] // 2)
-                    text_rect = text.get_rect(midright=base_pos)
-                    offset_dir = (-1, 0)
-                elif direction == "Right":
-                    base_pos = (key["x"] + key["width"] + 4, key["y"] + key["height"] // 2)
-                    text_rect = text.get_rect(midleft=base_pos)
-                    offset_dir = (1, 0)
-                elif direction == "Up-Left":
-                    base_pos = (key["x"] - 4, key["y"] - 4)
-                    text_rect = text.get_rect(bottomright=base_pos)
-                    offset_dir = (-1, -1)
-                elif direction == "Up-Right":
-                    base_pos = (key["x"] + key["width"] + 4, key["y"] - 4)
-                    text_rect = text.get_rect(bottomleft=base_pos)
-                    offset_dir = (1, -1)
-                elif direction == "Down-Left":
-                    base_pos = (key["x"] - 4, key["y"] + key["height"] + 4)
-                    text_rect = text.get_rect(topright=base_pos)
-                    offset_dir = (-1, 1)
-                elif direction == "Down-Right":
-                    base_pos = (key["x"] + key["width"] + 4, key["y"] + key["height"] + 4)
-                    text_rect = text.get_rect(topleft=base_pos)
-                    offset_dir = (1, 1)
-                
-                offset = 0
-                max_offset = 50
-                while offset < max_offset:
-                    collides = False
-                    for other_rect in text_rects:
-                        if text_rect.colliderect(other_rect):
-                            collides = True
-                            break
-                    if not collides:
-                        break
-                    offset += 5
-                    new_x = base_pos[0] + offset * offset_dir[0]
-                    new_y = base_pos[1] + offset * offset_dir[1]
-                    if direction in ["Up", "Down"]:
-                        text_rect = text.get_rect(center=(new_x, new_y))
-                    elif direction == "Left":
-                        text_rect = text.get_rect(midright=(new_x, new_y))
-                    elif direction == "Right":
-                        text_rect = text.get_rect(midleft=(new_x, new_y))
-                    elif direction == "Up-Left":
-                        text_rect = text.get_rect(bottomright=(new_x, new_y))
-                    elif direction == "Up-Right":
-                        text_rect = text.get_rect(bottomleft=(new_x, new_y))
-                    elif direction == "Down-Left":
-                        text_rect = text.get_rect(topright=(new_x, new_y))
-                    elif direction == "Down-Right":
-                        text_rect = text.get_rect(topleft=(new_x, new_y))
-                
-                screen.blit(text, text_rect)
-                text_rects.append(text_rect)
+        layer = get_keyboard_layer(selected_keyboard, get_active_layer_name(selected_keyboard))
+        if layer["patches"] is not None and selected_keyboard.get("layers"):
+            prebake_keyboard_layers(selected_keyboard)
+        view = layer["view"]
+        overlays = []
+        if layer["patches"] is not None:
+            for key in layer["modifier_keys"]:
+                if key is not selected_key:
+                    patch = get_key_patch(layer, key, False)
+                    if patch:
+                        overlays.append(patch)
+            if selected_key:
+                patch = get_key_patch(layer, selected_key, True)
+                if patch:
+                    overlays.append(patch)
         
         if input_buffer:
-            text = font.render(f"Buffer: {input_buffer}", True, (0, 0, 0))
-            screen.blit(text, (30, 330))
+            overlays.append((get_input_tail(view["font"], scale_length(LAYOUT_WIDTH - 60, view)), layout_to_screen_rect(30, 330, 0, 0, view)))
         if last_typed_text:
-            text = font.render(f"Last: {last_typed_text}", True, (0, 0, 0))
-            screen.blit(text, (30, 350))
+            overlays.append((render_text(view["font"], f"Last: {last_typed_text}", (0, 0, 0)), layout_to_screen_rect(30, 350, 0, 0, view)))
         
-        back_button_rect = pygame.Rect(650, 365, 100, 20)
-        pygame.draw.rect(screen, (255, 100, 100), back_button_rect)
-        pygame.draw.rect(screen, (0, 0, 0), back_button_rect, 1)
-        text = font.render("Back", True, (0, 0, 0))
-        text_rect = text.get_rect(center=back_button_rect.center)
-        screen.blit(text, text_rect)
+        back_button_rect = layer["back_button_rect"]
+        if renderer_backend == "gpu":
+            present_layers(layer["surface"], overlays)
+            return back_button_rect
+        screen.blit(layer["surface"], (0, 0))
+        screen.blits(overlays, doreturn=False)
+    else:
+        screen.fill((255, 255, 255))
     
-    pygame.display.flip()
+    present_frame()
     return back_button_rect
 
+def get_committed_swipe_direction(start_pos, pos):
+    # A swipe in progress is only committed once it is past the tap threshold
+    # and its angle is clear of the octant edges, so a drifting finger that ends
+    # up in the neighbouring direction is left for MOUSEBUTTONUP to classify.
+    dx = pos[0] - start_pos[0]
+    dy = pos[1] - start_pos[1]
+    if math.hypot(dx, dy) < SWIPE_THRESHOLD:
+        return None
+    edge_distance = (math.degrees(math.atan2(dy, dx)) - 22.5) % 45
+    if min(edge_distance, 45 - edge_distance) < SWIPE_COMMIT_MARGIN:
+        return None
+    return get_swipe_direction(start_pos, pos)
+
+def dispatch_key_action(key, direction):
+    # The caller has already begun the keystroke trace; the key is marked as
+    # dispatched even when debounced so its release does not fire it again.
+    global last_key_action_time, key_dispatched
+    key_dispatched = True
+    action = key["actions"].get(direction)
+    mark_keystroke_stage("classify")
+    if action and input_time - last_key_action_time > 0.2:
+        last_key_action_time = input_time
+        mark_keystroke_stage("debounce")
+        send_key(action)
+        finish_keystroke_trace(direction)
+        print(f"Performed {direction} action: '{action}'")
+    else:
+        cancel_keystroke_trace()
+
 def get_swipe_direction(start_pos, end_pos):
     dx = end_pos[0] - start_pos[0]
     dy = end_pos[1] - start_pos[1]
@@ -952,49 +2986,713 @@ def get_swipe_direction(start_pos, end_pos):
     else:
         return "Right"
 
+LOOPBACK_HOSTS = ["127.0.0.1", "localhost", "::1"]
+CONTROL_LINE_LIMIT = 64 * 1024 * 1024
+CONTROL_PIPELINE_DEPTH = 1024
+# Control commands run on the main thread between frames, for at most this long
+# per frame; the rest wait for the next frame.
+CONTROL_FRAME_BUDGET = 0.004
+control_requests = queue.Queue()
+control_server = None
+control_clients = set()
+
+def parse_control_address(address):
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+async def handle_control_client(reader, writer):
+    # One JSON command (or a list of them, run as a batch) per line. Lines are
+    # queued for the main thread as they arrive, so a client may pipeline them;
+    # responses come back in request order.
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Queue(CONTROL_PIPELINE_DEPTH)
+
+    async def write_responses():
+        while True:
+            future = await pending.get()
+            if future is None:
+                return
+            writer.write((json.dumps(await future) + "\n").encode("utf-8"))
+            if pending.empty():
+                await writer.drain()
+
+    writer_task = asyncio.create_task(write_responses())
+    control_clients.add(writer)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            future = loop.create_future()
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                future.set_result({"ok": False, "error": f"JSON parse error: {e}"})
+            else:
+                control_requests.put((request, future, loop))
+            await pending.put(future)
+    except (ConnectionError, ValueError) as e:
+        print(f"Control client dropped: {e}")
+    finally:
+        control_clients.discard(writer)
+        await pending.put(None)
+        try:
+            await writer_task
+        except ConnectionError:
+            pass
+        writer.close()
+
+def run_control_server(address, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        if isinstance(address, tuple):
+            server = loop.run_until_complete(asyncio.start_server(handle_control_client, address[0], address[1], limit=CONTROL_LINE_LIMIT))
+        else:
+            server = loop.run_until_complete(asyncio.start_unix_server(handle_control_client, address, limit=CONTROL_LINE_LIMIT))
+    except Exception as e:
+        print(f"Control server failed to start: {e}\n{traceback.format_exc()}")
+        loop.close()
+        ready.set()
+        return
+    control_server["loop"] = loop
+    ready.set()
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        for writer in list(control_clients):
+            writer.close()
+        tasks = asyncio.all_tasks(loop)
+        if tasks:
+            loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+        loop.close()
+
+def start_control_server(address):
+    global control_server
+    target = parse_control_address(address)
+    if isinstance(target, tuple) and target[0] not in LOOPBACK_HOSTS:
+        print(f"Control server refused: {target[0]} is not a loopback address")
+        return False
+    if not isinstance(target, tuple):
+        if not hasattr(asyncio, "start_unix_server"):
+            print("Control server refused: Unix sockets are not available here, use HOST:PORT")
+            return False
+        if os.path.exists(target):
+            if not stat.S_ISSOCK(os.stat(target).st_mode):
+                print(f"Control server refused: {target} exists and is not a socket")
+                return False
+            os.remove(target)
+    ready = threading.Event()
+    control_server = {"address": target, "loop": None}
+    control_server["thread"] = threading.Thread(target=run_control_server, args=(target, ready), daemon=True)
+    control_server["thread"].start()
+    ready.wait(5)
+    if control_server["loop"] is None:
+        control_server = None
+        return False
+    print(f"Control server listening on {address}")
+    return True
+
+def stop_control_server():
+    global control_server
+    if control_server is None:
+        return
+    control_server["loop"].call_soon_threadsafe(control_server["loop"].stop)
+    control_server["thread"].join(2)
+    if not isinstance(control_server["address"], tuple) and os.path.exists(control_server["address"]):
+        os.remove(control_server["address"])
+    control_server = None
+
+def resolve_control_future(future, response):
+    if not future.done():
+        future.set_result(response)
+
+def process_control_requests():
+    deadline = time.perf_counter() + CONTROL_FRAME_BUDGET
+    while time.perf_counter() < deadline:
+        try:
+            request, future, loop = control_requests.get_nowait()
+        except queue.Empty:
+            return
+        if isinstance(request, list):
+            response = [run_control_command(command) for command in request]
+        else:
+            response = run_control_command(request)
+        try:
+            loop.call_soon_threadsafe(resolve_control_future, future, response)
+        except RuntimeError:
+            pass
+
+def run_control_command(command):
+    if not isinstance(command, dict) or not isinstance(command.get("cmd"), str):
+        return {"ok": False, "error": "Expected an object with a 'cmd' field"}
+    response = {"id": command["id"]} if "id" in command else {}
+    handler = CONTROL_COMMANDS.get(command["cmd"])
+    if handler is None:
+        response.update(ok=False, error=f"Unknown command '{command['cmd']}'")
+        return response
+    try:
+        response.update(ok=True, result=handler(command))
+    except (KeyError, ValueError, TypeError) as e:
+        response.update(ok=False, error=str(e))
+    except Exception as e:
+        print(f"Control command error: {e}\n{traceback.format_exc()}")
+        response.update(ok=False, error=f"{type(e).__name__}: {e}")
+    return response
+
+def find_control_keyboard(command):
+    # The target is "keyboard_id" or "name"; a command's own "id" only tags
+    # its response.
+    for keyboard_data in keyboards:
+        if keyboard_data["id"] == command.get("keyboard_id") or ("keyboard_id" not in command and keyboard_data["name"] == command.get("name")):
+            return keyboard_data
+    raise ValueError(f"No keyboard with keyboard_id/name {command.get('keyboard_id', command.get('name'))!r}")
+
+def control_keyboard_from_json(keyboard_data):
+    error = validate_keyboard_json(keyboard_data)
+    if error:
+        raise ValueError(f"Invalid JSON: {error}")
+    return normalize_keyboard_layout(copy.deepcopy(keyboard_data))
+
+def control_select(command):
+    global state, selected_keyboard, selected_key, swipe_start, swipe_direction, last_typed_text, show_keyboard, latched_layer, oneshot_layer
+    selected_keyboard = find_control_keyboard(command)
+    state = "keyboard"
+    selected_key = None
+    swipe_start = None
+    swipe_direction = None
+    last_typed_text = ""
+    show_keyboard = True
+    latched_layer = "base"
+    oneshot_layer = None
+    print(f"Selected keyboard: {selected_keyboard['name']} (control)")
+    return {"keyboard_id": selected_keyboard["id"]}
+
+def control_keyboard_from_command(command):
+    # A "spec" is compiled in place of "keyboard" JSON.
+    if "spec" in command:
+        return normalize_keyboard_layout(compile_layout_spec(command["spec"]))
+    return control_keyboard_from_json(command["keyboard"])
+
+def control_load(command):
+    new_keyboard = control_keyboard_from_command(command)
+    new_keyboard["id"] = str(uuid.uuid4())
+    keyboards.append(new_keyboard)
+    print(f"Keyboard loaded: {new_keyboard['name']} (control)")
+    if command.get("select"):
+        control_select({"keyboard_id": new_keyboard["id"]})
+    return {"keyboard_id": new_keyboard["id"], "lint": report_layout_lint(new_keyboard, "control")}
+
+def control_replace(command):
+    global selected_keyboard, selected_key
+    old_keyboard = find_control_keyboard(command)
+    new_keyboard = control_keyboard_from_command(command)
+    new_keyboard["id"] = old_keyboard["id"]
+    keyboards[keyboards.index(old_keyboard)] = new_keyboard
+    invalidate_keyboard_layer(old_keyboard)
+    if selected_keyboard is old_keyboard:
+        selected_keyboard = new_keyboard
+        selected_key = None
+    print(f"Keyboard replaced: {new_keyboard['name']} (control)")
+    return {"keyboard_id": new_keyboard["id"], "lint": report_layout_lint(new_keyboard, "control")}
+
+def control_key(command):
+    if not isinstance(command["action"], str):
+        raise ValueError("'action' must be a string")
+    send_key(command["action"])
+    return {"typed_count": typed_count}
+
+def control_tap(command):
+    if selected_keyboard is None:
+        raise ValueError("No keyboard selected")
+    direction = command.get("direction", "Tap")
+    if direction not in DIRECTIONS:
+        raise ValueError(f"'direction' must be one of {DIRECTIONS}")
+    for key in get_layer_keys(selected_keyboard, get_active_layer_name(selected_keyboard)):
+        if key["char"] == command["char"]:
+            action = key["actions"].get(direction)
+            if action:
+                send_key(action)
+            return {"action": action, "typed_count": typed_count}
+    raise ValueError(f"No key {command['char']!r} on the active layer")
+
+def control_state(command):
+    return {
+        "state": state,
+        "keyboard": {"id": selected_keyboard["id"], "name": selected_keyboard["name"]} if selected_keyboard else None,
+        "layer": get_active_layer_name(selected_keyboard) if selected_keyboard else None,
+        "modifiers": sorted(key for key, active in active_modifiers.items() if active),
+        "caps_lock": caps_lock_active,
+        "keyboards": len(keyboards),
+        "typed_count": typed_count
+    }
+
+def control_list(command):
+    return [{"id": keyboard_data["id"], "name": keyboard_data["name"], "keys": len(keyboard_data["keys"])} for keyboard_data in keyboards]
+
+def control_metrics(command):
+    timings = {}
+    for name, histogram in profile_histograms.items():
+        timings[name] = {"count": histogram["count"], "mean_ms": histogram["total_ms"] / max(1, histogram["count"]), "max_ms": histogram["max_ms"]}
+        for quantile in LATENCY_QUANTILES:
+            timings[name][f"p{round(quantile * 100)}_ms"] = histogram_percentile(histogram, quantile)
+    caches = {name: {"hits": hits, "misses": misses} for name, (hits, misses) in cache_stats.items()}
+    return {"keystroke_latency": summarize_keystroke_latency(), "timings": timings, "caches": caches}
+
+CONTROL_COMMANDS = {
+    "ping": lambda command: "pong",
+    "state": control_state,
+    "list": control_list,
+    "load": control_load,
+    "replace": control_replace,
+    "select": control_select,
+    "key": control_key,
+    "tap": control_tap,
+    "metrics": control_metrics
+}
+
+LAYOUT_POLL_INTERVAL = 0.5
+layout_watch = None
+layout_updates = queue.Queue()
+
+def start_layout_watcher(directory):
+    # A stat() poll of one directory: no inotify in the standard library, and a
+    # scandir of a few dozen files is far cheaper than a frame. Changed files
+    # are parsed on the watcher thread so a big layout never stalls drawing.
+    global layout_watch
+    if not os.path.isdir(directory):
+        print(f"Layouts directory not found: {directory}")
+        return False
+    layout_watch = {"directory": directory, "stamps": {}, "keyboards": {}, "stop": threading.Event()}
+    layout_watch["thread"] = threading.Thread(target=layout_watch_worker, args=(layout_watch,), daemon=True)
+    layout_watch["thread"].start()
+    print(f"Watching {directory} for layout changes")
+    return True
+
+def layout_watch_worker(watch):
+    while True:
+        try:
+            seen = set()
+            with os.scandir(watch["directory"]) as entries:
+                for entry in entries:
+                    if not entry.name.endswith((".json", LAYOUT_SPEC_SUFFIX)) or not entry.is_file():
+                        continue
+                    seen.add(entry.path)
+                    info = entry.stat()
+                    stamp = (info.st_mtime_ns, info.st_size)
+                    if watch["stamps"].get(entry.path) == stamp:
+                        continue
+                    watch["stamps"][entry.path] = stamp
+                    try:
+                        with open(entry.path, "r", encoding="utf-8") as f:
+                            if entry.name.endswith(LAYOUT_SPEC_SUFFIX):
+                                layout_updates.put((entry.path, compile_layout_spec(f.read())))
+                            else:
+                                layout_updates.put((entry.path, json.load(f)))
+                    except (OSError, ValueError) as e:
+                        layout_updates.put((entry.path, e))
+            for path in [path for path in watch["stamps"] if path not in seen]:
+                del watch["stamps"][path]
+                layout_updates.put((path, None))
+        except OSError as e:
+            print(f"Layout watcher error: {e}")
+        if watch["stop"].wait(LAYOUT_POLL_INTERVAL):
+            return
+
+def process_layout_updates():
+    while True:
+        try:
+            path, data = layout_updates.get_nowait()
+        except queue.Empty:
+            return
+        name = os.path.basename(path)
+        keyboard_id = layout_watch["keyboards"].get(path)
+        keyboard_data = next((keyboard_data for keyboard_data in keyboards if keyboard_data["id"] == keyboard_id), None)
+        if data is None:
+            # The keyboard stays loaded, it just stops following a file that is gone.
+            layout_watch["keyboards"].pop(path, None)
+            print(f"Layout file removed: {name}")
+            continue
+        error = f"{'Spec' if path.endswith(LAYOUT_SPEC_SUFFIX) else 'JSON parse'} error: {data}" if isinstance(data, Exception) else validate_keyboard_json(data)
+        if error:
+            set_feedback_message(f"{name}: {error}")
+            print(f"Layout reload skipped for {name}: {error}")
+            continue
+        try:
+            data = normalize_keyboard_layout(data)
+            if keyboard_data is None:
+                data["id"] = str(uuid.uuid4())
+                keyboards.append(data)
+                layout_watch["keyboards"][path] = data["id"]
+                print(f"Keyboard loaded from {name}")
+            else:
+                changed = apply_layout_update(keyboard_data, data)
+                if state == "configure" and selected_keyboard is keyboard_data:
+                    set_feedback_message(f"{name} changed on disk while editing")
+                else:
+                    set_feedback_message(f"Reloaded {name}")
+                print(f"Reloaded {name}: {changed} keys changed")
+        except Exception as e:
+            set_feedback_message("Layout reload error")
+            print(f"Layout reload error for {name}: {e}\n{traceback.format_exc()}")
+
+def apply_layout_update(keyboard_data, new_data):
+    # Keys are matched by position and updated in place, so unchanged keys keep
+    # their cached patches and a key that is being swiped keeps its identity.
+    keyboard_data["name"] = new_data["name"]
+    changed_total = 0
+    for layer_name in LAYER_NAMES:
+        old_keys = get_layer_keys(keyboard_data, layer_name)
+        new_keys = get_layer_keys(new_data, layer_name)
+        if old_keys is None or new_keys is None:
+            if old_keys is new_keys:
+                continue
+            if new_keys is None:
+                del keyboard_data["layers"][layer_name]
+            else:
+                keyboard_data.setdefault("layers", {})[layer_name] = new_keys
+            changed_total += len(old_keys or new_keys)
+            keyboard_layer_cache.pop((keyboard_data["id"], layer_name), None)
+            continue
+        shared = min(len(old_keys), len(new_keys))
+        changed = [index for index in range(shared) if old_keys[index] != new_keys[index]]
+        if not changed and len(old_keys) == len(new_keys):
+            continue
+        old_geometry = {index: (old_keys[index]["x"], old_keys[index]["y"], old_keys[index]["width"], old_keys[index]["height"])
+                        for index in changed + list(range(shared, len(old_keys)))}
+        removed = old_keys[shared:]
+        for index in changed:
+            old_keys[index].clear()
+            old_keys[index].update(new_keys[index])
+        del old_keys[shared:]
+        old_keys.extend(new_keys[shared:])
+        changed += list(range(shared, max(len(old_keys), len(removed) + shared)))
+        changed_total += len(changed)
+        layer = keyboard_layer_cache.get((keyboard_data["id"], layer_name))
+        if layer is not None:
+            patch_keyboard_layer(layer, keyboard_data, layer_name, changed, old_geometry, removed)
+    if keyboard_data.get("layers") == {}:
+        del keyboard_data["layers"]
+    with thumbnail_lock:
+        thumbnail_cache.pop(keyboard_data["id"], None)
+        thumbnail_pending.pop(keyboard_data["id"], None)
+    return changed_total
+
+def get_hit_grid_cells(geometry):
+    x, y, width, height = geometry
+    for cell_x in range(int(x // HIT_GRID_CELL), int((x + width) // HIT_GRID_CELL) + 1):
+        for cell_y in range(int(y // HIT_GRID_CELL), int((y + height) // HIT_GRID_CELL) + 1):
+            yield (cell_x, cell_y)
+
+def patch_keyboard_layer(layer, keyboard_data, layer_name, changed, old_geometry, removed):
+    keys = layer["keys"]
+    hit_grid = layer["hit_grid"]
+    for index in changed:
+        if index in old_geometry:
+            for cell in get_hit_grid_cells(old_geometry[index]):
+                hit_grid[cell].remove(index)
+                if not hit_grid[cell]:
+                    del hit_grid[cell]
+        if index < len(keys):
+            key = keys[index]
+            for cell in get_hit_grid_cells((key["x"], key["y"], key["width"], key["height"])):
+                bisect.insort(hit_grid.setdefault(cell, []), index)
+    for key in removed:
+        layer["tap_only"].discard(id(key))
+    for index in changed:
+        if index < len(keys):
+            key = keys[index]
+            if any(key["actions"].get(direction) for direction in DIRECTIONS[1:]):
+                layer["tap_only"].discard(id(key))
+            else:
+                layer["tap_only"].add(id(key))
+    layer["modifier_keys"] = [key for key in keys if key["char"] in MODIFIER_KEYS]
+    layer.pop("preview", None)
+
+    layer.pop("label_layout_grid", None)
+    layer["label_layout"], dirty = relayout_key_labels(keys, layer["view"], layer["text_cache"], layer["label_layout"], changed, modifier_captions=False)
+    surface = layer["surface"]
+    surface_rect = surface.get_rect()
+    dirty = [rect for rect in {tuple(rect.clip(surface_rect)) for rect in dirty} if rect[2] and rect[3]]
+    dirty_grid = {}
+    for rect in dirty:
+        add_label_rect(dirty_grid, pygame.Rect(rect))
+    # Only what overlaps a dirty area is drawn again, in the original order.
+    elements = []
+    for key_rect, labels in layer["label_layout"]:
+        if label_collides(dirty_grid, key_rect):
+            elements.append((key_rect, None))
+        for text_key, text, text_rect in labels:
+            if text is not None and label_collides(dirty_grid, text_rect):
+                elements.append((text_rect, text))
+    for rect in dirty:
+        surface.set_clip(rect)
+        surface.fill((255, 255, 255))
+        for element_rect, text in elements:
+            if element_rect.colliderect(rect):
+                if text is None:
+                    draw_key_rect(surface, element_rect, (200, 200, 200))
+                else:
+                    surface.blit(text, element_rect)
+        draw_keyboard_layer_chrome(surface, keyboard_data, layer_name, layer["view"])
+        surface.set_clip(None)
+    layer["patches"] = {patch_id: patch for patch_id, patch in layer["patches"].items()
+                        if patch is None or not label_collides(dirty_grid, patch[1])}
+    texture_cache.clear()
+    print(f"Patched keyboard layer '{layer_name}': {len(changed)} keys, {len(dirty)} regions redrawn")
+
+# Remote mode frames: type, flags, sequence number and payload length, then the
+# payload. KEY carries the action as UTF-8, HELLO a 16-byte session id plus the
+# shared token, and ACK confirms every key up to its sequence number.
+REMOTE_HEADER = struct.Struct("!BBIH")
+REMOTE_HELLO = 1
+REMOTE_KEY = 2
+REMOTE_ACK = 3
+REMOTE_SHIFT = 1
+REMOTE_CTRL = 2
+REMOTE_DEFAULT_PORT = 8766
+REMOTE_RECONNECT_MIN = 0.25
+REMOTE_RECONNECT_MAX = 5.0
+REMOTE_PAYLOAD_LIMIT = 0xFFFF
+# Unacknowledged keys kept for resending; past this the oldest are dropped.
+REMOTE_QUEUE_LIMIT = 10000
+remote_link = None
+
+def pack_remote_frame(kind, seq, payload=b"", flags=0):
+    if len(payload) > REMOTE_PAYLOAD_LIMIT:
+        raise ValueError(f"Remote frame payload is {len(payload)} bytes, over the {REMOTE_PAYLOAD_LIMIT} byte limit")
+    return REMOTE_HEADER.pack(kind, flags, seq, len(payload)) + payload
+
+def split_remote_payload(data):
+    # Text too long for one frame goes as several KEY frames, cut between
+    # UTF-8 characters.
+    chunks = []
+    while len(data) > REMOTE_PAYLOAD_LIMIT:
+        cut = REMOTE_PAYLOAD_LIMIT
+        while data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        chunks.append(data[:cut])
+        data = data[cut:]
+    chunks.append(data)
+    return chunks
+
+def parse_remote_address(address):
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return (address, REMOTE_DEFAULT_PORT)
+
+def start_remote_link(address, token=""):
+    # Keys are kept until the host acknowledges them and are resent after a
+    # reconnect; the host skips sequence numbers it has already typed for this
+    # session, so nothing is typed twice.
+    global remote_link
+    remote_link = {
+        "address": parse_remote_address(address),
+        "hello": pack_remote_frame(REMOTE_HELLO, 0, uuid.uuid4().bytes + token.encode("utf-8")),
+        "lock": threading.Lock(),
+        "unacked": OrderedDict(),
+        "outbox": queue.Queue(),
+        "next_seq": 1,
+        "socket": None,
+        "connected": False,
+        "ack_ms": deque(maxlen=4096),
+        "stop": threading.Event()
+    }
+    remote_link["thread"] = threading.Thread(target=run_remote_link, args=(remote_link,), daemon=True)
+    remote_link["thread"].start()
+    print(f"Remote mode: sending keys to {remote_link['address'][0]}:{remote_link['address'][1]}")
+
+def stop_remote_link(flush_timeout=2.0):
+    global remote_link
+    if remote_link is None:
+        return
+    link = remote_link
+    deadline = time.perf_counter() + flush_timeout
+    while link["unacked"] and link["connected"] and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    if link["unacked"]:
+        print(f"Remote mode: {len(link['unacked'])} keys were never acknowledged")
+    link["stop"].set()
+    link["outbox"].put(None)
+    with link["lock"]:
+        if link["socket"] is not None:
+            link["socket"].close()
+    link["thread"].join(2)
+    remote_link = None
+
+def send_remote_key(text, shift=False, ctrl=False):
+    link = remote_link
+    flags = (REMOTE_SHIFT if shift else 0) | (REMOTE_CTRL if ctrl else 0)
+    seqs = []
+    dropped = 0
+    with link["lock"]:
+        for chunk in split_remote_payload(text.encode("utf-8")):
+            seq = link["next_seq"]
+            link["next_seq"] += 1
+            link["unacked"][seq] = (pack_remote_frame(REMOTE_KEY, seq, chunk, flags), time.perf_counter())
+            seqs.append(seq)
+        while len(link["unacked"]) > REMOTE_QUEUE_LIMIT:
+            link["unacked"].popitem(last=False)
+            dropped += 1
+    for seq in seqs:
+        link["outbox"].put(seq)
+    if dropped:
+        print(f"Remote mode: more than {REMOTE_QUEUE_LIMIT} keys unacknowledged, dropped the {dropped} oldest")
+    if not link["connected"]:
+        print(f"Remote mode: host unreachable, {len(link['unacked'])} keys queued")
+
+def read_remote_acks(link, sock):
+    buffer = b""
+    while True:
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            return
+        if not data:
+            return
+        buffer += data
+        frame_count = len(buffer) // REMOTE_HEADER.size
+        now = time.perf_counter()
+        for i in range(frame_count):
+            kind, flags, seq, length = REMOTE_HEADER.unpack_from(buffer, i * REMOTE_HEADER.size)
+            if kind != REMOTE_ACK:
+                continue
+            with link["lock"]:
+                while link["unacked"] and next(iter(link["unacked"])) <= seq:
+                    acked_seq, (frame, sent) = link["unacked"].popitem(last=False)
+                    if acked_seq == seq:
+                        link["ack_ms"].append((now - sent) * 1000)
+        buffer = buffer[frame_count * REMOTE_HEADER.size:]
+
+def run_remote_link(link):
+    delay = REMOTE_RECONNECT_MIN
+    while not link["stop"].is_set():
+        try:
+            sock = socket.create_connection(link["address"], timeout=REMOTE_RECONNECT_MAX)
+        except OSError as e:
+            print(f"Remote mode: connect failed ({e}), retrying in {delay:.2f}s")
+            link["stop"].wait(delay)
+            delay = min(delay * 2, REMOTE_RECONNECT_MAX)
+            continue
+        delay = REMOTE_RECONNECT_MIN
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with link["lock"]:
+            link["socket"] = sock
+            pending = [frame for frame, sent in link["unacked"].values()]
+            sent_through = link["next_seq"] - 1
+        reader = threading.Thread(target=read_remote_acks, args=(link, sock), daemon=True)
+        try:
+            sock.sendall(link["hello"] + b"".join(pending))
+            link["connected"] = True
+            print(f"Remote mode: connected, resent {len(pending)} unacknowledged keys")
+            reader.start()
+            while reader.is_alive() and not link["stop"].is_set():
+                try:
+                    seqs = [link["outbox"].get(timeout=0.2)]
+                except queue.Empty:
+                    continue
+                while not link["outbox"].empty():
+                    seqs.append(link["outbox"].get_nowait())
+                seqs = [seq for seq in seqs if seq is not None and seq > sent_through]
+                with link["lock"]:
+                    frames = [link["unacked"][seq][0] for seq in seqs if seq in link["unacked"]]
+                if frames:
+                    sock.sendall(b"".join(frames))
+                sent_through = max([sent_through] + seqs)
+        except OSError as e:
+            print(f"Remote mode: connection lost ({e})")
+        finally:
+            link["connected"] = False
+            with link["lock"]:
+                link["socket"] = None
+            sock.close()
+            if reader.is_alive():
+                reader.join(1)
+
+def process_remote_acks():
+    if remote_link is None:
+        return
+    ack_ms = remote_link["ack_ms"]
+    while ack_ms:
+        record_timing("remote.ack", ack_ms.popleft())
+
 def update_loop():
-    global state, selected_key, swipe_start, swipe_direction, selected_keyboard, current_keys, dragged_key, configuring_key, label_text, text_active, active_input, action_texts, scroll_offset, dragged_scroll, keyboard_name_text, last_typed_text, input_buffer, show_keyboard, last_arrow_click, scroll_start_y, keyboards, load_code_text, screen, feedback_message, feedback_timer, last_key_action_time, active_modifiers, caps_lock_active
+    global state, selected_key, swipe_start, swipe_direction, selected_keyboard, current_keys, key_drag, key_selection, box_select, key_mods, configuring_key, label_buffer, text_active, active_input, action_texts, scroll_offset, dragged_scroll, keyboard_name_text, last_typed_text, input_buffer, show_keyboard, last_arrow_click, scroll_start_y, keyboards, load_code_buffer, screen, pending_resize, scroll_velocity, last_scroll_sample, last_frame_time, feedback_message, feedback_timer, last_key_action_time, key_press_time, key_dispatched, active_modifiers, caps_lock_active, clipboard_fresh, show_profiler_hud, latched_layer, oneshot_layer, editing_layers, editing_layer
     
-    for event in pygame.event.get():
+    frame_events = get_frame_events()
+    frame_start = time.perf_counter()
+    begin_profiled_frame()
+    process_clipboard_results()
+    process_control_requests()
+    process_remote_acks()
+    if layout_watch is not None:
+        process_layout_updates()
+    for event in frame_events:
+        record_event(event)
+    # Early swipe dispatch classifies the gesture as it moves, so it keeps the path.
+    frame_events = coalesce_motion_events(frame_events, keep_path=dispatch_mode == "early" and state == "keyboard" and selected_key is not None and not key_dispatched)
+    for event in frame_events:
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            # Held modifiers are read from key events rather than live device
+            # state, so a replay sees the ones that were recorded.
+            key_mods = event.mod
         if event.type == pygame.QUIT:
             pygame.quit()
             return
         elif event.type == pygame.VIDEORESIZE:
-            screen = pygame.display.set_mode((event.w, event.h), pygame.RESIZABLE)
+            pending_resize = (event.w, event.h)
+        elif event.type == pygame.CLIPBOARDUPDATE:
+            clipboard_fresh = False
+        elif event.type == REPLAY_PASTE_EVENT:
+            apply_clipboard_paste(event.text, label_buffer)
+        elif event.type == pygame.WINDOWSIZECHANGED:
+            if renderer_backend == "gpu" and screen.get_size() != (event.x, event.y):
+                pending_resize = (event.x, event.y)
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_F11:
-                pygame.display.toggle_fullscreen()
+                toggle_fullscreen()
+            elif event.key == pygame.K_F3:
+                show_profiler_hud = not show_profiler_hud
+                if event.mod & pygame.KMOD_SHIFT:
+                    reset_profile()
+                print(f"Profiler HUD {'shown' if show_profiler_hud else 'hidden'}")
+            elif event.key == pygame.K_F4:
+                start_frame_profile(PROFILE_HOTKEY_FRAMES)
             elif text_active and active_input:
                 try:
-                    if event.key == pygame.K_c and (event.mod & pygame.KMOD_CTRL):
-                        if copy_to_clipboard(label_text):
+                    ctrl_held = event.mod & pygame.KMOD_CTRL
+                    shift_held = bool(event.mod & pygame.KMOD_SHIFT)
+                    if event.key == pygame.K_c and ctrl_held:
+                        copied_text = label_buffer.selected_text() or label_buffer.text()
+                        if copy_to_clipboard(copied_text):
                             set_feedback_message("Text copied")
-                            print(f"Copied text to clipboard: {label_text[:50]}...")
-                    elif event.key == pygame.K_x and (event.mod & pygame.KMOD_CTRL):
-                        if copy_to_clipboard(label_text):
-                            label_text = ""
+                            print(f"Copied text to clipboard: {copied_text[:50]}...")
+                    elif event.key == pygame.K_x and ctrl_held:
+                        if not label_buffer.selection():
+                            label_buffer.select_all()
+                        if copy_to_clipboard(label_buffer.selected_text()):
+                            label_buffer.delete_selection()
                             set_feedback_message("Text cut")
                             print("Cut text to clipboard")
-                    elif event.key == pygame.K_v and (event.mod & pygame.KMOD_CTRL):
-                        pasted = get_clipboard_text()
-                        if pasted:
-                            label_text += pasted
-                            set_feedback_message("Text pasted")
-                            print(f"Pasted text: {pasted[:50]}...")
-                            if active_input in ["start_load_code", "load_code"]:
-                                load_code_text = label_text
-                    elif event.key == pygame.K_a and (event.mod & pygame.KMOD_CTRL):
-                        if copy_to_clipboard(label_text):
-                            set_feedback_message("Text selected")
-                            print("Selected and copied all text")
+                    elif event.key == pygame.K_v and ctrl_held:
+                        request_clipboard_paste(label_buffer)
+                    elif event.key == pygame.K_a and ctrl_held:
+                        label_buffer.select_all()
+                        set_feedback_message("Text selected")
+                        print("Selected all text")
                     elif event.key == pygame.K_RETURN:
+                        label_text = label_buffer.text()
                         if active_input in ["start_load_code", "load_code"]:
-                            load_code_text = label_text
-                            text_active = False
-                            active_input = None
-                            label_text = ""
                             set_feedback_message("JSON code set")
                             print(f"JSON code set from paste box ({active_input})")
+                            text_active = False
+                            active_input = None
+                            label_buffer = TextBuffer()
                         elif active_input == "keyboard_name":
                             keyboard_name_text = label_text if label_text.strip() else ""
                         elif configuring_key and active_input in DIRECTIONS:
@@ -1006,24 +3704,43 @@ def update_loop():
                             try:
                                 value = int(label_text) if label_text.strip() else 40
                                 value = max(20, min(200, value))
-                                configuring_key[active_input] = value
                             except ValueError:
-                                configuring_key[active_input] = 40
+                                value = 40
+                            for key in get_selected_keys():
+                                key[active_input] = value
                     elif event.key == pygame.K_BACKSPACE:
-                        label_text = label_text[:-1]
-                        if active_input in ["start_load_code", "load_code"]:
-                            load_code_text = label_text
+                        label_buffer.delete_back()
+                    elif event.key == pygame.K_DELETE:
+                        label_buffer.delete_forward()
+                    elif event.key == pygame.K_LEFT:
+                        label_buffer.move_cursor(label_buffer.cursor - 1, shift_held)
+                    elif event.key == pygame.K_RIGHT:
+                        label_buffer.move_cursor(label_buffer.cursor + 1, shift_held)
+                    elif event.key == pygame.K_HOME:
+                        label_buffer.move_cursor(0, shift_held)
+                    elif event.key == pygame.K_END:
+                        label_buffer.move_cursor(len(label_buffer), shift_held)
                     elif event.unicode.isprintable():
                         if active_input in ["width", "height"]:
                             if event.unicode.isdigit():
-                                label_text += event.unicode
+                                label_buffer.insert(event.unicode)
                         else:
-                            label_text += event.unicode
-                            if active_input in ["start_load_code", "load_code"]:
-                                load_code_text = label_text
+                            label_buffer.insert(event.unicode)
                 except Exception as e:
                     set_feedback_message("Key error")
                     print(f"Key event error: {e}\n{traceback.format_exc()}")
+            elif state == "configure" and selected_keyboard:
+                if event.key in NUDGE_KEYS:
+                    step = 10 if event.mod & pygame.KMOD_SHIFT else 1
+                    selection = get_selected_keys()
+                    nudge_keys(selection, NUDGE_KEYS[event.key][0] * step, NUDGE_KEYS[event.key][1] * step)
+                    print(f"Nudged {len(selection)} keys")
+                elif event.key == pygame.K_a and event.mod & pygame.KMOD_CTRL:
+                    key_selection = {id(key): key for key in current_keys}
+                    set_feedback_message(f"{len(current_keys)} keys selected")
+                elif event.key == pygame.K_ESCAPE:
+                    key_selection = {}
+                    print("Cleared key selection")
         elif event.type == pygame.MOUSEBUTTONDOWN:
             mouse_pos = event.pos
             try:
@@ -1033,7 +3750,7 @@ def update_loop():
                         selected_keyboard = create_default_keyboard()
                         current_keys = selected_keyboard["keys"]
                         configuring_key = current_keys[0] if current_keys else None
-                        label_text = ""
+                        label_buffer = TextBuffer()
                         keyboard_name_text = selected_keyboard["name"]
                         action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS} if configuring_key else {}
                         state = "configure"
@@ -1047,11 +3764,12 @@ def update_loop():
                                 print("No keyboards to save")
                             else:
                                 kb_to_save = selected_keyboard if selected_keyboard else keyboards[0]
-                                json_data = {"name": kb_to_save["name"], "keys": kb_to_save["keys"]}
+                                json_data = keyboard_to_json(kb_to_save)
                                 json_str = json.dumps(json_data, indent=2)
                                 print(f"Generated JSON: {json_str[:100]}...")
+                                lint_summary = report_layout_lint(kb_to_save, "save")
                                 if copy_to_clipboard(json_str):
-                                    set_feedback_message("Keyboard JSON copied")
+                                    set_feedback_message(f"Keyboard JSON copied, lint: {lint_summary}" if lint_summary else "Keyboard JSON copied")
                                     print("JSON copied to clipboard")
                                 else:
                                     set_feedback_message("Copy failed")
@@ -1062,22 +3780,19 @@ def update_loop():
                     elif load_button_rect.collidepoint(mouse_pos):
                         print("Load button clicked (start)")
                         try:
+                            load_code_text = load_code_buffer.text()
                             if load_code_text and load_code_text.strip():
-                                new_keyboard = json.loads(load_code_text)
-                                if not isinstance(new_keyboard, dict):
-                                    set_feedback_message("Invalid JSON: Must be an object")
-                                    print("Invalid JSON: Not an object")
-                                elif "name" not in new_keyboard or "keys" not in new_keyboard:
-                                    set_feedback_message("Invalid JSON: Missing 'name' or 'keys'")
-                                    print("Invalid JSON: Missing required fields")
-                                elif not isinstance(new_keyboard["keys"], list):
-                                    set_feedback_message("Invalid JSON: 'keys' must be a list")
-                                    print("Invalid JSON: 'keys' not a list")
+                                new_keyboard = parse_keyboard_text(load_code_text)
+                                error = validate_keyboard_json(new_keyboard)
+                                if error:
+                                    set_feedback_message(f"Invalid JSON: {error}")
+                                    print(f"Invalid JSON: {error}")
                                 else:
                                     new_keyboard["id"] = str(uuid.uuid4())
-                                    keyboards.append(new_keyboard)
+                                    keyboards.append(normalize_keyboard_layout(new_keyboard))
                                     state = "list"
-                                    set_feedback_message("Keyboard loaded")
+                                    lint_summary = report_layout_lint(new_keyboard, "load")
+                                    set_feedback_message(f"Keyboard loaded, lint: {lint_summary}" if lint_summary else "Keyboard loaded")
                                     print("Keyboard loaded from JSON")
                             else:
                                 set_feedback_message("No JSON to load")
@@ -1085,18 +3800,21 @@ def update_loop():
                         except json.JSONDecodeError as e:
                             set_feedback_message(f"JSON parse error: {str(e)}")
                             print(f"JSON parse error: {e}\n{traceback.format_exc()}")
+                        except ValueError as e:
+                            set_feedback_message(f"Spec error: {e}")
+                            print(f"Layout spec error: {e}")
                         except Exception as e:
                             set_feedback_message("Load error")
                             print(f"Load error: {e}\n{traceback.format_exc()}")
                     elif paste_input_rect.collidepoint(mouse_pos):
                         text_active = True
                         active_input = "start_load_code"
-                        label_text = load_code_text or ""
+                        label_buffer = load_code_buffer
                         set_feedback_message("Paste box activated")
                         print("Paste JSON input activated (start)")
                     elif delete_code_button_rect.collidepoint(mouse_pos):
-                        load_code_text = ""
-                        label_text = ""
+                        load_code_buffer.set_text("")
+                        label_buffer = TextBuffer()
                         text_active = False
                         active_input = None
                         set_feedback_message("Paste input cleared")
@@ -1117,35 +3835,71 @@ def update_loop():
                     else:
                         dragged_scroll = True
                         scroll_start_y = mouse_pos[1]
+                        scroll_velocity = 0
+                        last_scroll_sample = input_time
                 
                 elif state == "configure" and selected_keyboard:
-                    add_key_button, done_button, delete_key_button, input_rects, duplicate_key_button = draw_configure_screen()
+                    add_key_button, done_button, delete_key_button, input_rects, duplicate_key_button, layer_button = draw_configure_screen()
                     if add_key_button.collidepoint(mouse_pos):
                         new_key = create_new_key()
                         current_keys.append(new_key)
                         configuring_key = new_key
-                        label_text = ""
+                        label_buffer = TextBuffer()
                         action_texts = {direction: "" for direction in DIRECTIONS}
                         text_active = False
                         active_input = None
-                        dragged_key = None
+                        key_drag = None
+                        key_selection = {}
                         print("Added new blank key")
                     elif duplicate_key_button.collidepoint(mouse_pos):
                         if configuring_key:
-                            new_key = create_new_key(configuring_key)
-                            new_key["x"] += 10
-                            new_key["y"] += 10
-                            current_keys.append(new_key)
-                            configuring_key = new_key
-                            label_text = ""
+                            # The copies become the selection, and the copy of the
+                            # configured key is configured next.
+                            copies = {}
+                            for key in get_selected_keys():
+                                new_key = create_new_key(key)
+                                new_key["x"] += 10
+                                new_key["y"] += 10
+                                current_keys.append(new_key)
+                                copies[id(new_key)] = new_key
+                                if key is configuring_key:
+                                    configuring_key = new_key
+                            key_selection = copies
+                            label_buffer = TextBuffer()
                             action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS}
                             text_active = False
                             active_input = None
-                            dragged_key = None
-                            print("Duplicated selected key")
+                            key_drag = None
+                            print(f"Duplicated {len(copies)} selected keys")
+                    elif layer_button.collidepoint(mouse_pos):
+                        if editing_layers is None:
+                            editing_layers = {"base": current_keys}
+                            editing_layers.update(copy.deepcopy(selected_keyboard.get("layers", {})))
+                        editing_layer = LAYER_NAMES[(LAYER_NAMES.index(editing_layer) + 1) % len(LAYER_NAMES)]
+                        if editing_layer not in editing_layers:
+                            editing_layers[editing_layer] = copy.deepcopy(editing_layers["base"])
+                        current_keys = editing_layers[editing_layer]
+                        configuring_key = current_keys[0] if current_keys else None
+                        key_selection = {}
+                        label_buffer = TextBuffer()
+                        action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS} if configuring_key else {}
+                        text_active = False
+                        active_input = None
+                        key_drag = None
+                        set_feedback_message(f"Editing layer: {editing_layer}")
+                        print(f"Switched configure screen to layer '{editing_layer}'")
                     elif done_button.collidepoint(mouse_pos):
+                        if editing_layers is not None:
+                            current_keys = editing_layers["base"]
+                            # Layers left identical to the base layer are dropped.
+                            layers = {name: keys for name, keys in editing_layers.items() if name != "base" and keys and keys != current_keys}
+                            if layers:
+                                selected_keyboard["layers"] = layers
+                            else:
+                                selected_keyboard.pop("layers", None)
                         selected_keyboard["keys"] = current_keys
                         selected_keyboard["name"] = keyboard_name_text
+                        invalidate_keyboard_layer(selected_keyboard)
                         if selected_keyboard["keys"]:
                             found = False
                             for i, kb in enumerate(keyboards):
@@ -1155,35 +3909,43 @@ def update_loop():
                                     break
                             if not found:
                                 keyboards.append(selected_keyboard)
+                            lint_summary = report_layout_lint(selected_keyboard, "save")
+                            if lint_summary:
+                                set_feedback_message(f"Saved, lint: {lint_summary}")
                         state = "list"
                         selected_keyboard = None
                         current_keys = []
                         configuring_key = None
-                        dragged_key = None
-                        label_text = ""
+                        key_drag = None
+                        key_selection = {}
+                        label_buffer = TextBuffer()
                         keyboard_name_text = ""
                         action_texts = {}
                         text_active = False
                         active_input = None
+                        editing_layers = None
+                        editing_layer = "base"
                         print("Saved keyboard and returned to list")
                     elif delete_key_button.collidepoint(mouse_pos):
                         if configuring_key:
-                            current_keys.remove(configuring_key)
+                            removed = {id(key) for key in get_selected_keys()}
+                            current_keys[:] = [key for key in current_keys if id(key) not in removed]
                             configuring_key = current_keys[0] if current_keys else None
-                            label_text = ""
+                            key_selection = {}
+                            label_buffer = TextBuffer()
                             action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS} if configuring_key else {}
                             text_active = False
                             active_input = None
-                            dragged_key = None
-                            print("Deleted key")
+                            key_drag = None
+                            print(f"Deleted {len(removed)} keys")
                     else:
                         text_active = False
                         active_input = None
                         for input_name, rect in input_rects.items():
                             if rect.collidepoint(mouse_pos):
                                 if "_up_arrow" in input_name or "_down_arrow" in input_name:
-                                    if configuring_key and time.time() - last_arrow_click > 0.1:
-                                        last_arrow_click = time.time()
+                                    if configuring_key and input_time - last_arrow_click > 0.1:
+                                        last_arrow_click = input_time
                                         direction = input_name.split("_")[0]
                                         current_text = action_texts.get(direction, configuring_key["actions"][direction])
                                         current_index = 0
@@ -1201,104 +3963,96 @@ def update_loop():
                                         if direction == "Tap":
                                             configuring_key["char"] = new_text
                                         print(f"Changed {direction} to '{new_text}'")
+                                elif input_name in dict(ARRANGE_BUTTONS):
+                                    selection = get_selected_keys()
+                                    arrange_keys(selection, input_name)
+                                    set_feedback_message(f"{dict(ARRANGE_BUTTONS)[input_name]}: {len(selection)} keys")
+                                    print(f"Arranged {len(selection)} keys: {input_name}")
                                 else:
                                     text_active = True
                                     active_input = input_name
                                     if input_name == "keyboard_name":
-                                        label_text = keyboard_name_text
+                                        label_buffer = TextBuffer(keyboard_name_text)
                                     elif input_name in ["width", "height"]:
-                                        label_text = str(configuring_key[input_name]) if configuring_key else "40"
+                                        label_buffer = TextBuffer(str(configuring_key[input_name]) if configuring_key else "40")
                                     elif configuring_key:
-                                        label_text = action_texts.get(input_name, configuring_key["actions"][input_name])
+                                        label_buffer = TextBuffer(action_texts.get(input_name, configuring_key["actions"][input_name]))
                                     print(f"Activated input: {input_name}")
                                 break
                         else:
-                            keyboard_area_start_y = 50
-                            for key in current_keys:
-                                if (key["x"] <= mouse_pos[0] <= key["x"] + key["width"] and
-                                    key["y"] + keyboard_area_start_y <= mouse_pos[1] <= key["y"] + keyboard_area_start_y + key["height"]):
-                                    dragged_key = key
-                                    configuring_key = key
-                                    label_text = ""
-                                    action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS}
-                                    text_active = False
-                                    active_input = None
-                                    print(f"Selected key with char: {key['char']}")
-                                    break
+                            key = find_key_at(current_keys, (mouse_pos[0], mouse_pos[1] - CONFIGURE_AREA_TOP))
+                            selection = {id(selected): selected for selected in get_selected_keys()}
+                            extend = key_mods & (pygame.KMOD_SHIFT | pygame.KMOD_CTRL)
+                            if key and extend:
+                                # Shift- or Ctrl-click adds a key to the selection or
+                                # takes it out; the last key added is configured.
+                                if id(key) not in selection:
+                                    selection[id(key)] = key
+                                    focus_configuring_key(key)
+                                elif len(selection) > 1:
+                                    del selection[id(key)]
+                                    if key is configuring_key:
+                                        focus_configuring_key(list(selection.values())[-1])
+                                key_selection = selection
+                                print(f"Selection now {len(selection)} keys")
+                            elif key:
+                                # Pressing a selected key drags the whole selection.
+                                key_selection = selection if id(key) in selection else {}
+                                if key is not configuring_key:
+                                    focus_configuring_key(key)
+                                key_drag = begin_key_drag(mouse_pos)
+                                print(f"Selected key with char: {key['char']}")
+                            elif mouse_pos[1] >= CONFIGURE_AREA_TOP:
+                                box_select = {"start": mouse_pos, "rect": pygame.Rect(mouse_pos[0], mouse_pos[1] - CONFIGURE_AREA_TOP, 0, 0),
+                                              "base": selection if extend else {}, "hits": [], "extend": extend,
+                                              "grid": build_hit_grid(current_keys)}
+                                key_selection = dict(box_select["base"])
                 
                 elif state == "list":
-                    add_button_rect, save_button_rect, load_button_rect, load_input_rect, keyboard_buttons, scrollbar_rect, delete_code_button_rect = draw_keyboard_list()
-                    delete_indices = []
-                    duplicate_indices = []
+                    add_button_rect, save_button_rect, load_button_rect, load_input_rect, delete_code_button_rect = draw_keyboard_list()
                     
                     clicked_button = False
-                    for select_button, edit_button, delete_button, idx, duplicate_button in keyboard_buttons:
-                        select_collision_rect = pygame.Rect(select_button.x, select_button.y + scroll_offset, select_button.width, select_button.height)
-                        edit_collision_rect = pygame.Rect(edit_button.x, edit_button.y + scroll_offset, edit_button.width, edit_button.height)
-                        delete_collision_rect = pygame.Rect(delete_button.x, delete_button.y + scroll_offset, delete_button.width, delete_button.height)
-                        duplicate_collision_rect = pygame.Rect(duplicate_button.x, duplicate_button.y + scroll_offset, duplicate_button.width, duplicate_button.height)
-                        
-                        try:
-                            if select_collision_rect.collidepoint(mouse_pos):
-                                if idx < len(keyboards):
-                                    selected_keyboard = keyboards[idx]
-                                    state = "keyboard"
-                                    selected_key = None
-                                    swipe_start = None
-                                    swipe_direction = None
-                                    last_typed_text = ""
-                                    show_keyboard = True
-                                    clicked_button = True
-                                    print(f"Selected keyboard: {selected_keyboard['name']}")
-                            elif edit_collision_rect.collidepoint(mouse_pos):
-                                if idx < len(keyboards):
-                                    selected_keyboard = keyboards[idx]
-                                    current_keys = copy.deepcopy(selected_keyboard["keys"]) or [create_new_key()]
-                                    configuring_key = current_keys[0] if current_keys else None
-                                    label_text = ""
-                                    keyboard_name_text = selected_keyboard["name"]
-                                    action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS} if configuring_key else {}
-                                    state = "configure"
-                                    clicked_button = True
-                                    print(f"Editing keyboard: {selected_keyboard['name']}")
-                            elif delete_collision_rect.collidepoint(mouse_pos):
-                                if idx < len(keyboards):
-                                    delete_indices.append(idx)
-                                    clicked_button = True
-                                    print(f"Deleted keyboard at index {idx}")
-                            elif duplicate_collision_rect.collidepoint(mouse_pos):
-                                if idx < len(keyboards):
-                                    duplicate_indices.append(idx)
-                                    clicked_button = True
-                                    print(f"Duplicating keyboard at index {idx}")
-                        except IndexError:
-                            continue
-                    
-                    for idx in sorted(delete_indices, reverse=True):
-                        try:
-                            if idx < len(keyboards):
-                                keyboards.pop(idx)
-                                draw_keyboard_list()
-                        except IndexError:
-                            continue
-                    
-                    for idx in sorted(duplicate_indices, reverse=True):
-                        try:
-                            if idx < len(keyboards):
-                                new_keyboard = copy.deepcopy(keyboards[idx])
-                                new_keyboard["id"] = str(uuid.uuid4())
-                                new_keyboard["name"] = new_keyboard["name"] + " Copy"
-                                keyboards.append(new_keyboard)
-                                set_feedback_message("Keyboard duplicated")
-                                print(f"Duplicated keyboard: {new_keyboard['name']}")
-                        except IndexError:
-                            continue
+                    hit = get_keyboard_list_hit(mouse_pos)
+                    if hit:
+                        idx, button_name = hit
+                        clicked_button = True
+                        if button_name == "select":
+                            selected_keyboard = keyboards[idx]
+                            state = "keyboard"
+                            selected_key = None
+                            swipe_start = None
+                            swipe_direction = None
+                            last_typed_text = ""
+                            show_keyboard = True
+                            latched_layer = "base"
+                            oneshot_layer = None
+                            print(f"Selected keyboard: {selected_keyboard['name']}")
+                        elif button_name == "edit":
+                            selected_keyboard = keyboards[idx]
+                            current_keys = copy.deepcopy(selected_keyboard["keys"]) or [create_new_key()]
+                            configuring_key = current_keys[0] if current_keys else None
+                            key_selection = {}
+                            label_buffer = TextBuffer()
+                            keyboard_name_text = selected_keyboard["name"]
+                            action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS} if configuring_key else {}
+                            state = "configure"
+                            print(f"Editing keyboard: {selected_keyboard['name']}")
+                        elif button_name == "delete":
+                            invalidate_keyboard_layer(keyboards.pop(idx))
+                            print(f"Deleted keyboard at index {idx}")
+                        elif button_name == "duplicate":
+                            new_keyboard = copy.deepcopy(keyboards[idx])
+                            new_keyboard["id"] = str(uuid.uuid4())
+                            new_keyboard["name"] = new_keyboard["name"] + " Copy"
+                            keyboards.append(new_keyboard)
+                            set_feedback_message("Keyboard duplicated")
+                            print(f"Duplicated keyboard: {new_keyboard['name']}")
                     
                     if add_button_rect.collidepoint(mouse_pos):
                         selected_keyboard = create_default_keyboard()
                         current_keys = selected_keyboard["keys"]
                         configuring_key = current_keys[0] if current_keys else None
-                        label_text = ""
+                        label_buffer = TextBuffer()
                         keyboard_name_text = selected_keyboard["name"]
                         action_texts = {direction: configuring_key["actions"][direction] for direction in DIRECTIONS} if configuring_key else {}
                         state = "configure"
@@ -1312,11 +4066,12 @@ def update_loop():
                                 print("No keyboards to save")
                             else:
                                 kb_to_save = selected_keyboard if selected_keyboard else keyboards[0]
-                                json_data = {"name": kb_to_save["name"], "keys": kb_to_save["keys"]}
+                                json_data = keyboard_to_json(kb_to_save)
                                 json_str = json.dumps(json_data, indent=2)
                                 print(f"Generated JSON: {json_str[:100]}...")
+                                lint_summary = report_layout_lint(kb_to_save, "save")
                                 if copy_to_clipboard(json_str):
-                                    set_feedback_message("Keyboard JSON copied")
+                                    set_feedback_message(f"Keyboard JSON copied, lint: {lint_summary}" if lint_summary else "Keyboard JSON copied")
                                     print("JSON copied to clipboard")
                                 else:
                                     set_feedback_message("Copy failed")
@@ -1327,21 +4082,18 @@ def update_loop():
                     elif load_button_rect.collidepoint(mouse_pos):
                         print("Load button clicked (list)")
                         try:
+                            load_code_text = load_code_buffer.text()
                             if load_code_text and load_code_text.strip():
-                                new_keyboard = json.loads(load_code_text)
-                                if not isinstance(new_keyboard, dict):
-                                    set_feedback_message("Invalid JSON: Must be an object")
-                                    print("Invalid JSON: Not an object")
-                                elif "name" not in new_keyboard or "keys" not in new_keyboard:
-                                    set_feedback_message("Invalid JSON: Missing 'name' or 'keys'")
-                                    print("Invalid JSON: Missing required fields")
-                                elif not isinstance(new_keyboard["keys"], list):
-                                    set_feedback_message("Invalid JSON: 'keys' must be a list")
-                                    print("Invalid JSON: 'keys' not a list")
+                                new_keyboard = parse_keyboard_text(load_code_text)
+                                error = validate_keyboard_json(new_keyboard)
+                                if error:
+                                    set_feedback_message(f"Invalid JSON: {error}")
+                                    print(f"Invalid JSON: {error}")
                                 else:
                                     new_keyboard["id"] = str(uuid.uuid4())
-                                    keyboards.append(new_keyboard)
-                                    set_feedback_message("Keyboard loaded")
+                                    keyboards.append(normalize_keyboard_layout(new_keyboard))
+                                    lint_summary = report_layout_lint(new_keyboard, "load")
+                                    set_feedback_message(f"Keyboard loaded, lint: {lint_summary}" if lint_summary else "Keyboard loaded")
                                     print("Keyboard loaded from JSON")
                             else:
                                 set_feedback_message("No JSON to load")
@@ -1349,18 +4101,21 @@ def update_loop():
                         except json.JSONDecodeError as e:
                             set_feedback_message(f"JSON parse error: {str(e)}")
                             print(f"JSON parse error: {e}\n{traceback.format_exc()}")
+                        except ValueError as e:
+                            set_feedback_message(f"Spec error: {e}")
+                            print(f"Layout spec error: {e}")
                         except Exception as e:
                             set_feedback_message("Load error")
                             print(f"Load error: {e}\n{traceback.format_exc()}")
                     elif load_input_rect.collidepoint(mouse_pos):
                         text_active = True
                         active_input = "load_code"
-                        label_text = load_code_text or ""
+                        label_buffer = load_code_buffer
                         set_feedback_message("Paste box activated")
                         print("Paste JSON input activated (list)")
                     elif delete_code_button_rect.collidepoint(mouse_pos):
-                        load_code_text = ""
-                        label_text = ""
+                        load_code_buffer.set_text("")
+                        label_buffer = TextBuffer()
                         text_active = False
                         active_input = None
                         set_feedback_message("Paste input cleared")
@@ -1368,6 +4123,8 @@ def update_loop():
                     elif not clicked_button:
                         dragged_scroll = True
                         scroll_start_y = mouse_pos[1]
+                        scroll_velocity = 0
+                        last_scroll_sample = input_time
                 
                 elif state == "keyboard" and selected_keyboard:
                     back_button_rect = draw_keyboard()
@@ -1377,20 +4134,27 @@ def update_loop():
                         swipe_start = None
                         swipe_direction = None
                         last_typed_text = ""
-                        input_buffer = ""
+                        clear_input_history()
                         show_keyboard = False
                         active_modifiers = {key: False for key in active_modifiers}
                         caps_lock_active = False
+                        latched_layer = "base"
+                        oneshot_layer = None
                         print("Back to keyboard list")
                     else:
-                        for key in selected_keyboard["keys"]:
-                            if (key["x"] <= mouse_pos[0] <= key["x"] + key["width"] and
-                                key["y"] <= mouse_pos[1] <= key["y"] + key["height"]):
-                                selected_key = key
-                                swipe_start = mouse_pos
-                                swipe_direction = None
-                                print(f"Started swipe on key: {key['char']}")
-                                break
+                        layer = get_keyboard_layer(selected_keyboard, get_active_layer_name(selected_keyboard))
+                        key = find_key_at(layer["keys"], screen_to_layout(mouse_pos, layer["view"]), layer["hit_grid"])
+                        if key:
+                            selected_key = key
+                            swipe_start = mouse_pos
+                            swipe_direction = None
+                            key_press_time = frame_start
+                            key_dispatched = False
+                            print(f"Started swipe on key: {key['char']}")
+                            if dispatch_mode != "release" and id(key) in layer["tap_only"]:
+                                begin_keystroke_trace(frame_start, dispatch="press")
+                                swipe_direction = "Tap"
+                                dispatch_key_action(key, swipe_direction)
             except Exception as e:
                 set_feedback_message("Mouse down error")
                 print(f"Mouse down error: {e}\n{traceback.format_exc()}")
@@ -1399,19 +4163,25 @@ def update_loop():
             mouse_pos = event.pos
             try:
                 if state == "keyboard" and selected_key and swipe_start:
-                    swipe_direction = get_swipe_direction(swipe_start, mouse_pos)
-                    distance = math.hypot(mouse_pos[0] - swipe_start[0], mouse_pos[1] - swipe_start[1])
-                    if distance < 10:
-                        swipe_direction = "Tap"
-                    action = selected_key["actions"].get(swipe_direction)
-                    if action and time.time() - last_key_action_time > 0.2:
-                        last_key_action_time = time.time()
-                        send_key(action)
-                        print(f"Performed {swipe_direction} action: '{action}'")
+                    if not key_dispatched:
+                        begin_keystroke_trace(frame_start, key_press_time)
+                        swipe_direction = get_swipe_direction(swipe_start, mouse_pos)
+                        distance = math.hypot(mouse_pos[0] - swipe_start[0], mouse_pos[1] - swipe_start[1])
+                        if distance < SWIPE_THRESHOLD:
+                            swipe_direction = "Tap"
+                        dispatch_key_action(selected_key, swipe_direction)
                     selected_key = None
                     swipe_start = None
                     swipe_direction = None
-                dragged_key = None
+                key_drag = None
+                if box_select is not None:
+                    hits = box_select["hits"]
+                    if hits and not box_select["extend"] and not any(key is configuring_key for key in hits):
+                        focus_configuring_key(hits[0])
+                    print(f"Box selected {len(hits)} keys")
+                    box_select = None
+                if dragged_scroll and input_time - last_scroll_sample > 0.05:
+                    scroll_velocity = 0
                 dragged_scroll = False
                 print("Mouse button released, stopped dragging")
             except Exception as e:
@@ -1421,18 +4191,45 @@ def update_loop():
         elif event.type == pygame.MOUSEMOTION:
             mouse_pos = event.pos
             try:
-                if state == "configure" and dragged_key:
-                    dragged_key["x"] = max(0, min(mouse_pos[0] - dragged_key["width"] // 2, screen.get_width() - dragged_key["width"]))
-                    dragged_key["y"] = max(0, min(mouse_pos[1] - dragged_key["height"] // 2 - 50, screen.get_height() - dragged_key["height"] - 50))
-                    print(f"Dragging key to ({dragged_key['x']}, {dragged_key['y']})")
+                if state == "configure" and key_drag:
+                    # Alt drags freely, without snapping.
+                    move_key_drag(key_drag, mouse_pos, not key_mods & pygame.KMOD_ALT)
+                    print(f"Dragging {len(key_drag['keys'])} keys by {key_drag['offset']}")
+                elif state == "configure" and box_select:
+                    start = box_select["start"]
+                    box_select["rect"] = pygame.Rect(min(start[0], mouse_pos[0]), min(start[1], mouse_pos[1]) - CONFIGURE_AREA_TOP,
+                                                     abs(mouse_pos[0] - start[0]), abs(mouse_pos[1] - start[1]))
+                    box_select["hits"] = find_keys_in_rect(current_keys, box_select["rect"], box_select["grid"])
+                    key_selection = dict(box_select["base"])
+                    key_selection.update((id(key), key) for key in box_select["hits"])
                 elif dragged_scroll and state in ["list", "help"]:
-                    scroll_offset += scroll_start_y - mouse_pos[1]
+                    now = input_time
+                    delta = scroll_start_y - mouse_pos[1]
+                    scroll_offset += delta
                     scroll_start_y = mouse_pos[1]
+                    if now > last_scroll_sample:
+                        scroll_velocity = 0.8 * delta / max(now - last_scroll_sample, 1 / 240) + 0.2 * scroll_velocity
+                    last_scroll_sample = now
                     print(f"Scrolling, offset: {scroll_offset}")
+                elif state == "keyboard" and selected_key and swipe_start and not key_dispatched and dispatch_mode == "early":
+                    direction = get_committed_swipe_direction(swipe_start, mouse_pos)
+                    if direction and selected_key["actions"].get(direction):
+                        begin_keystroke_trace(frame_start, key_press_time, dispatch="motion")
+                        swipe_direction = direction
+                        dispatch_key_action(selected_key, direction)
             except Exception as e:
                 set_feedback_message("Mouse motion error")
                 print(f"Mouse motion error: {e}\n{traceback.format_exc()}")
 
+    record_timing("events", (time.perf_counter() - frame_start) * 1000)
+
+    if pending_resize:
+        resize_screen(pending_resize)
+        pending_resize = None
+
+    update_scroll_momentum(min(input_time - last_frame_time, 0.1))
+    last_frame_time = input_time
+
     try:
         if state == "start":
             draw_start_screen()
@@ -1447,21 +4244,81 @@ def update_loop():
     except Exception as e:
         set_feedback_message("Draw error")
         print(f"Draw error: {e}\n{traceback.format_exc()}")
+    end_profiled_frame((time.perf_counter() - frame_start) * 1000)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Virtual Touchscreen Keyboard")
+    parser.add_argument("--renderer", choices=["software", "gpu"], default=os.environ.get("VK_RENDERER", "software"),
+                        help="Drawing backend; 'gpu' uses SDL2 textures and falls back to software if unavailable")
+    parser.add_argument("--profile-frames", type=int, default=0,
+                        help="Run cProfile over the first N frames and write the stats to --profile-output")
+    parser.add_argument("--profile-output", default="keyboard.prof", help="Where cProfile stats are written (also used by F4)")
+    parser.add_argument("--latency-export", default=None,
+                        help="Write keystroke latency traces to this file (.prom/.txt for Prometheus text, otherwise JSON)")
+    parser.add_argument("--dispatch", choices=["release", "press", "early"], default="release",
+                        help="When keys fire: on release (default), tap-only keys on press, or also swipes once their direction is unambiguous")
+    parser.add_argument("--control", default=None,
+                        help="Serve the scripting API on this Unix socket path or loopback HOST:PORT")
+    parser.add_argument("--remote", default=None,
+                        help="Send keystrokes to a host_agent.py at HOST[:PORT] instead of typing them on this machine")
+    parser.add_argument("--remote-token", default=os.environ.get("VK_REMOTE_TOKEN", ""), help="Shared token the host agent expects")
+    parser.add_argument("--layouts-dir", default=None,
+                        help="Load every *.json layout in this directory and reload them when they change")
+    parser.add_argument("--snap-grid", type=int, default=10,
+                        help="Grid in layout pixels that dragged keys snap to when no key edge is near; 0 turns the grid off")
+    parser.add_argument("--lint", nargs="+", default=None, metavar="LAYOUT",
+                        help="Check these .json or .kbd layouts for overlapping, unreachable and off-screen keys and labels, then exit")
+    parser.add_argument("--record", default=None, help="Record the input event stream to this file")
+    parser.add_argument("--replay", default=None, help="Replay a recorded event stream instead of live input, then exit")
+    parser.add_argument("--replay-speed", choices=["real", "max"], default="max", help="Replay at recorded pace or as fast as possible")
+    parser.add_argument("--replay-inject", action="store_true", help="Send replayed keystrokes to the system instead of only recording them")
+    return parser.parse_args(argv)
 
-def main():
-    setup()
+def main(args=None):
+    global profile_output, latency_export_path, dispatch_mode, snap_grid
+    if args is None:
+        args = parse_args()
+    if args.lint:
+        raise SystemExit(lint_layout_files(args.lint))
+    setup(renderer=args.renderer)
+    profile_output = args.profile_output
+    latency_export_path = args.latency_export
+    dispatch_mode = args.dispatch
+    snap_grid = args.snap_grid
+    start_frame_profile(args.profile_frames)
+    if args.replay:
+        start_replay(args.replay, args.replay_speed, args.replay_inject)
+    if args.record:
+        start_recording(args.record)
+    if args.control:
+        start_control_server(args.control)
+    if args.layouts_dir:
+        start_layout_watcher(args.layouts_dir)
+    if args.remote:
+        start_remote_link(args.remote, args.remote_token)
     running = True
     clock = pygame.time.Clock()
     
     while running:
         try:
             update_loop()
-            clock.tick(60)
+            start_backend_loader()
+            if not pygame.get_init():
+                running = False
+            elif session_replay is not None and session_replay["done"]:
+                running = False
+            elif session_replay is None or session_replay["speed"] == "real":
+                clock.tick(60)
         except Exception as e:
             set_feedback_message(f"Main loop error: {str(e)}")
             print(f"Main loop error: {e}\n{traceback.format_exc()}")
             running = False
     
+    finish_session()
+    stop_control_server()
+    stop_remote_link()
+    if latency_export_path:
+        export_latency_report(latency_export_path)
     pygame.quit()
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import argparse
+import contextlib
+import io
+import os
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import keyboard as app
+import control
+
+def setup_module():
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.setup()
+
+def load_keyboard(name):
+    keyboard_data = {"name": name, "keys": []}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return app.run_control_command({"cmd": "load", "id": f"load-{name}", "keyboard": keyboard_data})
+
+def test_tagged_select_by_name():
+    first = load_keyboard("first")
+    second = load_keyboard("second")
+    assert first["id"] == "load-first" and first["ok"]
+    assert second["result"]["keyboard_id"] != "load-second"
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = app.run_control_command({"cmd": "select", "id": 7, "name": "second"})
+    assert response == {"id": 7, "ok": True, "result": {"keyboard_id": second["result"]["keyboard_id"]}}
+    assert app.selected_keyboard["name"] == "second"
+
+def test_tagged_select_by_keyboard_id():
+    first = load_keyboard("by-id")
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = app.run_control_command({"cmd": "select", "id": "tag", "keyboard_id": first["result"]["keyboard_id"], "name": "second"})
+    assert response["ok"] and app.selected_keyboard["name"] == "by-id"
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = app.run_control_command({"cmd": "select", "id": first["result"]["keyboard_id"]})
+    assert not response["ok"]
+
+def test_client_replace_targets_keyboard_id(tmp_path):
+    layout = tmp_path / "layout.kbd"
+    layout.write_text("row a b\n", encoding="utf-8")
+    command = control.build_command(argparse.Namespace(command="replace", keyboard_id="abc", file=str(layout)))
+    assert command == {"cmd": "replace", "keyboard_id": "abc", "spec": "row a b\n"}
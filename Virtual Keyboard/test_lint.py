@@ -0,0 +1,44 @@
+import contextlib
+import io
+import os
+import random
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import keyboard as app
+
+def random_rects(rng, count):
+    # A small integer grid makes shared edges, nested and identical rects and
+    # empty rects common.
+    return [(rng.randint(0, 20), rng.randint(0, 20), rng.randint(0, 8), rng.randint(0, 8)) for _ in range(count)]
+
+def share_area(first, second):
+    x, y, width, height = first
+    other_x, other_y, other_width, other_height = second
+    return (width > 0 and height > 0 and other_width > 0 and other_height > 0
+            and x < other_x + other_width and other_x < x + width
+            and y < other_y + other_height and other_y < y + height)
+
+def test_overlaps_within_rects_match_brute_force():
+    rng = random.Random(50)
+    for _ in range(300):
+        rects = random_rects(rng, rng.randint(0, 40))
+        pairs = app.find_rect_overlaps(rects)
+        found = [tuple(sorted(pair)) for pair in pairs]
+        assert len(found) == len(set(found))
+        assert all(first != second for first, second in found)
+        expected = {(first, second) for first in range(len(rects)) for second in range(first + 1, len(rects))
+                    if share_area(rects[first], rects[second])}
+        assert set(found) == expected
+
+def test_overlaps_between_rects_and_others_match_brute_force():
+    rng = random.Random(51)
+    for _ in range(300):
+        rects = random_rects(rng, rng.randint(0, 30))
+        others = random_rects(rng, rng.randint(0, 30))
+        pairs = app.find_rect_overlaps(rects, others)
+        assert len(pairs) == len(set(pairs))
+        expected = {(index, other_index) for index in range(len(rects)) for other_index in range(len(others))
+                    if share_area(rects[index], others[other_index])}
+        assert set(pairs) == expected
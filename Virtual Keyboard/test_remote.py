@@ -0,0 +1,74 @@
+import contextlib
+import io
+import os
+import socket
+import time
+import uuid
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import keyboard as app
+import host_agent
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+@contextlib.contextmanager
+def loopback_agent(token="tok"):
+    typed = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent = host_agent.start_agent("127.0.0.1:0", lambda text, shift, ctrl: typed.append(text), token)
+        app.start_remote_link(f"127.0.0.1:{agent['port']}", token)
+        try:
+            assert wait_for(lambda: app.remote_link["connected"])
+            yield agent, typed
+        finally:
+            app.stop_remote_link(0.5)
+            host_agent.stop_agent(agent)
+
+def test_keys_delivered_once_in_order_across_reconnect():
+    with loopback_agent() as (agent, typed):
+        sent = [f"k{i}" for i in range(300)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i, text in enumerate(sent):
+                app.send_remote_key(text)
+                if i == 150:
+                    app.remote_link["socket"].shutdown(socket.SHUT_RDWR)
+            assert wait_for(lambda: not app.remote_link["unacked"] and app.remote_link["connected"])
+        assert typed == sent
+
+def test_long_text_is_split_and_rejoined():
+    text = "é€x" * 70000
+    with loopback_agent() as (agent, typed):
+        with contextlib.redirect_stdout(io.StringIO()):
+            app.send_remote_key(text)
+            assert wait_for(lambda: not app.remote_link["unacked"])
+        assert len(typed) > 1 and "".join(typed) == text
+
+def test_split_never_cuts_a_character():
+    for text in ["a" * 70000, "é" * 40000, "€" * 30000, "😀" * 20000, "x" + "😀" * 20000, "é" * 10]:
+        chunks = app.split_remote_payload(text.encode("utf-8"))
+        assert all(len(chunk) <= app.REMOTE_PAYLOAD_LIMIT for chunk in chunks)
+        assert "".join(chunk.decode("utf-8") for chunk in chunks) == text
+
+def test_oversized_frame_is_refused():
+    try:
+        app.pack_remote_frame(app.REMOTE_KEY, 1, b"x" * (app.REMOTE_PAYLOAD_LIMIT + 1))
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+
+def test_sessions_are_capped():
+    with loopback_agent() as (agent, typed):
+        for _ in range(host_agent.SESSION_LIMIT + 20):
+            with socket.create_connection(("127.0.0.1", agent["port"])) as sock:
+                sock.sendall(app.pack_remote_frame(app.REMOTE_HELLO, 0, uuid.uuid4().bytes + b"tok"))
+        assert wait_for(lambda: len(agent["sessions"]) == host_agent.SESSION_LIMIT)
+
+def test_non_loopback_agent_needs_a_token():
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert host_agent.start_agent("0.0.0.0:0", lambda text, shift, ctrl: None) is None
@@ -0,0 +1,66 @@
+import contextlib
+import io
+import os
+
+import pytest
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import keyboard as app
+
+def labels(keys):
+    return [key["char"] for key in keys]
+
+def test_ranges_expand_and_advance_together():
+    keys = app.compile_layout_spec("row F{1..3} {a..c}/{A..C} {3..1}")["keys"]
+    assert labels(keys) == ["F1", "F2", "F3", "a", "b", "c", "3", "2", "1"]
+    assert [key["actions"]["Up"] for key in keys[3:6]] == ["A", "B", "C"]
+    with pytest.raises(ValueError, match="line 1: ranges in .* differ in length"):
+        app.compile_layout_spec("row {a..c}{1..2}")
+
+def test_templates_widths_and_gaps():
+    spec = "unit 40\ngap 4\ntemplate pair = x y\nrow @pair ~ Space:2"
+    keys = app.compile_layout_spec(spec)["keys"]
+    assert labels(keys) == ["x", "y", "Space"]
+    assert [(key["x"], key["width"]) for key in keys] == [(0, 40), (44, 40), (132, 84)]
+    with pytest.raises(ValueError, match="line 2: unknown template 'missing'"):
+        app.compile_layout_spec("row a\nrow @missing")
+
+def test_escapes_and_named_actions():
+    keys = app.compile_layout_spec(r"row \~ \/ a\:b:2 q/^/d=\/")["keys"]
+    assert labels(keys) == ["~", "/", "a:b", "q"]
+    assert keys[2]["width"] == 84
+    assert keys[3]["actions"]["Up"] == "Q" and keys[3]["actions"]["Down"] == "/"
+
+def test_rows_and_layers():
+    keyboard_data = app.compile_layout_spec("row:2*2 a b\nlayer shift\nrow A")
+    assert [(key["char"], key["y"], key["height"]) for key in keyboard_data["keys"]] == [
+        ("a", 0, 84), ("b", 0, 84), ("a", 88, 84), ("b", 88, 84)]
+    assert labels(keyboard_data["layers"]["shift"]) == ["A"]
+    assert keyboard_data["layers"]["shift"][0]["y"] == 0
+    with pytest.raises(ValueError, match="line 1: layer must be one of"):
+        app.compile_layout_spec("layer nope")
+
+@pytest.mark.parametrize("spec, message", [
+    ("row: a", "line 1: bad row height '' in 'row:'"),
+    ("row:-1 a", "line 1: row height must be a positive number"),
+    ("# header\nrow*x a", "line 2: bad row count 'x' in 'row\\*x'"),
+    ("rows a", "line 1: unknown directive 'rows'"),
+    ("unit", "line 1: missing value for 'unit'"),
+    ("row a/b/c/d/e/f/g/h/i/j", "line 1: too many actions"),
+])
+def test_error_messages(spec, message):
+    with pytest.raises(ValueError, match=message):
+        app.compile_layout_spec(spec)
+
+def test_key_limit():
+    assert len(app.compile_layout_spec(f"row*{app.SPEC_KEY_LIMIT // 10} {{0..9}}")["keys"]) == app.SPEC_KEY_LIMIT
+    for spec, message in [
+        (f"row*{app.SPEC_KEY_LIMIT} a b", "line 1: more than"),
+        (f"row a\nlayer shift\nrow*{app.SPEC_KEY_LIMIT} b", "line 3: more than"),
+        ("row {1..100000000}", "line 1: range .* has more than"),
+        ("template t = {1..5000}\ntemplate u = @t @t @t", "line 2: template 'u' has more than"),
+    ]:
+        with pytest.raises(ValueError, match=message):
+            app.compile_layout_spec(spec)